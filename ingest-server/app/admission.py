@@ -0,0 +1,56 @@
+"""
+Admission control for POST /uplink.
+
+At most INGEST_MAX_IN_FLIGHT uplinks are handled at once per process.
+Anything beyond that is answered straight away with 503 and Retry-After,
+before its body is read, and the network server retries it later. Memory,
+sockets and tail latency therefore stay bounded while the database or
+device manager is slow.
+
+Readiness (GET /ready, and "ready" in /health) goes false while this
+process is close to the limit, the writer queue is full, the forward
+outbox backlog is over OUTBOX_MAX_BACKLOG, or the writer does not answer.
+"""
+
+import os
+
+INGEST_MAX_IN_FLIGHT = int(os.environ.get("INGEST_MAX_IN_FLIGHT", "256"))  # per worker process
+INGEST_RETRY_AFTER = int(os.environ.get("INGEST_RETRY_AFTER", "5"))  # seconds, sent with 503s
+INGEST_READY_RATIO = float(os.environ.get("INGEST_READY_RATIO", "0.9"))  # in-flight share that reads as saturated
+
+
+class Admission:
+    def __init__(self, max_in_flight=INGEST_MAX_IN_FLIGHT, ready_ratio=INGEST_READY_RATIO):
+        self.max_in_flight = max_in_flight
+        self.ready_limit = max(int(max_in_flight * ready_ratio), 1)
+        self.in_flight = 0
+        self.shed = 0
+
+    def try_enter(self) -> bool:
+        """Take a slot, or count the request as shed if none is free."""
+        if self.in_flight >= self.max_in_flight:
+            self.shed += 1
+            return False
+        self.in_flight += 1
+        return True
+
+    def leave(self):
+        self.in_flight -= 1
+
+    def saturated(self) -> bool:
+        return self.in_flight >= self.ready_limit
+
+    def stats(self) -> dict:
+        return {"in_flight": self.in_flight, "max_in_flight": self.max_in_flight, "shed": self.shed}
+
+
+def not_ready_reasons(admission: Admission, store_stats: dict) -> list:
+    """Why this process should not get more traffic right now (empty when ready)."""
+    reasons = []
+    if admission.saturated():
+        reasons.append("ingest at capacity")
+    if store_stats.get("writer", {}).get("saturated"):
+        reasons.append("writer queue full")
+    if store_stats.get("outbox", {}).get("saturated"):
+        reasons.append("forward outbox backlog over limit")
+    return reasons
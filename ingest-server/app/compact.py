@@ -0,0 +1,236 @@
+"""
+compact.py
+
+Compact storage for raw_uplinks rows.
+
+An uplink used to be stored whole as JSONB in raw_uplinks.payload, so an
+Actility query-string callback held every field twice (top level and under
+query_params), plus the Token. Rows are now written as:
+
+  * fport, fcnt, payload_bytes (BYTEA) and ns_time: typed hot fields
+  * meta: JSONB holding everything else the uplink carried
+  * format: how to rebuild the payload. 1 is a callback whose DevEUI is
+    the row's deveui, 2 is an Actility query string whose query_params
+    repeat the top level, 0 is anything else. NULL means a row that is
+    not migrated yet and still stored in payload.
+
+A field is only dropped from meta when rebuilding it from its column gives
+back the same value. payload_hex has to be lower-case hex, Time has to be
+in the network server's UTC millisecond form ("2025-06-10T19:07:24.887+00:00"),
+FPort has to be an integer, and so on. Otherwise the original value is kept
+in meta, and the column is still filled for queries. Tokens are not stored.
+
+uplink_payload() in initdb/init_raw_uplinks.sql rebuilds the payload. The
+raw_uplinks_json view uses it to give the old row shape for either kind of
+row, so consumer.py, forward_cron.py, /uplink/raw and the exports read the
+view and are unchanged otherwise.
+
+    python -m app.compact status
+    python -m app.compact migrate [--batch-size 5000] [--pause 0.2]
+
+migrate converts older rows in id order, one short transaction per batch,
+so it can run while the ingest server is writing, and can be stopped and
+restarted at any point. A row is only converted if uplink_payload() gives
+back its stored payload, token aside; any other row is left as it is.
+VACUUM makes the freed space reusable by new rows. VACUUM FULL on a
+partition gives it back to the file system.
+"""
+
+import argparse
+import json
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import create_engine, text
+
+from app.checkpoints import INGEST_DB_URL
+from app.partitions import INIT_SQL
+
+MIGRATE_BATCH_SIZE = 5000
+
+FORMAT_OTHER = 0
+FORMAT_CALLBACK = 1
+FORMAT_QUERY = 2
+
+SECRET_FIELDS = ("Token",)
+# query parameter -> top-level field, as app/parser.py builds a query-string uplink
+QUERY_FIELDS = (
+    ("LrnDevEui", "DevEUI"),
+    ("Time", "Time"),
+    ("LrnFPort", "LrnFPort"),
+    ("LrnInfos", "LrnInfos"),
+    ("AS_ID", "AS_ID"),
+)
+INT4_MAX = 2 ** 31 - 1
+INT8_MAX = 2 ** 63 - 1
+
+
+def stored_payload(uplink: dict) -> dict:
+    """The uplink as raw_uplinks keeps it: without tokens."""
+    payload = {k: v for k, v in uplink.items() if k not in SECRET_FIELDS}
+    query = payload.get("query_params")
+    if isinstance(query, dict):
+        payload["query_params"] = {k: v for k, v in query.items() if k not in SECRET_FIELDS}
+    return payload
+
+
+def format_time(value: datetime) -> str:
+    return value.astimezone(timezone.utc).isoformat(timespec="milliseconds")
+
+
+def _int(value, limit):
+    if isinstance(value, bool):
+        return None
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        return None
+    return number if -limit - 1 <= number <= limit else None
+
+
+def _bytes(value):
+    if not isinstance(value, str):
+        return None
+    try:
+        return bytes.fromhex(value)
+    except ValueError:
+        return None
+
+
+def _time(value):
+    if not isinstance(value, str):
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def _take(meta, field, rendered):
+    """Drop field from meta if the column renders back to exactly its value."""
+    value = meta[field]
+    if type(value) is type(rendered) and value == rendered:
+        del meta[field]
+
+
+def pack(deveui: str, uplink: dict):
+    """(format, fport, fcnt, payload_bytes, ns_time, meta) storing one uplink."""
+    meta = stored_payload(uplink)
+    fmt = FORMAT_OTHER
+    if meta.get("DevEUI") == deveui:
+        del meta["DevEUI"]
+        fmt = FORMAT_CALLBACK
+        implied = {q: uplink[f] for q, f in QUERY_FIELDS if uplink.get(f) is not None}
+        if meta.get("query_params") == implied:
+            del meta["query_params"]
+            fmt = FORMAT_QUERY
+
+    port_field = "LrnFPort" if fmt == FORMAT_QUERY else "FPort"
+    fport = _int(meta.get(port_field), INT4_MAX)
+    if fport is not None:
+        _take(meta, port_field, str(fport) if fmt == FORMAT_QUERY else fport)
+    fcnt = _int(meta.get("FCntUp"), INT8_MAX)
+    if fcnt is not None:
+        _take(meta, "FCntUp", fcnt)
+    payload_bytes = _bytes(meta.get("payload_hex"))
+    if payload_bytes is not None:
+        _take(meta, "payload_hex", payload_bytes.hex())
+    ns_time = _time(meta.get("Time"))
+    if ns_time is not None:
+        _take(meta, "Time", format_time(ns_time))
+    return fmt, fport, fcnt, payload_bytes, ns_time, meta or None
+
+
+# ---- migration of older rows (CLI) ----
+
+FETCH_SQL = text("""
+    SELECT id, received_at, deveui, payload FROM raw_uplinks
+    WHERE id > :last_id AND payload IS NOT NULL
+    ORDER BY id
+    LIMIT :limit
+""")
+
+# converts a row only if its rebuilt payload matches, so a mismatch never loses data
+UPDATE_SQL = text("""
+    UPDATE raw_uplinks AS r
+    SET format = c.format, fport = c.fport, fcnt = c.fcnt, payload_bytes = c.payload_bytes,
+        ns_time = c.ns_time, meta = c.meta, payload = NULL
+    FROM unnest(CAST(:ids AS bigint[]), CAST(:times AS timestamptz[]), CAST(:formats AS smallint[]),
+                CAST(:fports AS int[]), CAST(:fcnts AS bigint[]), CAST(:payload_bytes AS bytea[]),
+                CAST(:ns_times AS timestamptz[]), CAST(:metas AS jsonb[]), CAST(:expected AS jsonb[]))
+        AS c(id, received_at, format, fport, fcnt, payload_bytes, ns_time, meta, expected)
+    WHERE r.id = c.id AND r.received_at = c.received_at AND r.payload IS NOT NULL
+      AND uplink_payload(c.format, r.deveui, c.fport, c.fcnt, c.payload_bytes, c.ns_time, c.meta) = c.expected
+""")
+
+STATUS_SQL = text("""
+    SELECT count(*) FILTER (WHERE payload IS NULL), count(*) FILTER (WHERE payload IS NOT NULL),
+           (SELECT pg_size_pretty(sum(pg_total_relation_size(relid))) FROM pg_partition_tree('raw_uplinks'))
+    FROM raw_uplinks
+""")
+
+
+def _json(value):
+    return json.dumps(value) if value is not None else None
+
+
+def apply_schema(conn):
+    with open(INIT_SQL) as f, conn.connection.cursor() as cur:
+        cur.execute(f.read())  # no parameters, so format()'s %s/%L reach Postgres untouched
+
+
+def migrate(engine, batch_size=MIGRATE_BATCH_SIZE, pause=0.0):
+    """Convert rows still stored in payload; returns (converted, left as they are)."""
+    with engine.begin() as conn:
+        apply_schema(conn)
+    last_id = 0
+    converted = kept = 0
+    started = time.monotonic()
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(FETCH_SQL, {"last_id": last_id, "limit": batch_size}).fetchall()
+            if not rows:
+                break
+            packed = [pack(row.deveui, row.payload) for row in rows]
+            done = conn.execute(UPDATE_SQL, {
+                "ids": [row.id for row in rows],
+                "times": [row.received_at for row in rows],
+                "formats": [p[0] for p in packed],
+                "fports": [p[1] for p in packed],
+                "fcnts": [p[2] for p in packed],
+                "payload_bytes": [p[3] for p in packed],
+                "ns_times": [p[4] for p in packed],
+                "metas": [_json(p[5]) for p in packed],
+                "expected": [_json(stored_payload(row.payload)) for row in rows],
+            }).rowcount
+        last_id = rows[-1].id
+        converted += done
+        kept += len(rows) - done
+        elapsed = time.monotonic() - started
+        print(f"[{time.strftime('%H:%M:%S')}] up to id {last_id}: converted {converted}, kept {kept} "
+              f"({(converted + kept) / elapsed if elapsed > 0 else 0:.0f} rows/s)", flush=True)
+        if len(rows) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return converted, kept
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact raw_uplinks storage")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("status", help="rows in compact and in JSON storage, and the table size")
+    migrate_p = sub.add_parser("migrate", help="convert rows still stored as JSON payload")
+    migrate_p.add_argument("--batch-size", type=int, default=MIGRATE_BATCH_SIZE, help="rows per transaction")
+    migrate_p.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    args = parser.parse_args()
+
+    engine = create_engine(INGEST_DB_URL)
+    if args.command == "status":
+        with engine.connect() as conn:
+            compact_rows, json_rows, size = conn.execute(STATUS_SQL).first()
+        print(f"raw_uplinks: {compact_rows} compact rows, {json_rows} JSON rows, {size} on disk")
+    else:
+        converted, kept = migrate(engine, batch_size=args.batch_size, pause=args.pause)
+        print(f"Converted {converted} rows; {kept} left as JSON (payload does not round-trip)")
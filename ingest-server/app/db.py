@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import os
+
+import asyncpg
+
+from app.utils import json_dumps, json_loads
+
+logger = logging.getLogger(__name__)
+
+# Database config from environment variables
+DB_HOST = os.environ.get("POSTGRES_HOST", "localhost")
+DB_PORT = int(os.environ.get("POSTGRES_PORT", "5432"))
+DB_NAME = os.environ.get("POSTGRES_DB", "ingest")
+DB_USER = os.environ.get("POSTGRES_USER", "ingestuser")
+DB_PASS = os.environ.get("POSTGRES_PASSWORD", "ingestpass")
+
+# Pool sizing and health checking
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", "5"))
+DB_POOL_MAX_IDLE = float(os.environ.get("DB_POOL_MAX_IDLE", "300"))
+DB_COMMAND_TIMEOUT = float(os.environ.get("DB_COMMAND_TIMEOUT", "10"))
+DB_HEALTH_INTERVAL = float(os.environ.get("DB_HEALTH_INTERVAL", "5"))
+
+# Idempotent DDL applied once the database is first reachable; app.serve
+# turns it off in the HTTP workers so only the writer process runs it
+DB_APPLY_SCHEMA = os.environ.get("DB_APPLY_SCHEMA", "1") != "0"
+INITDB_DIR = os.environ.get(
+    "INITDB_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "initdb"),
+)
+
+_pool = None
+_healthy = False
+_schema_applied = False
+_health_task = None
+
+
+async def _init_connection(conn):
+    """
+    Decode JSONB columns to Python objects, like psycopg2 did. Uses the
+    binary wire format (a version byte, then the JSON text) with orjson.
+    """
+    await conn.set_type_codec(
+        "jsonb",
+        encoder=lambda value: b"\x01" + json_dumps(value),
+        decoder=lambda data: json_loads(data[1:]),
+        schema="pg_catalog",
+        format="binary",
+    )
+
+
+async def _create_pool():
+    return await asyncpg.create_pool(
+        host=DB_HOST,
+        port=DB_PORT,
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASS,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        max_inactive_connection_lifetime=DB_POOL_MAX_IDLE,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        init=_init_connection,
+    )
+
+
+async def apply_schema(conn):
+    """
+    Run every initdb/*.sql file in name order; they are all idempotent.
+    A failing file is logged and skipped so it can't keep the pool unhealthy.
+    Runs under an advisory lock, so processes starting together take turns
+    instead of deadlocking on the ALTER TABLEs.
+    """
+    if not os.path.isdir(INITDB_DIR):
+        return
+    await conn.execute("SELECT pg_advisory_lock(hashtext('ingest_schema'))")
+    try:
+        for name in sorted(os.listdir(INITDB_DIR)):
+            if name.endswith(".sql"):
+                with open(os.path.join(INITDB_DIR, name)) as f:
+                    sql = f.read()
+                try:
+                    await conn.execute(sql)
+                    logger.info("Applied schema file %s", name)
+                except asyncpg.PostgresError as e:
+                    logger.error("Schema file %s failed: %s", name, e)
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock(hashtext('ingest_schema'))")
+
+
+async def _check():
+    """
+    Run a trivial query through the pool, (re)creating it if needed.
+    On failure every pooled connection is expired so the next acquire
+    reconnects instead of handing out a socket Postgres already closed.
+    """
+    global _pool, _healthy, _schema_applied
+    try:
+        if _pool is None:
+            _pool = await _create_pool()
+            logger.info("Database pool created")
+        async with _pool.acquire() as conn:
+            await conn.fetchval("SELECT 1")
+            if DB_APPLY_SCHEMA and not _schema_applied:
+                await apply_schema(conn)
+                _schema_applied = True
+        if not _healthy:
+            logger.info("Database is reachable")
+        _healthy = True
+    except Exception as e:
+        if _healthy or _pool is None:
+            logger.error("Database health check failed: %s", e)
+        _healthy = False
+        if _pool is not None:
+            await _pool.expire_connections()
+
+
+async def _health_loop():
+    while True:
+        await asyncio.sleep(DB_HEALTH_INTERVAL)
+        await _check()
+
+
+async def init_pool():
+    """Create the pool and start the background health check."""
+    global _health_task
+    await _check()
+    _health_task = asyncio.create_task(_health_loop())
+
+
+async def close_pool():
+    global _pool, _healthy, _health_task
+    if _health_task is not None:
+        _health_task.cancel()
+        try:
+            await _health_task
+        except asyncio.CancelledError:
+            pass
+        _health_task = None
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+    _healthy = False
+
+
+async def connect():
+    """A connection outside the pool, for long streams that must not hold a pooled one."""
+    conn = await asyncpg.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER,
+                                 password=DB_PASS, command_timeout=DB_COMMAND_TIMEOUT)
+    await _init_connection(conn)
+    return conn
+
+
+def get_pool():
+    if _pool is None:
+        raise RuntimeError("Database pool is not available")
+    return _pool
+
+
+def is_healthy() -> bool:
+    return _healthy
+
+
+def pool_stats() -> dict:
+    if _pool is None:
+        return {"size": 0, "idle": 0, "max": DB_POOL_MAX_SIZE}
+    return {
+        "size": _pool.get_size(),
+        "idle": _pool.get_idle_size(),
+        "max": _pool.get_max_size(),
+    }
+
+
+# Errors that say nothing about the rows being written, so the same rows
+# can succeed later. Anything else (bad data, a constraint) fails again.
+TRANSIENT_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.InterfaceError,  # e.g. "connection is closed"
+    asyncpg.PostgresConnectionError,
+    asyncpg.exceptions.OperatorInterventionError,
+    asyncpg.exceptions.InsufficientResourcesError,
+    asyncpg.exceptions.TransactionRollbackError,
+)
+
+
+def is_transient(error: Exception) -> bool:
+    """True if a failed write says more about the database than about its rows."""
+    return isinstance(error, TRANSIENT_ERRORS) or not _healthy
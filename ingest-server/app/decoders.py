@@ -0,0 +1,210 @@
+"""
+Payload decoders for payload_hex, keyed by device profile and FPort.
+
+Each layout is a fixed-size binary record described once and compiled to
+a struct.Struct (and, when NumPy is installed, a structured dtype), with
+per-field linear conversions ((raw & mask) + offset) * scale. decode()
+handles one uplink on the /uplink path; decode_batch() decodes many at
+once, vectorized over one bytes buffer per layout.
+"""
+
+import os
+import struct
+from collections import defaultdict
+
+try:
+    import numpy as np
+except ImportError:  # batch decoding falls back to struct.iter_unpack
+    np = None
+
+
+class Field:
+    def __init__(self, name, code, scale=1, offset=0, mask=None, missing=None, digits=None):
+        self.name = name
+        self.code = code          # struct code: B, H, h, I, ...
+        self.scale = scale
+        self.offset = offset
+        self.mask = mask
+        self.missing = missing    # raw value meaning "not available"
+        self.digits = digits      # round converted values to this many decimals
+
+    def convert(self, raw):
+        if self.missing is not None and raw == self.missing:
+            return None
+        if self.mask is not None:
+            raw = raw & self.mask
+        value = (raw + self.offset) * self.scale
+        if self.digits is not None:
+            value = round(value, self.digits)
+        return value
+
+
+class Layout:
+    """A fixed-size little/big-endian record, compiled once at registration."""
+
+    def __init__(self, name, fields, byteorder="<"):
+        self.name = name
+        self.fields = fields
+        self.struct = struct.Struct(byteorder + "".join(f.code for f in fields))
+        self.size = self.struct.size
+        self.dtype = None
+        if np is not None:
+            self.dtype = np.dtype([
+                (f.name, byteorder + np.dtype(f.code).str[1:]) for f in fields
+            ])
+
+    def decode(self, data: bytes):
+        if len(data) != self.size:
+            return None
+        return {
+            f.name: f.convert(raw) for f, raw in zip(self.fields, self.struct.unpack(data))
+        }
+
+    def decode_many(self, buffer: bytes, count: int):
+        """Decode count back-to-back records from buffer."""
+        if self.dtype is None:
+            return [
+                {f.name: f.convert(raw) for f, raw in zip(self.fields, values)}
+                for values in self.struct.iter_unpack(buffer)
+            ]
+        records = np.frombuffer(buffer, dtype=self.dtype, count=count)
+        columns = []
+        for f in self.fields:
+            raw = records[f.name].astype(np.int64)
+            missing = raw == f.missing if f.missing is not None else None
+            if f.mask is not None:
+                raw = raw & f.mask
+            values = (raw + f.offset) * f.scale
+            if f.digits is not None:
+                values = np.round(values, f.digits)
+            values = values.tolist()
+            if missing is not None:
+                values = [None if m else v for v, m in zip(values, missing.tolist())]
+            columns.append(values)
+        names = [f.name for f in self.fields]
+        return [dict(zip(names, row)) for row in zip(*columns)]
+
+
+# Browan TABS sensors (OUI 58A0CB): status, battery, temperature, humidity,
+# then eCO2 and VOC on the IAQ models (0xFFFF when the sensor has none).
+BROWAN_BATTERY = Field("battery_v", "B", scale=0.1, offset=25, mask=0x0F, digits=1)
+BROWAN_TEMPERATURE = Field("temperature_c", "B", offset=-32, mask=0x7F)
+BROWAN_HUMIDITY = Field("humidity_pct", "B", mask=0x7F)
+
+BROWAN_TEMP_HUMIDITY = Layout("browan_tbhh100", [
+    Field("status", "B"),
+    BROWAN_BATTERY,
+    BROWAN_TEMPERATURE,
+    BROWAN_HUMIDITY,
+])
+
+BROWAN_IAQ = Layout("browan_tbhv110", [
+    Field("status", "B"),
+    BROWAN_BATTERY,
+    BROWAN_TEMPERATURE,
+    BROWAN_HUMIDITY,
+    Field("co2_ppm", "H", missing=0xFFFF),
+    Field("voc_ppb", "H", missing=0xFFFF),
+])
+
+# (profile, fport) -> [layouts]; fport None matches any port.
+# Several layouts per key are told apart by payload length.
+_layouts = defaultdict(list)
+# DevEUI or DevEUI prefix -> profile, longest prefix wins
+_devices = {}
+
+
+def register_layout(profile, layout, fport=None):
+    _layouts[(profile, fport)].append(layout)
+
+
+def register_device(deveui_prefix, profile):
+    _devices[deveui_prefix.upper()] = profile
+
+
+def profile_for(deveui):
+    if not deveui:
+        return None
+    deveui = deveui.upper()
+    for length in range(len(deveui), 0, -1):
+        profile = _devices.get(deveui[:length])
+        if profile is not None:
+            return profile
+    return None
+
+
+def layout_for(deveui, fport, size):
+    profile = profile_for(deveui)
+    if profile is None:
+        return None
+    try:
+        fport = int(fport) if fport not in (None, "") else None
+    except (TypeError, ValueError):
+        fport = None
+    for key in ((profile, fport), (profile, None)):
+        for layout in _layouts.get(key, ()):
+            if layout.size == size:
+                return layout
+    return None
+
+
+def _payload_fields(uplink: dict):
+    """(payload bytes, fport) from a stored uplink dict, or (None, None)."""
+    payload_hex = uplink.get("payload_hex")
+    if not payload_hex:
+        return None, None
+    try:
+        data = bytes.fromhex(payload_hex)
+    except (TypeError, ValueError):
+        return None, None
+    return data, uplink.get("FPort", uplink.get("LrnFPort"))
+
+
+def decode(deveui, uplink: dict):
+    """Decoded values for one stored uplink, or None if no layout applies."""
+    data, fport = _payload_fields(uplink)
+    if data is None:
+        return None
+    layout = layout_for(deveui, fport, len(data))
+    if layout is None:
+        return None
+    values = layout.decode(data)
+    values["decoder"] = layout.name
+    return values
+
+
+def decode_batch(items):
+    """
+    Decode [(deveui, uplink_dict), ...] in one pass per layout.
+    Returns a list aligned with items, None where nothing applies.
+    """
+    results = [None] * len(items)
+    groups = defaultdict(list)
+    for index, (deveui, uplink) in enumerate(items):
+        data, fport = _payload_fields(uplink or {})
+        if data is None:
+            continue
+        layout = layout_for(deveui, fport, len(data))
+        if layout is not None:
+            groups[layout].append((index, data))
+
+    for layout, members in groups.items():
+        decoded = layout.decode_many(b"".join(data for _, data in members), len(members))
+        for (index, _), values in zip(members, decoded):
+            values["decoder"] = layout.name
+            results[index] = values
+    return results
+
+
+def _load_device_map(spec):
+    """DECODER_DEVICES="58A0CB=browan,0004A30B=other" adds prefix mappings."""
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        prefix, _, profile = entry.partition("=")
+        if prefix and profile:
+            register_device(prefix.strip(), profile.strip())
+
+
+register_layout("browan", BROWAN_TEMP_HUMIDITY)
+register_layout("browan", BROWAN_IAQ)
+register_device("58A0CB", "browan")
+_load_device_map(os.environ.get("DECODER_DEVICES", ""))
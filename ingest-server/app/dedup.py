@@ -0,0 +1,88 @@
+"""
+Duplicate uplink suppression.
+
+The same LoRaWAN frame reaches /uplink once per gateway that heard it, and
+again when the network server retries after a timeout. Each frame gets a
+key: its uplink counter (FCntUp) when the network server sends one,
+otherwise a short hash of the fields that identify the frame
+(payload, port, network time). The per-gateway radio metadata is left out.
+Without FCntUp or a network server Time there is nothing to tell two
+frames with the same payload apart, so such uplinks get no key and are
+never deduplicated.
+
+RecentFrames remembers keys seen within DEDUP_WINDOW_SECONDS, so copies
+are answered without touching the database. The unique index on
+raw_uplinks (deveui, frame_key, received_at) catches what the in-memory
+index can't, such as copies arriving after a restart.
+"""
+
+import hashlib
+import os
+import time
+from collections import OrderedDict
+
+DEDUP_WINDOW_SECONDS = float(os.environ.get("DEDUP_WINDOW_SECONDS", "300"))
+DEDUP_MAX_ENTRIES = int(os.environ.get("DEDUP_MAX_ENTRIES", "100000"))
+
+# fields that are the same in every copy of a frame, whichever gateway sent it
+FRAME_FIELDS = ("payload_hex", "FPort", "LrnFPort", "Time", "LrnInfos")
+
+
+def frame_key(uplink: dict):
+    """Key identifying the frame, or None if the uplink carries nothing to tell frames apart."""
+    fcnt = uplink.get("FCntUp")
+    if fcnt not in (None, ""):
+        return f"fcnt:{fcnt}"
+    # a periodic sensor repeats its payload, so without the frame's time it is not a key
+    if uplink.get("Time") in (None, ""):
+        return None
+    values = [str(uplink.get(name) or "") for name in FRAME_FIELDS]
+    identity = "|".join(values)
+    return "hash:" + hashlib.blake2b(identity.encode(), digest_size=8).hexdigest()
+
+
+class RecentFrames:
+    """
+    Bounded LRU of (deveui, frame_key) -> first-seen time. A key is recorded
+    by the first check; call forget() if that copy could not be stored, so
+    the next copy is taken instead of being dropped.
+    """
+
+    def __init__(self, window=DEDUP_WINDOW_SECONDS, max_entries=DEDUP_MAX_ENTRIES):
+        self.window = window
+        self.max_entries = max_entries
+        self._frames = OrderedDict()
+        self.suppressed = 0
+        self.db_duplicates = 0
+
+    def seen(self, deveui: str, key: str) -> bool:
+        """True if this frame was already taken within the window; records it otherwise."""
+        now = time.monotonic()
+        self._expire(now)
+        frame = (deveui, key)
+        if frame in self._frames:
+            self.suppressed += 1
+            return True
+        self._frames[frame] = now
+        if len(self._frames) > self.max_entries:
+            self._frames.popitem(last=False)
+        return False
+
+    def forget(self, deveui: str, key: str):
+        self._frames.pop((deveui, key), None)
+
+    def _expire(self, now):
+        cutoff = now - self.window
+        frames = self._frames
+        while frames:
+            frame, first_seen = next(iter(frames.items()))
+            if first_seen > cutoff:
+                break
+            frames.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "tracked": len(self._frames),
+            "suppressed": self.suppressed,
+            "db_duplicates": self.db_duplicates,
+        }
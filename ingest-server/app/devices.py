@@ -0,0 +1,173 @@
+"""
+devices.py
+
+Latest state per DevEUI: first/last seen, uplink count, last FPort, and the
+last payload and decoded values.
+
+insert_rows() upserts device_state in the same transaction as each
+raw_uplinks batch, one row per device in the batch. The upsert returns the
+resulting rows, and DeviceStates keeps them in memory for GET /devices. A
+row is only replaced by one that is newer, so late or replayed uplinks still
+count but don't roll last_seen back. The store also reloads the whole table
+every DEVICE_STATE_REFRESH seconds (app/store.py), which picks up what
+rebuild and the importer write.
+
+    python -m app.devices rebuild    # recompute device_state from raw_uplinks
+"""
+
+import argparse
+import os
+
+from sqlalchemy import create_engine, text
+
+from app import compact, db
+from app.checkpoints import INGEST_DB_URL
+
+SCHEMA_SQL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "initdb", "init_device_state.sql")
+
+STATE_COLUMNS = (
+    "deveui", "first_seen", "last_seen", "last_uplink_id", "last_fport",
+    "last_payload", "last_decoded", "uplink_count",
+)
+SUMMARY_COLUMNS = tuple(c for c in STATE_COLUMNS if c != "last_payload")
+
+_latest = "CASE WHEN EXCLUDED.last_seen >= d.last_seen THEN EXCLUDED.{0} ELSE d.{0} END"
+
+UPSERT_TEMPLATE = f"""
+    INSERT INTO device_state AS d ({", ".join(STATE_COLUMNS)})
+    {{source}}
+    ON CONFLICT (deveui) DO UPDATE SET
+        first_seen = least(d.first_seen, EXCLUDED.first_seen),
+        last_seen = greatest(d.last_seen, EXCLUDED.last_seen),
+        last_uplink_id = {_latest.format("last_uplink_id")},
+        last_fport = {_latest.format("last_fport")},
+        last_payload = {_latest.format("last_payload")},
+        last_decoded = {_latest.format("last_decoded")},
+        uplink_count = d.uplink_count + EXCLUDED.uplink_count,
+        updated_at = now()
+"""
+
+# one batch from insert_rows(), already reduced to a row per device
+UPSERT_SQL = UPSERT_TEMPLATE.format(source="""
+    SELECT * FROM unnest($1::text[], $2::timestamptz[], $3::timestamptz[], $4::bigint[],
+                         $5::int[], $6::jsonb[], $7::jsonb[], $8::bigint[])
+""") + f"RETURNING {', '.join(STATE_COLUMNS)}"
+
+FPORT_SQL = "coalesce(payload->>'FPort', payload->>'LrnFPort')"
+
+
+def state_from(relation: str) -> str:
+    """SELECT reducing any (id, deveui, received_at, payload, decoded) relation to one state row per device."""
+    return f"""
+    SELECT DISTINCT ON (deveui)
+        deveui,
+        min(received_at) OVER w,
+        received_at,
+        id,
+        CASE WHEN {FPORT_SQL} ~ '^[0-9]{{1,9}}$' THEN ({FPORT_SQL})::int END,
+        payload,
+        decoded,
+        count(*) OVER w
+    FROM {relation}
+    WINDOW w AS (PARTITION BY deveui)
+    ORDER BY deveui, received_at DESC, id DESC
+"""
+
+
+LOAD_SQL = f"SELECT {', '.join(STATE_COLUMNS)} FROM device_state"
+
+
+def uplink_fport(payload: dict):
+    """FPort as device_state's int column takes it, or None if missing or out of range."""
+    return compact._int(payload.get("FPort", payload.get("LrnFPort")), compact.INT4_MAX)
+
+
+async def upsert(conn, rows, ids):
+    """
+    Fold the inserted rows of one batch into device_state on conn, inside
+    the caller's transaction. Returns the resulting device_state rows.
+    """
+    latest = {}
+    for row_id, (deveui, received_at, payload, decoded, _) in zip(ids, rows):
+        if row_id is None:
+            continue
+        state = latest.get(deveui)
+        if state is None:
+            latest[deveui] = [received_at, received_at, row_id, payload, decoded, 1]
+            continue
+        state[0] = min(state[0], received_at)
+        state[5] += 1
+        if (received_at, row_id) > (state[1], state[2]):
+            state[1:5] = [received_at, row_id, payload, decoded]
+    if not latest:
+        return []
+    # sorted, so concurrent batches (writer, spool replay) lock devices in the same order
+    deveuis = sorted(latest)
+    states = [latest[d] for d in deveuis]
+    return await conn.fetch(
+        UPSERT_SQL,
+        deveuis,
+        [s[0] for s in states],
+        [s[1] for s in states],
+        [s[2] for s in states],
+        [uplink_fport(s[3]) for s in states],
+        [compact.stored_payload(s[3]) for s in states],
+        [s[4] for s in states],
+        [s[5] for s in states],
+    )
+
+
+class DeviceStates:
+    """In-process copy of device_state, loaded from the table and patched from each batch's upsert."""
+
+    def __init__(self):
+        self.states = {}
+        self.loaded = False
+
+    def update(self, records):
+        for record in records:
+            state = dict(record)
+            current = self.states.get(state["deveui"])
+            # a load racing a batch must not roll the newer state back
+            if current is None or ((state["last_seen"], state["last_uplink_id"])
+                                   >= (current["last_seen"], current["last_uplink_id"])):
+                self.states[state["deveui"]] = state
+
+    async def load(self):
+        async with db.get_pool().acquire() as conn:
+            records = await conn.fetch(LOAD_SQL)
+        self.update(records)
+        self.loaded = True
+
+    async def ensure_loaded(self):
+        if not self.loaded:
+            await self.load()
+
+    def summaries(self) -> list:
+        return [{c: self.states[d][c] for c in SUMMARY_COLUMNS} for d in sorted(self.states)]
+
+    def get(self, deveui: str):
+        return self.states.get(deveui)
+
+    def stats(self) -> dict:
+        return {"tracked": len(self.states), "loaded": self.loaded}
+
+
+def rebuild(conn):
+    """Recompute device_state from raw_uplinks (one full scan of raw_uplinks_json)."""
+    with open(SCHEMA_SQL) as f:
+        conn.exec_driver_sql(f.read())
+    conn.execute(text("TRUNCATE device_state"))
+    count = conn.execute(text(UPSERT_TEMPLATE.format(source=state_from("raw_uplinks_json")))).rowcount
+    print(f"Rebuilt device_state: {count} devices")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the device_state table")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("rebuild", help="recompute device_state from raw_uplinks")
+    args = parser.parse_args()
+
+    engine = create_engine(INGEST_DB_URL)
+    with engine.begin() as conn:
+        rebuild(conn)
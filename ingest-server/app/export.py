@@ -0,0 +1,331 @@
+"""
+export.py
+
+Bulk export of raw_uplinks (ingest DB) or devices.uplinks (device DB).
+
+    python -m app.export --output raw_uplinks.csv.gz [--since 2025-06-01] [--until ...]
+    python -m app.export --table device_uplinks --output uplinks.csv.zst --resume
+    python -m app.export --output june.parquet --since 2025-06-01 --until 2025-07-01
+
+Rows are pulled with COPY ... TO STDOUT, one id range (--chunk-ids) at a
+time, so memory stays flat and no single statement holds a snapshot for
+the whole history. CSV goes out as it streams, compressed by the output
+extension (.gz, or .zst when zstandard is installed). Each chunk is a
+complete gzip member or zstd frame. After every chunk, <output>.state
+records the last id and the file size, and --resume truncates to that
+size and carries on after that id. Parquet (needs pyarrow) writes one row
+group per chunk, with the payload flattened into typed columns and one
+column per decoder field.
+
+GET /export/raw_uplinks streams the same CSV (gzip or plain) over a
+connection of its own, so a slow download never holds one of the pool's.
+zstandard and pyarrow are not in requirements.txt; .zst and .parquet
+output is for installs that add them, and is refused up front otherwise.
+"""
+
+import argparse
+import asyncio
+import csv
+import gzip
+import io
+import json
+import os
+import zlib
+from datetime import datetime
+
+from sqlalchemy import create_engine, inspect
+
+from app import decoders
+from app.checkpoints import DEVICE_DB_URL, INGEST_DB_URL
+from app.utils import json_loads
+
+try:
+    import zstandard
+except ImportError:  # .zst output unavailable
+    zstandard = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet output unavailable
+    pa = pq = None
+
+EXPORT_CHUNK_IDS = int(os.environ.get("EXPORT_CHUNK_IDS", "50000"))
+
+TABLES = {
+    "raw_uplinks": ("raw_uplinks_json", INGEST_DB_URL),  # payload rebuilt for compact rows
+    "device_uplinks": ("devices.uplinks", DEVICE_DB_URL),
+}
+COLUMNS = ("id", "deveui", "received_at", "payload", "decoded")
+CSV_HEADER = (",".join(COLUMNS) + "\n").encode()
+
+# (column, payload keys tried in order, type) flattened out of the stored JSON
+PAYLOAD_COLUMNS = (
+    ("ns_time", ("Time",), str),
+    ("fport", ("FPort", "LrnFPort"), int),
+    ("fcnt", ("FCntUp",), int),
+    ("payload_hex", ("payload_hex",), str),
+    ("rssi", ("LrrRSSI",), float),
+    ("snr", ("LrrSNR",), float),
+)
+
+
+def _where(where, params, since, until, deveui, placeholder):
+    for clause, value in (("received_at >= {}", since), ("received_at < {}", until), ("deveui = {}", deveui)):
+        if value is not None:
+            where.append(clause)
+            params.append(value)
+    marks = [f"${i}" if placeholder == "$" else "%s" for i in range(1, len(params) + 1)]
+    return " AND ".join(c.format(m) for c, m in zip(where, marks)) or "true"
+
+
+def export_query(table, columns, after_id, upper_id, since=None, until=None, deveui=None,
+                 placeholder="%s"):
+    """
+    (sql, params) selecting one id range in id order. placeholder is "%s"
+    for psycopg2 or "$" for asyncpg's numbered parameters.
+    """
+    params = [after_id, upper_id]
+    conditions = _where(["id > {}", "id <= {}"], params, since, until, deveui, placeholder)
+    select_columns = ", ".join(c if c in columns else f"NULL AS {c}" for c in COLUMNS)
+    return f"SELECT {select_columns} FROM {table} WHERE {conditions} ORDER BY id", params
+
+
+def bounds_query(table, since=None, until=None, deveui=None, placeholder="%s"):
+    """(sql, params) for the (first id - 1, last id) of the rows to export."""
+    params = []
+    conditions = _where([], params, since, until, deveui, placeholder)
+    return f"SELECT coalesce(min(id) - 1, 0), coalesce(max(id), 0) FROM {table} WHERE {conditions}", params
+
+
+# ---- file outputs (CLI) ----
+
+def compression_for(path, compress="auto"):
+    if compress != "auto":
+        return None if compress == "none" else compress
+    if path.endswith(".gz"):
+        return "gzip"
+    if path.endswith(".zst"):
+        return "zstd"
+    return None
+
+
+def open_chunk(path, compression):
+    """Append handle for one chunk; closing it ends the gzip member / zstd frame."""
+    if compression == "gzip":
+        return gzip.open(path, "ab")
+    if compression == "zstd":
+        if zstandard is None:
+            raise SystemExit("zstd output needs the zstandard package")
+        return zstandard.ZstdCompressor().stream_writer(open(path, "ab"), closefd=True)
+    return open(path, "ab")
+
+
+def load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_state(path, last_id, size):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"last_id": last_id, "bytes": size}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def decoded_fields():
+    """Every field any registered layout can produce, for a fixed Parquet schema."""
+    names = []
+    for layouts in decoders._layouts.values():
+        for layout in layouts:
+            names.extend(f.name for f in layout.fields if f.name not in names)
+    return names
+
+
+def parquet_schema(fields):
+    columns = [
+        ("id", pa.int64()),
+        ("deveui", pa.string()),
+        ("received_at", pa.timestamp("us", tz="UTC")),
+    ]
+    kinds = {str: pa.string(), int: pa.int64(), float: pa.float64()}
+    columns += [(name, kinds[kind]) for name, _, kind in PAYLOAD_COLUMNS]
+    columns += [("decoder", pa.string())] + [(f"decoded_{name}", pa.float64()) for name in fields]
+    columns += [("payload", pa.string())]
+    return pa.schema(columns)
+
+
+def _typed(value, kind):
+    if value in (None, ""):
+        return None
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parquet_table(csv_bytes, schema, fields):
+    """Flatten one COPY chunk (CSV) into a pyarrow table."""
+    columns = {name: [] for name in schema.names}
+    for row in csv.reader(io.StringIO(csv_bytes.decode())):
+        row_id, deveui, received_at, payload_text, decoded_text = row
+        payload = json_loads(payload_text) if payload_text else {}
+        decoded = json_loads(decoded_text) if decoded_text else {}
+        columns["id"].append(int(row_id))
+        columns["deveui"].append(deveui)
+        columns["received_at"].append(datetime.fromisoformat(received_at))
+        for name, keys, kind in PAYLOAD_COLUMNS:
+            value = next((payload[k] for k in keys if payload.get(k) not in (None, "")), None)
+            columns[name].append(_typed(value, kind))
+        columns["decoder"].append(decoded.get("decoder"))
+        for name in fields:
+            columns[f"decoded_{name}"].append(_typed(decoded.get(name), float))
+        columns["payload"].append(payload_text)
+    return pa.table(columns, schema=schema)
+
+
+def export_file(table="raw_uplinks", output="raw_uplinks.csv.gz", fmt=None, compress="auto",
+                since=None, until=None, deveui=None, after_id=0, resume=False,
+                chunk_ids=EXPORT_CHUNK_IDS):
+    table_name, url = TABLES[table]
+    fmt = fmt or ("parquet" if output.endswith(".parquet") else "csv")
+    compression = compression_for(output, compress)
+    state_path = output + ".state"
+    # before anything is touched: neither package is in requirements.txt
+    if fmt == "parquet" and pa is None:
+        raise SystemExit("Parquet output needs the pyarrow package (pip install pyarrow)")
+    if fmt == "csv" and compression == "zstd" and zstandard is None:
+        raise SystemExit("zstd output needs the zstandard package (pip install zstandard)")
+
+    if resume:
+        state = load_state(state_path)
+        if state is None:
+            raise SystemExit(f"Nothing to resume: {state_path} not found")
+        if fmt == "parquet":
+            raise SystemExit("Parquet files can't be appended to; export the rest to a new "
+                             f"--output with --after-id {state['last_id']}")
+        with open(output, "ab") as f:
+            f.truncate(state["bytes"])  # drop a chunk that was cut off mid-write
+        after_id = state["last_id"]
+    elif os.path.exists(output):
+        os.remove(output)
+
+    engine = create_engine(url)
+    columns = {c["name"] for c in inspect(engine).get_columns(*reversed(table_name.split(".")))}
+    exported = 0
+    with engine.connect() as sa_conn:
+        with sa_conn.connection.cursor() as cur:
+            cur.execute("SET TIME ZONE 'UTC'")
+            cur.execute(*bounds_query(table_name, since, until, deveui))
+            first, upper_bound = cur.fetchone()
+            after_id = max(after_id, first)
+
+            writer = None
+            if fmt == "parquet":
+                fields = decoded_fields()
+                schema = parquet_schema(fields)
+                writer = pq.ParquetWriter(output, schema, compression="zstd")
+            elif not resume:
+                with open_chunk(output, compression) as f:
+                    f.write(CSV_HEADER)
+                save_state(state_path, after_id, os.path.getsize(output))
+
+            try:
+                while after_id < upper_bound:
+                    upper = min(after_id + chunk_ids, upper_bound)
+                    sql, params = export_query(table_name, columns, after_id, upper, since, until, deveui)
+                    copy = cur.mogrify(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv)", params).decode()
+                    if writer is not None:
+                        buffer = io.BytesIO()
+                        cur.copy_expert(copy, buffer)
+                        chunk = parquet_table(buffer.getvalue(), schema, fields)
+                        if chunk.num_rows:
+                            writer.write_table(chunk)
+                        exported += chunk.num_rows
+                    else:
+                        with open_chunk(output, compression) as f:
+                            cur.copy_expert(copy, f)
+                        exported += cur.rowcount
+                        save_state(state_path, upper, os.path.getsize(output))
+                    after_id = upper
+                    print(f"Exported up to id {after_id} of {upper_bound} ({exported} rows)", flush=True)
+            finally:
+                if writer is not None:
+                    writer.close()
+                    save_state(state_path, after_id, os.path.getsize(output))
+    return exported
+
+
+# ---- HTTP streaming (app) ----
+
+async def stream_csv(connect, after_id=0, since=None, until=None, deveui=None, gzip_output=False,
+                     chunk_ids=EXPORT_CHUNK_IDS):
+    """
+    Yield raw_uplinks as CSV (optionally gzip) bytes, one COPY per id range,
+    over a connection from connect() that is closed when the stream ends.
+    """
+    compressor = zlib.compressobj(wbits=31) if gzip_output else None
+
+    def out(data):
+        return compressor.compress(data) if compressor else data
+
+    yield out(CSV_HEADER)
+    conn = await connect()
+    try:
+        sql, params = bounds_query("raw_uplinks_json", since, until, deveui, placeholder="$")
+        first, upper_bound = await conn.fetchrow(sql, *params)
+        after_id = max(after_id, first)
+        await conn.execute("SET TIME ZONE 'UTC'")
+        while after_id < upper_bound:
+            upper = min(after_id + chunk_ids, upper_bound)
+            sql, params = export_query("raw_uplinks_json", COLUMNS, after_id, upper, since, until,
+                                       deveui, placeholder="$")
+            chunks = asyncio.Queue(maxsize=16)
+
+            async def sink(data):
+                await chunks.put(bytes(data))
+
+            async def run_copy():
+                try:
+                    await conn.copy_from_query(sql, *params, output=sink, format="csv")
+                finally:
+                    await chunks.put(None)
+
+            copy = asyncio.create_task(run_copy())
+            try:
+                while (data := await chunks.get()) is not None:
+                    yield out(data)
+                await copy
+            finally:
+                copy.cancel()
+            after_id = upper
+    finally:
+        await conn.close()
+    if compressor:
+        yield compressor.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export uplinks to compressed CSV or Parquet")
+    parser.add_argument("--table", choices=sorted(TABLES), default="raw_uplinks")
+    parser.add_argument("--output", required=True, help=".csv, .csv.gz, .csv.zst or .parquet")
+    parser.add_argument("--format", choices=["csv", "parquet"], default=None, help="default: from --output")
+    parser.add_argument("--compress", choices=["auto", "none", "gzip", "zstd"], default="auto")
+    parser.add_argument("--since", type=datetime.fromisoformat, default=None, help="received_at >= this")
+    parser.add_argument("--until", type=datetime.fromisoformat, default=None, help="received_at < this")
+    parser.add_argument("--deveui", default=None)
+    parser.add_argument("--after-id", type=int, default=0, help="start after this id")
+    parser.add_argument("--resume", action="store_true", help="continue from <output>.state")
+    parser.add_argument("--chunk-ids", type=int, default=EXPORT_CHUNK_IDS, help="ids per COPY")
+    args = parser.parse_args()
+    rows = export_file(
+        table=args.table, output=args.output, fmt=args.format, compress=args.compress,
+        since=args.since, until=args.until, deveui=args.deveui, after_id=args.after_id,
+        resume=args.resume, chunk_ids=args.chunk_ids,
+    )
+    print(f"Exported {rows} rows to {args.output}")
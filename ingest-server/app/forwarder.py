@@ -1,25 +1,83 @@
 import os
+import time
 import httpx
 import logging
 
+from app import metrics
+
 DEVICE_MANAGER_URL = os.getenv("DEVICE_MANAGER_URL", "http://device-manager:9000/process-uplink")
 DEVICE_MANAGER_API_KEY = os.getenv("DEVICE_MANAGER_API_KEY", "supersecrettoken123")
+DEVICE_MANAGER_TIMEOUT = float(os.getenv("DEVICE_MANAGER_TIMEOUT", "5.0"))
+DEVICE_MANAGER_MAX_CONNECTIONS = int(os.getenv("DEVICE_MANAGER_MAX_CONNECTIONS", "10"))
+
+logger = logging.getLogger(__name__)
+
+
+def build_forward_payload(uplink_data: dict) -> dict:
+    """
+    Build the body the device manager expects from a stored uplink:
+    DevEUI and Time, optional LrnFPort / payload_hex, plus the raw uplink.
+    """
+    payload = {
+        "DevEUI": uplink_data.get("DevEUI"),
+        "Time": uplink_data.get("Time")
+    }
+
+    # Add optional fields if present
+    if uplink_data.get("LrnFPort"):
+        payload["LrnFPort"] = uplink_data.get("LrnFPort")
+    if uplink_data.get("payload_hex"):
+        payload["payload_hex"] = uplink_data.get("payload_hex")
+
+    # Include raw payload for device manager processing
+    payload["raw_payload"] = uplink_data
+    return payload
+
+
+def create_client() -> httpx.AsyncClient:
+    """
+    One keep-alive client to share between forwards, so each uplink
+    reuses an open connection instead of a new TCP/TLS handshake.
+    """
+    return httpx.AsyncClient(
+        timeout=DEVICE_MANAGER_TIMEOUT,
+        headers={"x-api-key": DEVICE_MANAGER_API_KEY},
+        limits=httpx.Limits(
+            max_connections=DEVICE_MANAGER_MAX_CONNECTIONS,
+            max_keepalive_connections=DEVICE_MANAGER_MAX_CONNECTIONS,
+        ),
+    )
+
+
+async def post_uplink(client: httpx.AsyncClient, data: dict):
+    """POST one forward payload, raising on transport errors and non-2xx replies."""
+    started = time.perf_counter()
+    try:
+        response = await client.post(DEVICE_MANAGER_URL, json=data)
+        response.raise_for_status()
+    except Exception:
+        metrics.FORWARD_FAILED.inc()
+        raise
+    finally:
+        metrics.FORWARD_SECONDS.observe(time.perf_counter() - started)
+    metrics.FORWARDED.inc()
+    return response
+
 
-async def forward_uplink_to_device_manager(data: dict) -> bool:
+async def forward_uplink_to_device_manager(data: dict, client: httpx.AsyncClient = None) -> bool:
     """
     Forward a JSON uplink payload to the device-manager service.
     Returns True if forwarding succeeds, False otherwise.
+    Pass a shared client from create_client() to reuse connections.
     """
     try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.post(
-                DEVICE_MANAGER_URL,
-                headers={"x-api-key": DEVICE_MANAGER_API_KEY},
-                json=data
-            )
-            response.raise_for_status()
-            logging.info(f"Successfully forwarded uplink for device {data.get('deveui')}")
-            return True
+        if client is None:
+            async with create_client() as own_client:
+                await post_uplink(own_client, data)
+        else:
+            await post_uplink(client, data)
+        logger.info("Successfully forwarded uplink for device %s", data.get("DevEUI"))
+        return True
     except Exception as e:
-        logging.warning(f"Failed to forward uplink for {data.get('deveui')}: {e}")
+        logger.warning("Failed to forward uplink for %s: %s", data.get("DevEUI"), e)
         return False
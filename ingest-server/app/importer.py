@@ -0,0 +1,263 @@
+"""
+importer.py
+
+Bulk load of historical uplinks into raw_uplinks.
+
+    python -m app.importer raw_uplinks_2025-06-11_1043.csv
+    python -m app.importer site-a.ndjson.gz site-b.csv --workers 4 --rejects rejects.ndjson
+
+Reads CSV in the raw_uplinks export format (deveui, received_at, payload
+and optionally decoded; other columns such as id are ignored) or NDJSON.
+An NDJSON line is either a row of that shape or an uplink callback body
+({"DevEUI_uplink": {...}} or the bare uplink). Files ending in .gz are
+read compressed.
+
+Rows are parsed in chunks across a process pool (--workers; 0 parses
+inline). Each row is checked and normalized: DevEUI upper-cased and
+checked to be 16 hex digits, received_at parsed with the shared timestamp
+parser, payload required to be a JSON object. The frame key and decoded
+values are computed the same way as at ingest. Good rows are COPYed into
+a temporary staging table. Every --batch-rows they are merged into
+raw_uplinks in one transaction. A row is skipped if the same
+(deveui, received_at, payload) is already stored, tokens aside, or if the
+frame is already stored under its frame key. Re-running an import is
+therefore harmless. Rows are stored in the compact format (app/compact.py), and
+device_state is updated in the same statement. Imported rows get new ids.
+consumer.py picks them up once the batch commits; live rows written while
+a batch is open wait until then, as it only reads settled rows
+(app/checkpoints.py). Imported rows get no forward_outbox entry; send them
+to the device manager with a forward_cron.py backfill if it needs them.
+"""
+
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import create_engine
+
+from app import compact, decoders, dedup, devices
+from app.checkpoints import INGEST_DB_URL
+from app.utils import json_dumps, json_loads, parse_timestamp
+
+IMPORT_CHUNK_ROWS = int(os.environ.get("IMPORT_CHUNK_ROWS", "5000"))  # rows per parse task
+IMPORT_BATCH_ROWS = int(os.environ.get("IMPORT_BATCH_ROWS", "100000"))  # rows per transaction
+
+DEVEUI_RE = re.compile(r"^[0-9A-F]{16}$")
+
+csv.field_size_limit(sys.maxsize)
+
+# payload is the stored form (no tokens), kept only to compare against raw_uplinks_json
+STAGING_COLUMNS = (
+    "deveui", "received_at", "payload", "format", "fport", "fcnt", "payload_bytes", "ns_time", "meta",
+    "decoded", "frame_key",
+)
+STORED_COLUMNS = tuple(c for c in STAGING_COLUMNS if c != "payload")
+
+STAGING_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS import_staging (
+        deveui TEXT, received_at TIMESTAMPTZ, payload JSONB, format SMALLINT, fport INTEGER,
+        fcnt BIGINT, payload_bytes BYTEA, ns_time TIMESTAMPTZ, meta JSONB, decoded JSONB, frame_key TEXT
+    ) ON COMMIT DELETE ROWS
+"""
+
+COPY_SQL = f"COPY import_staging ({', '.join(STAGING_COLUMNS)}) FROM STDIN WITH (FORMAT csv)"
+
+MERGE_SQL = f"""
+    WITH inserted AS (
+        INSERT INTO raw_uplinks ({", ".join(STORED_COLUMNS)})
+        SELECT DISTINCT ON (s.deveui, s.received_at, s.payload)
+               {", ".join("s." + c for c in STORED_COLUMNS)}
+        FROM import_staging s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM raw_uplinks_json r
+            WHERE r.deveui = s.deveui AND r.received_at = s.received_at
+              AND uplink_without_tokens(r.payload) = s.payload
+        )
+        ON CONFLICT (deveui, frame_key, received_at) DO NOTHING
+        RETURNING id, deveui, received_at,
+                  uplink_payload(format, deveui, fport, fcnt, payload_bytes, ns_time, meta) AS payload, decoded
+    ), state AS (
+        {devices.UPSERT_TEMPLATE.format(source=devices.state_from("inserted"))}
+    )
+    SELECT count(*) FROM inserted
+"""
+
+
+def normalize(record: dict):
+    """(deveui, received_at, payload, decoded, frame_key) for one input record; raises ValueError."""
+    if "payload" in record:
+        payload = record["payload"]
+        if isinstance(payload, str):
+            payload = json_loads(payload)
+        deveui = record.get("deveui")
+        timestamp = record.get("received_at")
+        decoded = record.get("decoded")
+        if isinstance(decoded, str):
+            decoded = json_loads(decoded) if decoded else None
+    else:
+        payload = record.get("DevEUI_uplink", record)
+        deveui = timestamp = decoded = None
+    if not isinstance(payload, dict):
+        raise ValueError("payload is not a JSON object")
+
+    deveui = (deveui or payload.get("DevEUI") or "").strip().upper()
+    if not DEVEUI_RE.match(deveui):
+        raise ValueError(f"invalid DevEUI {deveui!r}")
+    timestamp = timestamp or payload.get("Time")
+    if not timestamp:
+        raise ValueError("no received_at or Time")
+    received_at = parse_timestamp(timestamp)
+    if decoded is None:
+        decoded = decoders.decode(deveui, payload)
+    return deveui, received_at, payload, decoded, dedup.frame_key(payload)
+
+
+def parse_chunk(chunk):
+    """
+    Parse one chunk of (line number, record) in a worker. Returns
+    (CSV text for COPY, rows, [(line number, error), ...]).
+    """
+    buffer = io.StringIO()
+    out = csv.writer(buffer)
+    rejects = []
+    rows = 0
+    for line_no, record in chunk:
+        try:
+            if isinstance(record, str):
+                record = json_loads(record)
+                if not isinstance(record, dict):
+                    raise ValueError("line is not a JSON object")
+            deveui, received_at, payload, decoded, key = normalize(record)
+        except (ValueError, TypeError) as e:
+            rejects.append((line_no, str(e)))
+            continue
+        fmt, fport, fcnt, payload_bytes, ns_time, meta = compact.pack(deveui, payload)
+        out.writerow((
+            deveui,
+            received_at.isoformat(),
+            json_dumps(compact.stored_payload(payload)).decode(),
+            fmt,
+            fport,
+            fcnt,
+            "\\x" + payload_bytes.hex() if payload_bytes is not None else None,
+            ns_time.isoformat() if ns_time is not None else None,
+            json_dumps(meta).decode() if meta is not None else None,
+            json_dumps(decoded).decode() if decoded is not None else None,
+            key,
+        ))
+        rows += 1
+    return buffer.getvalue(), rows, rejects
+
+
+def open_text(path):
+    return gzip.open(path, "rt", newline="") if path.endswith(".gz") else open(path, newline="")
+
+
+def read_records(path):
+    """(line number, record) from a CSV or NDJSON file; NDJSON lines are parsed in the workers."""
+    ndjson = ".ndjson" in path or ".jsonl" in path
+    with open_text(path) as f:
+        if ndjson:
+            for line_no, line in enumerate(f, 1):
+                if line.strip():
+                    yield line_no, line
+        else:
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, record
+
+
+def chunked(records, size):
+    chunk = []
+    for item in records:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def parsed_chunks(chunks, workers):
+    """parse_chunk over chunks in order, keeping at most 2 x workers chunks in flight."""
+    if workers <= 0:
+        yield from map(parse_chunk, chunks)
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(parse_chunk, chunk))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def import_files(paths, workers=None, batch_rows=IMPORT_BATCH_ROWS, chunk_rows=IMPORT_CHUNK_ROWS,
+                 rejects_path=None, db_url=INGEST_DB_URL):
+    """Load every file; returns (rows read, inserted, skipped as existing, rejected)."""
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    engine = create_engine(db_url)
+    read = inserted = rejected = 0
+    started = time.monotonic()
+    rejects_file = open(rejects_path, "w") if rejects_path else None
+    try:
+        with engine.connect() as sa_conn:
+            dbapi_conn = sa_conn.connection
+            with dbapi_conn.cursor() as cur:
+                cur.execute(STAGING_SQL)
+                dbapi_conn.commit()
+                staged = 0
+
+                def merge():
+                    nonlocal inserted, staged
+                    cur.execute(MERGE_SQL)
+                    inserted += cur.fetchone()[0]
+                    dbapi_conn.commit()
+                    staged = 0
+                    elapsed = time.monotonic() - started
+                    print(f"[{time.strftime('%H:%M:%S')}] read {read}, inserted {inserted}, "
+                          f"rejected {rejected} ({read / elapsed if elapsed > 0 else 0:.0f} rows/s)", flush=True)
+
+                for path in paths:
+                    chunks = chunked(read_records(path), chunk_rows)
+                    for text, rows, rejects in parsed_chunks(chunks, workers):
+                        read += rows + len(rejects)
+                        rejected += len(rejects)
+                        for line_no, error in rejects:
+                            if rejects_file is not None:
+                                rejects_file.write(json.dumps({"file": path, "line": line_no, "error": error}) + "\n")
+                        if rows:
+                            cur.copy_expert(COPY_SQL, io.StringIO(text))
+                            staged += rows
+                        if staged >= batch_rows:
+                            merge()
+                if staged:
+                    merge()
+    finally:
+        if rejects_file is not None:
+            rejects_file.close()
+    return read, inserted, read - rejected - inserted, rejected
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import raw_uplinks CSV / NDJSON dumps with COPY")
+    parser.add_argument("files", nargs="+", help=".csv, .ndjson or .jsonl, optionally .gz")
+    parser.add_argument("--workers", type=int, default=None, help="parsing processes (default: one per core, 0: inline)")
+    parser.add_argument("--batch-rows", type=int, default=IMPORT_BATCH_ROWS, help="rows per transaction")
+    parser.add_argument("--chunk-rows", type=int, default=IMPORT_CHUNK_ROWS, help="rows per parse task")
+    parser.add_argument("--rejects", default=None, help="write rejected lines and reasons here (NDJSON)")
+    args = parser.parse_args()
+    read, inserted, skipped, rejected = import_files(
+        args.files, workers=args.workers, batch_rows=args.batch_rows,
+        chunk_rows=args.chunk_rows, rejects_path=args.rejects,
+    )
+    print(f"Read {read} rows: inserted {inserted}, skipped {skipped} already stored, rejected {rejected}")
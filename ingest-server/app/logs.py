@@ -0,0 +1,169 @@
+"""
+Logging setup for the ingest server.
+
+Records are handed to a bounded queue and written to stdout by a
+background thread, so the event loop never blocks on I/O or formatting:
+messages use %-style arguments and are only rendered by the writer
+thread. Per-logger rate limits (LOG_RATE_LIMITS="app.main=5,...", in
+records per second) thin out the per-uplink INFO/DEBUG lines; warnings
+and errors always pass. Extra key/value context goes through kv():
+
+    logger.info("uplink stored", extra=kv(deveui=deveui, id=row_id))
+"""
+
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_RATE_LIMITS = os.environ.get("LOG_RATE_LIMITS", "app.main=5,app.forwarder=5,app.outbox=5")
+
+_listener = None
+_handler = None
+
+
+def kv(**fields) -> dict:
+    """extra= argument carrying structured key/value fields."""
+    return {"fields": fields}
+
+
+class KeyValueFormatter(logging.Formatter):
+    """`time level logger message key=value ...`, with the traceback on its own lines."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        suppressed = getattr(record, "suppressed", 0)
+        if fields or suppressed:
+            pairs = dict(fields or {})
+            if suppressed:
+                pairs["suppressed"] = suppressed
+            extra = " ".join(f"{key}={value}" for key, value in pairs.items())
+            # keep the traceback (if any) after the key/value pairs
+            head, sep, tail = line.partition("\n")
+            line = f"{head} {extra}{sep}{tail}"
+        return line
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket per logger name for records below WARNING. Dropped records
+    are counted and reported on the next record that gets through.
+    """
+
+    def __init__(self, limits: dict):
+        super().__init__()
+        self.limits = limits
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate_for(record.name)
+        if rate is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, dropped = self._buckets.get(record.name, (rate, now, 0))
+            tokens = min(rate, tokens + (now - updated) * rate)
+            if tokens < 1:
+                self._buckets[record.name] = (tokens, now, dropped + 1)
+                return False
+            self._buckets[record.name] = (tokens - 1, now, 0)
+        if dropped:
+            record.suppressed = dropped
+        return True
+
+    def _rate_for(self, name):
+        while name:
+            if name in self.limits:
+                return self.limits[name]
+            name = name.rpartition(".")[0]
+        return None
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread and drops
+    (and counts) records instead of blocking when the queue is full.
+    """
+
+    dropped = 0
+
+    def prepare(self, record):
+        # the stock prepare() formats the message here, on the event loop
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def parse_rate_limits(spec: str) -> dict:
+    limits = {}
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, rate = entry.partition("=")
+        try:
+            limits[name.strip()] = float(rate)
+        except ValueError:
+            continue
+    return limits
+
+
+def setup_logging(level=LOG_LEVEL, rate_limits=LOG_RATE_LIMITS):
+    """Route the root logger through the queue; safe to call more than once."""
+    global _listener, _handler
+    if _listener is not None:
+        return
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(KeyValueFormatter())
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _handler = DroppingQueueHandler(log_queue)
+    _handler.addFilter(RateLimitFilter(parse_rate_limits(rate_limits)))
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(_handler)
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown_logging():
+    """Flush queued records; call once at process exit."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_levels(names=()) -> dict:
+    names = set(names) | {"root"} | {
+        name for name in logging.root.manager.loggerDict if name.startswith("app")
+    }
+    levels = {}
+    for name in sorted(names):
+        logger = logging.getLogger() if name == "root" else logging.getLogger(name)
+        levels[name] = logging.getLevelName(logger.getEffectiveLevel())
+    levels["dropped_records"] = _handler.dropped if _handler else 0
+    return levels
+
+
+def set_level(name: str, level: str):
+    """Change a logger's level at runtime; raises ValueError for unknown levels."""
+    level = level.upper()
+    if not isinstance(logging.getLevelName(level), int):
+        raise ValueError(f"Unknown log level: {level}")
+    logger = logging.getLogger() if name in ("", "root") else logging.getLogger(name)
+    logger.setLevel(level)
@@ -1,183 +1,429 @@
-from fastapi import FastAPI, HTTPException, Request
-import psycopg2
-import os
-import json
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+import asyncio
+import asyncpg
+import base64
+import hmac
 import logging
-import httpx  # Added for clean forwarding
-from datetime import datetime
+import os
+import time
+from datetime import datetime, timezone
+from typing import Optional
+from app import db, decoders, export, metrics, rollups
+from app.parser import parse_batch_item, parse_uplink
+from app.admission import INGEST_RETRY_AFTER, Admission, not_ready_reasons
+from app.logs import get_levels, kv, set_level, setup_logging, shutdown_logging
+from app.utils import json_dumps, json_loads
+from app.dedup import frame_key
+from app.store import StoreUnavailable, create_store
 #from app.routers import uplinks
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
+# Set up logging: queued, rate limited, written by a background thread
+setup_logging()
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    setup_logging()
+    await store.start()
+    try:
+        yield
+    finally:
+        await store.stop()
+        await rollups.close_pool()
+        shutdown_logging()
+
+# In-process writer, or a client for the shared writer process under app.serve
+store = create_store()
+store.register_gauges()
+admission = Admission()
+app = FastAPI(lifespan=lifespan)
+
+HEALTH_STATS_TIMEOUT = 1.0  # seconds; a busy writer must not stall /health
+RETRY_LATER = {"Retry-After": str(INGEST_RETRY_AFTER)}
 #app.include_router(uplinks.router)
 
-# Database config from environment variables
-DB_HOST = os.environ.get("POSTGRES_HOST", "localhost")
-DB_NAME = os.environ.get("POSTGRES_DB", "ingest")
-DB_USER = os.environ.get("POSTGRES_USER", "ingestuser")
-DB_PASS = os.environ.get("POSTGRES_PASSWORD", "ingestpass")
-
-# Device manager config
-DEVICE_MANAGER_URL = os.environ.get("DEVICE_MANAGER_URL", "http://device-manager:9000/process-uplink")
-
-def get_conn():
-    return psycopg2.connect(
-        host=DB_HOST,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASS
-    )
+@app.post("/uplink")
+async def receive_uplink(req: Request):
+    # Shed load before reading the body; the network server retries later
+    if not admission.try_enter():
+        metrics.SHED.inc()
+        raise HTTPException(status_code=503, detail="Ingest at capacity, retry later", headers=RETRY_LATER)
+    metrics.IN_FLIGHT.inc()
+    try:
+        with metrics.REQUEST_SECONDS.time():
+            return await store_uplink(req)
+    finally:
+        metrics.IN_FLIGHT.dec()
+        admission.leave()
+
+async def store_uplink(req: Request):
+    started = time.perf_counter()
+    try:
+        logger.debug("Received uplink request", extra=kv(client=req.client.host if req.client else "unknown"))
+
+        # One pass: pick JSON body or Actility query format, build the row
+        parsed = parse_uplink(await req.body(), dict(req.query_params))
+        deveui, received_at, uplink = parsed.deveui, parsed.received_at, parsed.uplink
+        key = frame_key(uplink)
+        decoded = decoders.decode(deveui, uplink)
+    except Exception as e:
+        metrics.REJECTED.inc()
+        logger.exception("Error processing uplink: %s", e)
+        raise HTTPException(status_code=400, detail=str(e))
+    metrics.PARSE_SECONDS.observe(time.perf_counter() - started)
+
+    # Store the entire uplink JSON (or spool it, or drop it as a duplicate)
+    try:
+        status = await store.store(deveui, received_at, uplink, decoded, key)
+    except StoreUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e), headers=RETRY_LATER)
+    if status != "duplicate":
+        logger.info("Accepted uplink", extra=kv(deveui=deveui, time=uplink.get("Time"), status=status))
+    return {"status": status, "device_eui": deveui}
+
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "1000"))
+BATCH_MAX_BYTES = int(os.environ.get("BATCH_MAX_BYTES", str(8 * 1024 * 1024)))
+# a JSON array is buffered and parsed whole, so it gets a smaller limit than streamed NDJSON
+BATCH_MAX_ARRAY_BYTES = int(os.environ.get("BATCH_MAX_ARRAY_BYTES", str(1024 * 1024)))
 
-async def forward_to_device_manager(uplink_data: dict) -> bool:
+@app.post("/uplinks/batch")
+async def receive_uplink_batch(req: Request):
     """
-    Clean, simple forwarding to device manager
-    Based on our investigation of what device manager expects
+    Many uplinks in one request, as a JSON array or NDJSON (one per line).
+    Each item is a callback body /uplink accepts, or an object holding the
+    query parameters of an Actility callback. Items are stored in one
+    transaction (or spooled together); the answer has a status per item,
+    "rejected" with the error for items that could not be parsed.
+
+    NDJSON is read line by line, up to BATCH_MAX_BYTES. A JSON array is
+    held in memory until it is complete, so it is limited to
+    BATCH_MAX_ARRAY_BYTES; send larger batches as NDJSON.
     """
+    if not admission.try_enter():
+        metrics.SHED.inc()
+        raise HTTPException(status_code=503, detail="Ingest at capacity, retry later", headers=RETRY_LATER)
+    metrics.IN_FLIGHT.inc()
     try:
-        # Extract exactly what device manager expects
-        payload = {
-            "DevEUI": uplink_data.get("DevEUI"),
-            "Time": uplink_data.get("Time")
-        }
-        
-        # Add optional fields if present
-        if uplink_data.get("LrnFPort"):
-            payload["LrnFPort"] = uplink_data.get("LrnFPort")
-        if uplink_data.get("payload_hex"):
-            payload["payload_hex"] = uplink_data.get("payload_hex")
-        
-        # Include raw payload for device manager processing
-        payload["raw_payload"] = uplink_data
-        
-        logger.info(f"Forwarding uplink for device {payload['DevEUI']} to {DEVICE_MANAGER_URL}")
-        
-        # Simple, reliable HTTP POST
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.post(
-                DEVICE_MANAGER_URL,
-                json=payload,
-                headers={"Content-Type": "application/json"}
-            )
-            
-            if response.status_code == 200:
-                logger.info("Successfully forwarded to device manager")
-                return True
-            else:
-                logger.error(f"Device manager returned {response.status_code}: {response.text}")
-                return False
-                
-    except Exception as e:
-        logger.error(f"Forwarding error: {e}")
-        return False
+        return await store_uplink_batch(req)
+    finally:
+        metrics.IN_FLIGHT.dec()
+        admission.leave()
 
-@app.post("/uplink")
-async def receive_uplink(req: Request):
+async def batch_items(req: Request):
+    """
+    Yield the raw items of a batch body. NDJSON lines are yielded (as
+    bytes) as soon as they have arrived; a JSON array is parsed once
+    complete.
+    """
+    received = 0
+    pending = b""
+    array = None
+    parts = []
+    async for chunk in req.stream():
+        received += len(chunk)
+        if received > BATCH_MAX_BYTES:
+            raise HTTPException(status_code=413, detail=f"Batch larger than {BATCH_MAX_BYTES} bytes")
+        if array is None:
+            head = (pending + chunk).lstrip()[:1]
+            if head:
+                array = head == b"["
+        if array:
+            if received > BATCH_MAX_ARRAY_BYTES:
+                raise HTTPException(status_code=413, detail=f"JSON array batch larger than {BATCH_MAX_ARRAY_BYTES} "
+                                                            "bytes, send it as NDJSON")
+            parts.append(chunk)
+            continue
+        *lines, pending = (pending + chunk).split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if array:
+        data = json_loads(b"".join(parts))
+        if not isinstance(data, list):
+            raise ValueError("Batch body is not a JSON array")
+        for item in data:
+            yield item
+    elif pending.strip():
+        yield pending
+
+async def store_uplink_batch(req: Request):
+    rows = []
+    results = []
     try:
-        logger.info(f"Received uplink request from {req.client.host if req.client else 'unknown'}")
-        logger.info(f"Query params: {dict(req.query_params)}")
+        async for item in batch_items(req):
+            if len(results) >= BATCH_MAX_ITEMS:
+                raise HTTPException(status_code=413, detail=f"Batch holds more than {BATCH_MAX_ITEMS} uplinks")
+            index = len(results)
+            try:
+                parsed = parse_batch_item(json_loads(item) if isinstance(item, bytes) else item)
+            except (TypeError, ValueError) as e:
+                metrics.REJECTED.inc()
+                results.append({"index": index, "status": "rejected", "error": str(e)})
+                continue
+            uplink = parsed.uplink
+            rows.append((parsed.deveui, parsed.received_at, uplink, decoders.decode(parsed.deveui, uplink),
+                         frame_key(uplink)))
+            results.append({"index": index, "status": None, "device_eui": parsed.deveui})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid batch: {e}")
+    if not results:
+        raise HTTPException(status_code=400, detail="Empty batch")
+    metrics.BATCH_ITEMS.observe(len(results))
 
-        # Try to read JSON body first (old format)
-        try:
-            body = await req.json()
-            uplink = body.get("DevEUI_uplink", body)
-            deveui = uplink.get("DevEUI")
-            timestamp = uplink.get("Time")
-            logger.info(f"JSON format - DevEUI: {deveui}, Time: {timestamp}")
-        except Exception as json_error:
-            logger.info(f"No JSON body, checking query parameters: {json_error}")
-            body = {}
-            uplink = {}
-            deveui = None
-            timestamp = None
-
-        # Fall back to query parameters (Actility format)
-        if not deveui:
-            query_params = dict(req.query_params)
-            deveui = query_params.get("LrnDevEui") or query_params.get("DevEUI")
-            timestamp = query_params.get("Time")
-
-            # Build uplink object from query parameters
-            uplink = {
-                "DevEUI": deveui,
-                "Time": timestamp,
-                "LrnFPort": query_params.get("LrnFPort"),
-                "LrnInfos": query_params.get("LrnInfos"),
-                "AS_ID": query_params.get("AS_ID"),
-                "Token": query_params.get("Token"),
-                "query_params": query_params
-            }
-            logger.info(f"Query param format - DevEUI: {deveui}, Time: {timestamp}")
-
-        # Validate required fields
-        if not deveui:
-            logger.error("Missing DevEUI in both JSON body and query parameters")
-            raise ValueError("Missing DevEUI - required in either JSON body or LrnDevEui query parameter")
-
-        # Use current time if no timestamp provided
-        if not timestamp:
-            timestamp = datetime.utcnow().isoformat() + "+00:00"
-            logger.info(f"No timestamp provided, using current time: {timestamp}")
-
-        # Parse timestamp safely
+    statuses = []
+    if rows:
         try:
-            if timestamp.endswith('Z'):
-                received_at = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
-            elif '+' in timestamp or timestamp.endswith('+00:00'):
-                received_at = datetime.fromisoformat(timestamp)
-            else:
-                received_at = datetime.fromisoformat(timestamp + "+00:00")
-        except Exception as time_error:
-            logger.warning(f"Could not parse timestamp '{timestamp}': {time_error}")
-            received_at = datetime.utcnow()
-
-        # Store the entire uplink JSON
-        logger.info(f"Storing uplink for device {deveui}")
-        with get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "INSERT INTO raw_uplinks (deveui, received_at, payload) VALUES (%s, %s, %s)",
-                    (deveui, received_at, json.dumps(uplink))
-                )
-
-        logger.info(f"Successfully stored uplink for device {deveui}")
-
-        # CLEAN FORWARDING - Replace broken code
-        try:
-            success = await forward_to_device_manager(uplink)
-            if success:
-                logger.info("Successfully forwarded to device manager")
-            else:
-                logger.warning("Forwarding to device manager failed")
-        except Exception as fe:
-            logger.warning(f"Forwarding error: {fe}")
+            statuses = await store.store_batch(rows)
+        except StoreUnavailable as e:
+            raise HTTPException(status_code=503, detail=str(e), headers=RETRY_LATER)
+    stored = iter(statuses)
+    counts = {}
+    for result in results:
+        if result["status"] is None:
+            result["status"] = next(stored)
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    logger.info("Accepted uplink batch", extra=kv(items=len(results), **counts))
+    return {"items": len(results), "counts": counts, "results": results}
 
-        return {"status": "stored-and-forwarded", "device_eui": deveui}
+RAW_UPLINK_MAX_LIMIT = 1000
 
-    except Exception as e:
-        logger.error(f"Error processing uplink: {str(e)}")
-        logger.exception(e)
-        raise HTTPException(status_code=400, detail=str(e))
+def encode_cursor(received_at: datetime, row_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{received_at.isoformat()}|{row_id}".encode()).decode()
+
+def decode_cursor(token: str):
+    received_at, row_id = base64.urlsafe_b64decode(token.encode()).decode().split("|")
+    return datetime.fromisoformat(received_at), int(row_id)
+
+def raw_uplink_query(deveui, since=None, until=None, after_id=None, before=None, limit=None):
+    """
+    SQL and arguments for one page of a device's raw uplinks.
+    Newest first, continuing below the (received_at, id) `before` cursor;
+    with after_id, oldest first from that id (for tailing new rows).
+    """
+    clauses = ["deveui = $1"]
+    args = [deveui]
+    if since is not None:
+        args.append(since)
+        clauses.append(f"received_at >= ${len(args)}")
+    if until is not None:
+        args.append(until)
+        clauses.append(f"received_at < ${len(args)}")
+    if after_id is not None:
+        args.append(after_id)
+        clauses.append(f"id > ${len(args)}")
+        order = "id ASC"
+    else:
+        if before is not None:
+            args.extend(decode_cursor(before))
+            clauses.append(f"(received_at, id) < (${len(args) - 1}, ${len(args)})")
+        order = "received_at DESC, id DESC"
+    sql = f"SELECT id, received_at, payload, decoded FROM raw_uplinks_json WHERE {' AND '.join(clauses)} ORDER BY {order}"
+    if limit is not None:
+        args.append(limit)
+        sql += f" LIMIT ${len(args)}"
+    return sql, args
+
+def raw_uplink_row(r) -> dict:
+    return {
+        "id": r["id"],
+        "received_at": r["received_at"].isoformat(),
+        "payload": r["payload"],
+        "decoded": r["decoded"],
+    }
+
+async def stream_raw_uplinks(sql, args):
+    """Yield NDJSON lines straight from a server-side cursor."""
+    async with db.get_pool().acquire() as conn:
+        async with conn.transaction():
+            async for r in conn.cursor(sql, *args, prefetch=500):
+                yield json_dumps(raw_uplink_row(r)) + b"\n"
 
 @app.get("/uplink/raw/{deveui}")
-async def get_raw_uplink(deveui: str):
+async def get_raw_uplink(
+    deveui: str,
+    response: Response,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    after_id: Optional[int] = None,
+    before: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=RAW_UPLINK_MAX_LIMIT),
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+):
+    """
+    Raw uplinks for one device, newest first (oldest first with after_id).
+    JSON pages carry the next continuation in X-Next-Cursor (pass it back
+    as `before`) or X-Next-After-Id. format=ndjson streams every matching
+    row without a limit, so use since/until to bound it.
+    """
+    deveui = deveui.upper()
     try:
-        with get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "SELECT id, received_at, payload FROM raw_uplinks WHERE deveui = %s ORDER BY received_at DESC LIMIT 100",
-                    (deveui,)
-                )
-                rows = cur.fetchall()
-        return [
-            {"id": r[0], "received_at": r[1].isoformat(), "payload": r[2]}
-            for r in rows
-        ]
+        if format == "ndjson":
+            sql, args = raw_uplink_query(deveui, since, until, after_id, before)
+            return StreamingResponse(stream_raw_uplinks(sql, args), media_type="application/x-ndjson")
+
+        sql, args = raw_uplink_query(deveui, since, until, after_id, before, limit)
+        async with db.get_pool().acquire() as conn:
+            rows = await conn.fetch(sql, *args)
+        if len(rows) == limit:
+            last = rows[-1]
+            if after_id is not None:
+                response.headers["X-Next-After-Id"] = str(last["id"])
+            else:
+                response.headers["X-Next-Cursor"] = encode_cursor(last["received_at"], last["id"])
+        return [raw_uplink_row(r) for r in rows]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {e}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/devices")
+async def list_devices():
+    """Latest state of every device seen, from the in-process device-state cache."""
+    try:
+        return await store.device_list()
+    except StoreUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+@app.get("/devices/{deveui}/latest")
+async def get_device_latest(deveui: str):
+    """Last seen, uplink count, last FPort, payload and decoded values for one device."""
+    try:
+        state = await store.device(deveui.upper())
+    except StoreUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    if state is None:
+        raise HTTPException(status_code=404, detail=f"Unknown device {deveui}")
+    return state
+
+@app.get("/devices/{deveui}/rollups")
+async def get_device_rollups(
+    deveui: str,
+    resolution: str = Query("1h", pattern="^(1m|1h|1d)$"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: int = Query(500, ge=1, le=5000),
+    fields: Optional[str] = Query(None, description="comma-separated decoded fields"),
+):
+    """
+    Pre-aggregated buckets for one device, oldest first: uplink count,
+    first/last time and count/min/max/avg per decoded field. Without since,
+    returns the last `limit` buckets before until (default now).
+    """
+    until = until or datetime.now(timezone.utc)
+    since = since or until - rollups.RESOLUTIONS[resolution] * limit
+    try:
+        return await rollups.series(deveui.upper(), resolution, since, until, limit,
+                                    fields=set(fields.split(",")) if fields else None)
+    except (OSError, asyncpg.PostgresError) as e:
+        raise HTTPException(status_code=503, detail=f"Device database unavailable: {e}")
+
+# per process; each export holds a database connection of its own for its whole download
+EXPORT_MAX_CONCURRENT = int(os.environ.get("EXPORT_MAX_CONCURRENT", "1"))
+_exports_running = 0
+
+async def counted_export(stream):
+    """Pass stream through, counting it as a running export while it is read."""
+    global _exports_running
+    _exports_running += 1
+    try:
+        async for data in stream:
+            yield data
+    finally:
+        _exports_running -= 1
+
+@app.get("/export/raw_uplinks")
+async def export_raw_uplinks(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    deveui: Optional[str] = None,
+    after_id: int = Query(0, ge=0),
+    compress: str = Query("gzip", pattern="^(gzip|none)$"),
+):
+    """
+    Stream raw_uplinks as CSV (gzip by default), chunked by id with COPY.
+    Resume an interrupted download with after_id set to the last id received.
+    Runs on a connection outside the app pool; past EXPORT_MAX_CONCURRENT
+    exports in this process the answer is 429. Only gzip or plain CSV is
+    served here; .zst and .parquet are python -m app.export options.
+    """
+    if _exports_running >= EXPORT_MAX_CONCURRENT:
+        raise HTTPException(status_code=429, detail="An export is already running, retry later",
+                            headers=RETRY_LATER)
+    gzip_output = compress == "gzip"
+    filename = "raw_uplinks.csv.gz" if gzip_output else "raw_uplinks.csv"
+    return StreamingResponse(
+        counted_export(export.stream_csv(db.connect, after_id=after_id, since=since, until=until,
+                                         deveui=deveui.upper() if deveui else None,
+                                         gzip_output=gzip_output)),
+        media_type="application/gzip" if gzip_output else "text/csv",
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
+
+async def readiness():
+    """(health dict, reasons this process is not ready)."""
+    health = {
+        "status": "healthy",
+        "service": "ingest-server",
+        "database": "up" if db.is_healthy() else "down",
+        "pool": db.pool_stats(),
+        "admission": admission.stats(),
+    }
+    try:
+        stats = await asyncio.wait_for(store.stats(), HEALTH_STATS_TIMEOUT)
+    except (StoreUnavailable, asyncio.TimeoutError) as e:
+        health["status"] = "degraded"
+        health["writer"] = {"error": str(e) or "writer did not answer in time"}
+        return health, ["writer unavailable"]
+    health.update(stats)
+    return health, not_ready_reasons(admission, stats)
+
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "service": "ingest-server"}
+    health, reasons = await readiness()
+    health["ready"] = not reasons
+    if reasons:
+        health["not_ready"] = reasons
+    return health
+
+@app.get("/ready")
+async def ready_check():
+    """200 while this process should get traffic, else 503 with the reasons (for load balancers)."""
+    _, reasons = await readiness()
+    if reasons:
+        raise HTTPException(status_code=503, detail=reasons, headers=RETRY_LATER)
+    return {"ready": True}
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/logging")
+async def logging_levels():
+    return get_levels()
+
+# PUT /logging is refused unless this is set; send it as "Authorization: Bearer <token>"
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+def require_admin(req: Request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Set ADMIN_TOKEN to enable admin endpoints")
+    supplied = req.headers.get("authorization", "").removeprefix("Bearer ").strip()
+    if not hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+@app.put("/logging")
+async def update_logging_level(req: Request, level: str, logger_name: str = Query("root", alias="logger")):
+    """
+    Change a log level in the process that handles the request only. Under
+    app.serve the other workers and the writer keep theirs; LOG_LEVEL and
+    a restart change them all.
+    """
+    require_admin(req)
+    try:
+        set_level(logger_name, level)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"scope": "this process only", "pid": os.getpid(), "levels": get_levels([logger_name])}
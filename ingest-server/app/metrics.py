@@ -0,0 +1,131 @@
+"""
+Prometheus metrics for the ingest server and the batch scripts.
+
+Metrics are registered once at import. Hot paths only touch label children
+bound in advance, so each update is an increment or an observe. Gauges that
+mirror state we already keep (pool, queues, spool) are read at scrape time
+instead of being updated per request. consumer.py and forward_cron.py
+export their checkpoint lag through serve() or write_textfile().
+
+Under app.serve, PROMETHEUS_MULTIPROC_DIR is set and every process writes
+its samples there. /metrics then aggregates them, and the writer process
+refreshes its gauges every few seconds instead of at scrape time.
+"""
+
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    start_http_server,
+    write_to_textfile,
+)
+from prometheus_client.multiprocess import MultiProcessCollector
+
+MULTIPROCESS = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+# per-DevEUI series beyond this many devices are folded into deveui="other"
+METRICS_MAX_DEVICES = int(os.environ.get("METRICS_MAX_DEVICES", "1000"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REQUEST_SECONDS = Histogram("ingest_request_seconds", "Time to handle POST /uplink",
+                            buckets=LATENCY_BUCKETS)
+PARSE_SECONDS = Histogram("ingest_parse_seconds", "Time to parse and decode one uplink",
+                          buckets=LATENCY_BUCKETS)
+DB_INSERT_SECONDS = Histogram("ingest_db_insert_seconds", "Time to commit one writer batch",
+                              buckets=LATENCY_BUCKETS)
+DB_BATCH_ROWS = Histogram("ingest_db_batch_rows", "Rows per writer batch",
+                          buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+BATCH_ITEMS = Histogram("ingest_batch_items", "Uplinks per POST /uplinks/batch request",
+                        buckets=(1, 10, 50, 100, 250, 500, 1000, 5000))
+FORWARD_SECONDS = Histogram("ingest_forward_seconds", "Time for one device manager POST",
+                            buckets=LATENCY_BUCKETS)
+
+UPLINKS = Counter("ingest_uplinks_total", "Uplinks received, by outcome", ["outcome"])
+STORED = UPLINKS.labels("stored")
+SPOOLED = UPLINKS.labels("spooled")
+DUPLICATE = UPLINKS.labels("duplicate")
+REJECTED = UPLINKS.labels("rejected")
+FAILED = UPLINKS.labels("failed")
+SHED = UPLINKS.labels("shed")
+
+IN_FLIGHT = Gauge("ingest_in_flight_requests", "POST /uplink requests being handled",
+                  multiprocess_mode="livesum")
+
+SPOOL_REJECTED = Counter("ingest_spool_rejected_total",
+                         "Spooled uplinks set aside in rejected/ after failing replay repeatedly")
+
+FORWARDS = Counter("ingest_forwards_total", "Device manager forwards, by outcome", ["outcome"])
+FORWARDED = FORWARDS.labels("forwarded")
+FORWARD_FAILED = FORWARDS.labels("forward-failed")
+
+DEVICE_UPLINKS = Counter("ingest_device_uplinks_total", "Accepted uplinks per DevEUI", ["deveui"])
+_OTHER_DEVICES = DEVICE_UPLINKS.labels("other")
+_device_counters = {}
+
+CHECKPOINT_LAG = Gauge("ingest_checkpoint_lag_rows",
+                       "raw_uplinks ids newer than a job's checkpoint", ["checkpoint"])
+CHECKPOINT_ID = Gauge("ingest_checkpoint_id", "Last raw_uplinks id a job committed", ["checkpoint"])
+CHECKPOINT_UPDATED = Gauge("ingest_checkpoint_updated_timestamp_seconds",
+                           "When a job last reported its checkpoint", ["checkpoint"])
+
+
+def count_device(deveui: str):
+    counter = _device_counters.get(deveui)
+    if counter is None:
+        if len(_device_counters) >= METRICS_MAX_DEVICES:
+            counter = _OTHER_DEVICES
+        else:
+            counter = _device_counters[deveui] = DEVICE_UPLINKS.labels(deveui)
+    counter.inc()
+
+
+_refreshed_gauges = []
+
+
+def gauge(name: str, documentation: str, read):
+    """A gauge whose value is read() at scrape time (or by refresh_gauges())."""
+    if MULTIPROCESS:
+        metric = Gauge(name, documentation, multiprocess_mode="livesum")
+        _refreshed_gauges.append((metric, read))
+    else:
+        metric = Gauge(name, documentation)
+        metric.set_function(read)
+    return metric
+
+
+def refresh_gauges():
+    for metric, read in _refreshed_gauges:
+        metric.set(read())
+
+
+def report_checkpoint(name: str, checkpoint: int, lag: int):
+    CHECKPOINT_ID.labels(name).set(checkpoint)
+    CHECKPOINT_LAG.labels(name).set(lag)
+    CHECKPOINT_UPDATED.labels(name).set(time.time())
+
+
+def render():
+    """(body, content type) for a /metrics response."""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def serve(port: int):
+    """Expose /metrics on port from a background thread (for long-running scripts)."""
+    start_http_server(port)
+
+
+def write_textfile(path: str):
+    """Write the registry for node_exporter's textfile collector (for cron jobs)."""
+    write_to_textfile(path, REGISTRY)
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import os
+import time
+
+from app import db
+from app.forwarder import create_client, post_uplink
+
+logger = logging.getLogger(__name__)
+
+# Dispatcher settings
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_CONCURRENCY = int(os.environ.get("OUTBOX_CONCURRENCY", "4"))
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", "5"))
+OUTBOX_RETRY_BASE = float(os.environ.get("OUTBOX_RETRY_BASE", "2"))
+OUTBOX_RETRY_MAX = float(os.environ.get("OUTBOX_RETRY_MAX", "600"))
+OUTBOX_MAX_BACKLOG = int(os.environ.get("OUTBOX_MAX_BACKLOG", "100000"))  # readiness turns false above this
+
+INSERT_SQL = """
+    INSERT INTO forward_outbox (raw_uplink_id, deveui, payload)
+    SELECT * FROM unnest($1::bigint[], $2::text[], $3::jsonb[])
+"""
+
+FETCH_DUE_SQL = """
+    SELECT id, deveui, payload, attempts FROM forward_outbox
+    WHERE next_attempt_at <= now()
+    ORDER BY id
+    LIMIT $1
+"""
+
+# counts at most $1 rows, so it stays cheap however far behind the device manager is
+BACKLOG_SQL = "SELECT count(*) FROM (SELECT 1 FROM forward_outbox LIMIT $1) AS backlog"
+
+DELETE_SQL = "DELETE FROM forward_outbox WHERE id = ANY($1::bigint[])"
+
+RETRY_SQL = """
+    UPDATE forward_outbox
+    SET attempts = attempts + 1,
+        next_attempt_at = now() + make_interval(secs => $2),
+        last_error = $3
+    WHERE id = $1
+"""
+
+
+async def enqueue(conn, raw_uplink_ids, deveuis, payloads):
+    """Record forward payloads on conn, inside the caller's transaction."""
+    await conn.execute(INSERT_SQL, raw_uplink_ids, deveuis, payloads)
+
+
+def retry_delay(attempts: int) -> float:
+    # clamp the exponent: 2 ** attempts overflows a float after ~1000 retries
+    return min(OUTBOX_RETRY_BASE * (2 ** min(attempts, 32)), OUTBOX_RETRY_MAX)
+
+
+class OutboxDispatcher:
+    """
+    Drains forward_outbox to the device manager in the background.
+
+    Rows are only deleted once the device manager accepted them; failures
+    are rescheduled with exponential backoff, so nothing is lost while the
+    device manager is down. notify() wakes the loop right after a commit.
+    Only batch_size rows and `concurrency` POSTs are in memory at a time; the
+    backlog is counted (up to max_backlog) once per poll interval.
+    """
+
+    def __init__(self, batch_size=OUTBOX_BATCH_SIZE, concurrency=OUTBOX_CONCURRENCY,
+                 poll_interval=OUTBOX_POLL_INTERVAL, max_backlog=OUTBOX_MAX_BACKLOG):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_backlog = max_backlog
+        self.backlog = 0
+        self._backlog_checked = 0.0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._wake = asyncio.Event()
+        self._client = None
+        self._task = None
+        self.forwarded = 0
+        self.failed = 0
+
+    async def start(self):
+        self._client = create_client()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def notify(self):
+        self._wake.set()
+
+    def saturated(self) -> bool:
+        return self.backlog > self.max_backlog
+
+    async def _count_backlog(self):
+        now = time.monotonic()
+        if now - self._backlog_checked < self.poll_interval or not db.is_healthy():
+            return
+        self._backlog_checked = now
+        async with db.get_pool().acquire() as conn:
+            self.backlog = await conn.fetchval(BACKLOG_SQL, self.max_backlog + 1)
+
+    async def _run(self):
+        while True:
+            try:
+                await self._count_backlog()
+                drained = await self._dispatch_once()
+            except Exception as e:
+                logger.exception("Outbox dispatch failed: %s", e)
+                drained = False
+            if drained:
+                continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def _dispatch_once(self) -> bool:
+        """Send one batch of due rows; returns True if a full batch was found."""
+        if not db.is_healthy():
+            return False
+        async with db.get_pool().acquire() as conn:
+            rows = await conn.fetch(FETCH_DUE_SQL, self.batch_size)
+        if not rows:
+            return False
+
+        results = await asyncio.gather(*(self._send(row) for row in rows))
+        sent = [row["id"] for row, error in zip(rows, results) if error is None]
+        async with db.get_pool().acquire() as conn:
+            async with conn.transaction():
+                if sent:
+                    await conn.execute(DELETE_SQL, sent)
+                for row, error in zip(rows, results):
+                    if error is not None:
+                        await conn.execute(RETRY_SQL, row["id"], retry_delay(row["attempts"]), error)
+
+        self.forwarded += len(sent)
+        self.failed += len(rows) - len(sent)
+        if len(sent) < len(rows):
+            logger.warning("Forwarded %d/%d outbox rows, rest rescheduled", len(sent), len(rows))
+        return len(rows) == self.batch_size and len(sent) == len(rows)
+
+    async def _send(self, row):
+        async with self._semaphore:
+            try:
+                await post_uplink(self._client, row["payload"])
+                return None
+            except Exception as e:
+                return str(e) or type(e).__name__
@@ -0,0 +1,113 @@
+"""
+Single-pass parsing of /uplink requests into the row we store.
+
+Two callback formats reach /uplink:
+  * JSON body, optionally wrapped in "DevEUI_uplink" (old format)
+  * Actility query string (LrnDevEui, LrnFPort, LrnInfos, AS_ID, Time, Token),
+    usually with an empty or "{}" body
+
+The format is picked from the query string and body before any decoding,
+so the common Actility case never attempts (and fails) a JSON parse.
+
+POST /uplinks/batch carries many of either: each item is a JSON callback
+body, or an object holding the query parameters of an Actility callback.
+"""
+
+from datetime import datetime, timezone
+import logging
+
+from app.utils import json_loads, parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+EMPTY_BODIES = (b"", b"{}", b"null")
+
+
+class ParsedUplink:
+    __slots__ = ("deveui", "received_at", "uplink")
+
+    def __init__(self, deveui, received_at, uplink):
+        self.deveui = deveui
+        self.received_at = received_at
+        self.uplink = uplink
+
+
+def _from_json(body: bytes):
+    """The uplink dict from a JSON body, or None if it doesn't hold one."""
+    if body.lstrip()[:1] != b"{":
+        return None
+    try:
+        data = json_loads(body)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    uplink = data.get("DevEUI_uplink", data)
+    return uplink if isinstance(uplink, dict) else None
+
+
+def _from_query(query: dict) -> dict:
+    return {
+        "DevEUI": query.get("LrnDevEui") or query.get("DevEUI"),
+        "Time": query.get("Time"),
+        "LrnFPort": query.get("LrnFPort"),
+        "LrnInfos": query.get("LrnInfos"),
+        "AS_ID": query.get("AS_ID"),
+        "Token": query.get("Token"),
+        "query_params": query,
+    }
+
+
+def parse_received_at(timestamp):
+    """received_at for a Time value; now (UTC) if it is missing or unparseable."""
+    if timestamp:
+        try:
+            return parse_timestamp(timestamp)
+        except ValueError:
+            logger.warning("Could not parse timestamp '%s', using current time", timestamp)
+    return datetime.now(timezone.utc)
+
+
+def parse_uplink(body: bytes, query: dict) -> ParsedUplink:
+    """
+    Build the stored row from a raw request body and its query parameters.
+    Raises ValueError if no DevEUI string is found in either.
+    """
+    uplink = None
+    has_query_deveui = "LrnDevEui" in query or "DevEUI" in query
+    if body.strip() not in EMPTY_BODIES or not has_query_deveui:
+        uplink = _from_json(body)
+    if not uplink or not uplink.get("DevEUI"):
+        uplink = _from_query(query) if has_query_deveui else None
+
+    return _parsed(uplink)
+
+
+def parse_batch_item(item) -> ParsedUplink:
+    """
+    Build the stored row from one decoded batch item. Raises ValueError if
+    it is not an object, holds no DevEUI string or has a Time that is not a
+    string.
+    """
+    if not isinstance(item, dict):
+        raise ValueError("Batch item is not a JSON object")
+    uplink = item.get("DevEUI_uplink", item)
+    if not isinstance(uplink, dict) or not uplink.get("DevEUI"):
+        # query parameters arrive as strings; keep them so, for the same frame key
+        query = {k: str(v) for k, v in item.items() if v is not None}
+        uplink = _from_query(query) if "LrnDevEui" in query or "DevEUI" in query else None
+    return _parsed(uplink)
+
+
+def _parsed(uplink) -> ParsedUplink:
+    deveui = uplink.get("DevEUI") if uplink else None
+    if deveui is not None and not isinstance(deveui, str):
+        raise ValueError(f"DevEUI must be a string, got {type(deveui).__name__}")
+    # one spelling per device, so storage and lookups agree (as app/importer.py does)
+    deveui = (deveui or "").strip().upper()
+    if not deveui:
+        raise ValueError("Missing DevEUI - required in either JSON body or LrnDevEui query parameter")
+    timestamp = uplink.get("Time")
+    if timestamp is not None and not isinstance(timestamp, str):
+        raise ValueError(f"Time must be a string, got {type(timestamp).__name__}")
+    return ParsedUplink(deveui, parse_received_at(timestamp), uplink)
@@ -0,0 +1,207 @@
+"""
+partitions.py
+
+Monthly range partitions of raw_uplinks on received_at.
+
+    python -m app.partitions migrate        # convert a plain raw_uplinks table once
+    python -m app.partitions maintain       # create upcoming months, apply retention
+    python -m app.partitions list
+
+maintain is meant for cron (daily is plenty); the partitions service in
+docker-compose.yml runs it once a day. Partitions are named
+raw_uplinks_pYYYYMM; rows outside every monthly range land in
+raw_uplinks_default and are moved out when their month's partition is
+created. With PARTITION_RETENTION_MONTHS > 0, whole months older than the
+window are detached and dropped, which costs no VACUUM.
+"""
+
+import argparse
+import os
+import re
+from datetime import date, datetime, timezone
+
+from sqlalchemy import create_engine, text
+
+from app.checkpoints import INGEST_DB_URL
+
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+PARTITION_RETENTION_MONTHS = int(os.getenv("PARTITION_RETENTION_MONTHS", "0"))  # 0 keeps everything
+
+PARENT = "raw_uplinks"
+DEFAULT_PARTITION = "raw_uplinks_default"
+NAME_RE = re.compile(r"^raw_uplinks_p(\d{4})(\d{2})$")
+INIT_SQL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "initdb", "init_raw_uplinks.sql")
+
+
+def month_start(day) -> date:
+    return date(day.year, day.month, 1)
+
+
+def add_months(month: date, n: int) -> date:
+    index = month.year * 12 + month.month - 1 + n
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"raw_uplinks_p{month.year:04d}{month.month:02d}"
+
+
+def partition_bounds(month: date):
+    return month.isoformat(), add_months(month, 1).isoformat()
+
+
+def is_partitioned(conn) -> bool:
+    kind = conn.execute(text(
+        "SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)"
+    ), {"name": PARENT}).scalar()
+    return kind == "p"
+
+
+def existing_partitions(conn):
+    """Monthly partitions currently attached to raw_uplinks, as {month: name}."""
+    names = conn.execute(text("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(:name)
+    """), {"name": PARENT}).scalars()
+    months = {}
+    for name in names:
+        match = NAME_RE.match(name)
+        if match:
+            months[date(int(match.group(1)), int(match.group(2)), 1)] = name
+    return months
+
+
+def create_partition(conn, month: date):
+    """
+    Create one month's partition. Rows that already landed in the default
+    partition for that month are moved into it, since Postgres refuses to
+    attach a range the default partition still holds rows for.
+    """
+    name = partition_name(month)
+    lo, hi = partition_bounds(month)
+    stray = conn.execute(text(
+        f"SELECT 1 FROM {DEFAULT_PARTITION} WHERE received_at >= :lo AND received_at < :hi LIMIT 1"
+    ), {"lo": lo, "hi": hi}).first()
+    if stray is None:
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {PARENT} "
+            f"FOR VALUES FROM ('{lo}') TO ('{hi}')"
+        ))
+        return
+    conn.execute(text(f"CREATE TABLE {name} (LIKE {PARENT} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+    conn.execute(text(f"""
+        WITH moved AS (
+            DELETE FROM {DEFAULT_PARTITION}
+            WHERE received_at >= :lo AND received_at < :hi
+            RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+    """), {"lo": lo, "hi": hi})
+    conn.execute(text(f"ALTER TABLE {PARENT} ATTACH PARTITION {name} FOR VALUES FROM ('{lo}') TO ('{hi}')"))
+
+
+def ensure_partitions(conn, first: date, last: date):
+    """Create every missing monthly partition from first to last month inclusive."""
+    have = existing_partitions(conn)
+    month = month_start(first)
+    created = []
+    while month <= month_start(last):
+        if month not in have:
+            create_partition(conn, month)
+            created.append(partition_name(month))
+        month = add_months(month, 1)
+    return created
+
+
+def apply_retention(conn, retention_months: int, detach_only=False):
+    """Detach (and unless detach_only, drop) months entirely older than the window."""
+    if retention_months <= 0:
+        return []
+    cutoff = add_months(month_start(datetime.now(timezone.utc).date()), -retention_months)
+    removed = []
+    for month, name in sorted(existing_partitions(conn).items()):
+        if add_months(month, 1) > cutoff:
+            continue
+        conn.execute(text(f"ALTER TABLE {PARENT} DETACH PARTITION {name}"))
+        if not detach_only:
+            conn.execute(text(f"DROP TABLE {name}"))
+        removed.append(name)
+    conn.execute(text(
+        f"DELETE FROM {DEFAULT_PARTITION} WHERE received_at < :cutoff"
+    ), {"cutoff": cutoff.isoformat()})
+    return removed
+
+
+def migrate(conn, months_ahead=PARTITION_MONTHS_AHEAD):
+    """
+    Convert a plain raw_uplinks table into the partitioned layout, keeping
+    ids and the id sequence. Runs in the caller's transaction; the old
+    table is renamed raw_uplinks_legacy and dropped at the end.
+    """
+    if is_partitioned(conn):
+        print("raw_uplinks is already partitioned")
+        return
+    conn.execute(text(f"LOCK TABLE {PARENT} IN ACCESS EXCLUSIVE MODE"))
+    conn.execute(text(f"UPDATE {PARENT} SET received_at = now() WHERE received_at IS NULL"))
+    bounds = conn.execute(text(f"SELECT min(received_at), max(received_at) FROM {PARENT}")).first()
+    conn.execute(text("DROP VIEW IF EXISTS raw_uplinks_json"))
+    conn.execute(text(f"ALTER TABLE {PARENT} RENAME TO raw_uplinks_legacy"))
+    conn.execute(text("ALTER INDEX IF EXISTS raw_uplinks_pkey RENAME TO raw_uplinks_legacy_pkey"))
+    conn.execute(text("DROP TRIGGER IF EXISTS raw_uplinks_notify ON raw_uplinks_legacy"))
+    conn.execute(text(f"""
+        CREATE TABLE {PARENT} (LIKE raw_uplinks_legacy INCLUDING DEFAULTS)
+        PARTITION BY RANGE (received_at)
+    """))
+    conn.execute(text(f"ALTER TABLE {PARENT} ALTER COLUMN received_at SET NOT NULL"))
+    conn.execute(text(f"ALTER TABLE {PARENT} ADD PRIMARY KEY (id, received_at)"))
+    conn.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {PARENT} DEFAULT"))
+
+    now = datetime.now(timezone.utc).date()
+    first = bounds[0].date() if bounds[0] else now
+    last = max(bounds[1].date() if bounds[1] else now, now)
+    created = ensure_partitions(conn, first, add_months(month_start(last), months_ahead))
+    conn.execute(text(f"INSERT INTO {PARENT} SELECT * FROM raw_uplinks_legacy"))
+    conn.execute(text(f"ALTER SEQUENCE raw_uplinks_id_seq OWNED BY {PARENT}.id"))
+    conn.execute(text("DROP TABLE raw_uplinks_legacy"))
+    # recreate indexes, the NOTIFY trigger and the raw_uplinks_json view on the new parent
+    with open(INIT_SQL) as f, conn.connection.cursor() as cur:
+        cur.execute(f.read())  # no parameters, so format()'s %s/%L reach Postgres untouched
+    print(f"Migrated raw_uplinks into {len(created)} monthly partitions")
+
+
+def maintain(conn, months_ahead=PARTITION_MONTHS_AHEAD,
+             retention_months=PARTITION_RETENTION_MONTHS, detach_only=False):
+    if not is_partitioned(conn):
+        print("raw_uplinks is not partitioned yet; run: python -m app.partitions migrate")
+        return
+    now = month_start(datetime.now(timezone.utc).date())
+    created = ensure_partitions(conn, now, add_months(now, months_ahead))
+    removed = apply_retention(conn, retention_months, detach_only=detach_only)
+    print(f"Created {created or 'no partitions'}; removed {removed or 'no partitions'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage raw_uplinks monthly partitions")
+    sub = parser.add_subparsers(dest="command", required=True)
+    migrate_p = sub.add_parser("migrate", help="convert the plain table to partitions")
+    migrate_p.add_argument("--ahead", type=int, default=PARTITION_MONTHS_AHEAD, help="future months to create")
+    maintain_p = sub.add_parser("maintain", help="pre-create partitions and apply retention")
+    maintain_p.add_argument("--ahead", type=int, default=PARTITION_MONTHS_AHEAD, help="future months to create")
+    maintain_p.add_argument("--retention-months", type=int, default=PARTITION_RETENTION_MONTHS,
+                            help="drop months older than this (0 keeps everything)")
+    maintain_p.add_argument("--detach-only", action="store_true", help="detach old months instead of dropping them")
+    sub.add_parser("list", help="show attached monthly partitions")
+    args = parser.parse_args()
+
+    engine = create_engine(INGEST_DB_URL)
+    with engine.begin() as conn:
+        if args.command == "migrate":
+            migrate(conn, months_ahead=args.ahead)
+        elif args.command == "maintain":
+            maintain(conn, months_ahead=args.ahead, retention_months=args.retention_months,
+                     detach_only=args.detach_only)
+        else:
+            for month, name in sorted(existing_partitions(conn).items()):
+                lo, hi = partition_bounds(month)
+                print(f"{name}  [{lo}, {hi})")
@@ -0,0 +1,292 @@
+"""
+rollups.py
+
+Per-device time buckets of uplink traffic in the device DB, at 1-minute,
+1-hour and 1-day resolution:
+
+  * devices.uplink_rollups: uplink count and first/last received_at
+  * devices.uplink_rollup_fields: count/min/max/sum of every numeric
+    decoded field (avg = sum / count)
+
+consumer.py folds each batch it copies into the buckets, in the same
+device transaction as the rows and its checkpoint. A bucket therefore
+counts every uplink exactly once, however often the consumer restarts.
+GET /devices/{deveui}/rollups reads them through a small device-DB pool.
+
+    python -m app.rollups rebuild --since 2025-06-01 [--until 2025-07-01] [--deveui ...]
+
+rebuild recomputes whole days from devices.uplinks. It holds a lock that
+makes the consumer wait until it has committed.
+"""
+
+import argparse
+import os
+from datetime import datetime, timedelta, timezone
+
+import asyncpg
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Float,
+    MetaData,
+    Table,
+    Text,
+    create_engine,
+    func,
+    select,
+    text,
+)
+from sqlalchemy.dialects.postgresql import insert
+
+from app import decoders
+from app.checkpoints import DEVICE_DB_URL
+
+ROLLUP_DB_POOL_MAX_SIZE = int(os.environ.get("ROLLUP_DB_POOL_MAX_SIZE", "2"))
+REBUILD_PAGE = 5000
+
+RESOLUTIONS = {
+    "1m": timedelta(minutes=1),
+    "1h": timedelta(hours=1),
+    "1d": timedelta(days=1),
+}
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+metadata = MetaData(schema="devices")
+rollups = Table(
+    "uplink_rollups",
+    metadata,
+    Column("deveui", Text, primary_key=True),
+    Column("resolution", Text, primary_key=True),
+    Column("bucket_start", DateTime(timezone=True), primary_key=True),
+    Column("uplink_count", BigInteger, nullable=False),
+    Column("first_at", DateTime(timezone=True), nullable=False),
+    Column("last_at", DateTime(timezone=True), nullable=False),
+)
+rollup_fields = Table(
+    "uplink_rollup_fields",
+    metadata,
+    Column("deveui", Text, primary_key=True),
+    Column("resolution", Text, primary_key=True),
+    Column("bucket_start", DateTime(timezone=True), primary_key=True),
+    Column("field", Text, primary_key=True),
+    Column("value_count", BigInteger, nullable=False),
+    Column("min_value", Float, nullable=False),
+    Column("max_value", Float, nullable=False),
+    Column("sum_value", Float, nullable=False),
+)
+
+
+def ensure_tables(engine):
+    metadata.create_all(engine, checkfirst=True)
+
+
+def bucket_start(received_at: datetime, resolution: str) -> datetime:
+    """Start of the UTC bucket holding received_at."""
+    step = RESOLUTIONS[resolution]
+    return EPOCH + (received_at - EPOCH) // step * step
+
+
+def numeric_fields(decoded):
+    if not isinstance(decoded, dict):
+        return ()
+    return [(k, float(v)) for k, v in decoded.items()
+            if isinstance(v, (int, float)) and not isinstance(v, bool)]
+
+
+def accumulate(rows):
+    """
+    Fold (deveui, received_at, decoded) rows into ({bucket key: [count, first, last]},
+    {bucket key + (field,): [count, min, max, sum]}), keyed by (deveui, resolution, bucket_start).
+    """
+    buckets = {}
+    fields = {}
+    for deveui, received_at, decoded in rows:
+        values = numeric_fields(decoded)
+        for resolution in RESOLUTIONS:
+            key = (deveui, resolution, bucket_start(received_at, resolution))
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = [1, received_at, received_at]
+            else:
+                bucket[0] += 1
+                bucket[1] = min(bucket[1], received_at)
+                bucket[2] = max(bucket[2], received_at)
+            for name, value in values:
+                stat = fields.get(key + (name,))
+                if stat is None:
+                    fields[key + (name,)] = [1, value, value, value]
+                else:
+                    stat[0] += 1
+                    stat[1] = min(stat[1], value)
+                    stat[2] = max(stat[2], value)
+                    stat[3] += value
+    return buckets, fields
+
+
+def apply(conn, rows):
+    """Add (deveui, received_at, decoded) rows to their buckets on conn. Caller commits."""
+    buckets, fields = accumulate(rows)
+    if not buckets:
+        return
+    # key order, so the consumer and a rebuild lock buckets in the same order
+    stmt = insert(rollups)
+    conn.execute(
+        stmt.on_conflict_do_update(
+            index_elements=["deveui", "resolution", "bucket_start"],
+            set_={
+                "uplink_count": rollups.c.uplink_count + stmt.excluded.uplink_count,
+                "first_at": func.least(rollups.c.first_at, stmt.excluded.first_at),
+                "last_at": func.greatest(rollups.c.last_at, stmt.excluded.last_at),
+            },
+        ),
+        [
+            {"deveui": k[0], "resolution": k[1], "bucket_start": k[2],
+             "uplink_count": b[0], "first_at": b[1], "last_at": b[2]}
+            for k, b in sorted(buckets.items())
+        ],
+    )
+    if fields:
+        stmt = insert(rollup_fields)
+        conn.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["deveui", "resolution", "bucket_start", "field"],
+                set_={
+                    "value_count": rollup_fields.c.value_count + stmt.excluded.value_count,
+                    "min_value": func.least(rollup_fields.c.min_value, stmt.excluded.min_value),
+                    "max_value": func.greatest(rollup_fields.c.max_value, stmt.excluded.max_value),
+                    "sum_value": rollup_fields.c.sum_value + stmt.excluded.sum_value,
+                },
+            ),
+            [
+                {"deveui": k[0], "resolution": k[1], "bucket_start": k[2], "field": k[3],
+                 "value_count": s[0], "min_value": s[1], "max_value": s[2], "sum_value": s[3]}
+                for k, s in sorted(fields.items())
+            ],
+        )
+
+
+def day_range(since: datetime, until: datetime):
+    """[since, until) widened to whole UTC days, so every resolution is rebuilt completely."""
+    start = bucket_start(since, "1d")
+    end = bucket_start(until, "1d")
+    return start, end if end == until else end + RESOLUTIONS["1d"]
+
+
+def rebuild(conn, since: datetime, until: datetime, deveui=None, page=REBUILD_PAGE):
+    """Recompute the buckets of whole days in [since, until) from devices.uplinks. Caller commits."""
+    start, end = day_range(since, until)
+    conn.execute(text("LOCK TABLE devices.uplink_rollups, devices.uplink_rollup_fields IN EXCLUSIVE MODE"))
+    for table in (rollups, rollup_fields):
+        stmt = table.delete().where(table.c.bucket_start >= start, table.c.bucket_start < end)
+        if deveui is not None:
+            stmt = stmt.where(table.c.deveui == deveui)
+        conn.execute(stmt)
+
+    uplinks = Table("uplinks", MetaData(), autoload_with=conn, schema="devices")
+    columns = [uplinks.c.id, uplinks.c.deveui, uplinks.c.received_at, uplinks.c.payload]
+    has_decoded = "decoded" in uplinks.c
+    if has_decoded:
+        columns.append(uplinks.c.decoded)
+    query = select(*columns).where(uplinks.c.received_at >= start, uplinks.c.received_at < end)
+    if deveui is not None:
+        query = query.where(uplinks.c.deveui == deveui)
+
+    last_id = 0
+    total = 0
+    while True:
+        rows = conn.execute(query.where(uplinks.c.id > last_id).order_by(uplinks.c.id).limit(page)).fetchall()
+        if not rows:
+            break
+        decoded = [row.decoded if has_decoded else None for row in rows]
+        missing = [i for i, value in enumerate(decoded) if value is None]
+        if missing:
+            fresh = decoders.decode_batch([(rows[i].deveui, rows[i].payload) for i in missing])
+            for i, value in zip(missing, fresh):
+                decoded[i] = value
+        apply(conn, [(row.deveui, row.received_at, value) for row, value in zip(rows, decoded)])
+        last_id = rows[-1].id
+        total += len(rows)
+    print(f"Rebuilt rollups for {start.date()}..{end.date()} from {total} uplinks")
+    return total
+
+
+# ---- reads (app) ----
+
+BUCKETS_SQL = """
+    SELECT bucket_start, uplink_count, first_at, last_at FROM devices.uplink_rollups
+    WHERE deveui = $1 AND resolution = $2 AND bucket_start >= $3 AND bucket_start < $4
+    ORDER BY bucket_start
+    LIMIT $5
+"""
+
+FIELDS_SQL = """
+    SELECT bucket_start, field, value_count, min_value, max_value, sum_value FROM devices.uplink_rollup_fields
+    WHERE deveui = $1 AND resolution = $2 AND bucket_start >= $3 AND bucket_start <= $4
+"""
+
+_pool = None
+
+
+async def get_pool():
+    """Device-DB pool for rollup reads, created on first use."""
+    global _pool
+    if _pool is None:
+        _pool = await asyncpg.create_pool(DEVICE_DB_URL, min_size=0, max_size=ROLLUP_DB_POOL_MAX_SIZE)
+    return _pool
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+async def series(deveui, resolution, since, until, limit, fields=None):
+    """Buckets in [since, until), oldest first, each with its per-field count/min/max/avg."""
+    async with (await get_pool()).acquire() as conn:
+        buckets = await conn.fetch(BUCKETS_SQL, deveui, resolution, since, until, limit)
+        if not buckets:
+            return []
+        stats = await conn.fetch(FIELDS_SQL, deveui, resolution, buckets[0]["bucket_start"],
+                                 buckets[-1]["bucket_start"])
+    by_bucket = {}
+    for s in stats:
+        if fields is None or s["field"] in fields:
+            by_bucket.setdefault(s["bucket_start"], {})[s["field"]] = {
+                "count": s["value_count"],
+                "min": s["min_value"],
+                "max": s["max_value"],
+                "avg": s["sum_value"] / s["value_count"],
+            }
+    return [
+        {
+            "bucket_start": b["bucket_start"],
+            "uplink_count": b["uplink_count"],
+            "first_at": b["first_at"],
+            "last_at": b["last_at"],
+            "fields": by_bucket.get(b["bucket_start"], {}),
+        }
+        for b in buckets
+    ]
+
+
+def parse_time(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage per-device uplink rollups")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rebuild_p = sub.add_parser("rebuild", help="recompute buckets for a time range from devices.uplinks")
+    rebuild_p.add_argument("--since", type=parse_time, required=True, help="first day to rebuild (UTC)")
+    rebuild_p.add_argument("--until", type=parse_time, default=None, help="end of the range (default: now)")
+    rebuild_p.add_argument("--deveui", default=None, help="only this device")
+    args = parser.parse_args()
+
+    engine = create_engine(DEVICE_DB_URL)
+    ensure_tables(engine)
+    with engine.begin() as conn:
+        rebuild(conn, args.since, args.until or datetime.now(timezone.utc), deveui=args.deveui)
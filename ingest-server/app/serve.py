@@ -0,0 +1,141 @@
+"""
+Multi-process entry point for the ingest server.
+
+    python -m app.serve --host 0.0.0.0 --port 8000 [--workers 4]
+
+Starts one writer process (app.store) that owns the database writes,
+outbox, spool and dedup index. Then it runs SERVE_WORKERS uvicorn workers
+(default: one per core) on uvloop and httptools. Workers parse and decode
+uplinks and hand them to the writer over WRITER_SOCKET, so adding workers
+adds no DB connections or commits on the write path. Only the writer
+applies the schema at startup.
+
+If the writer process dies it is restarted, and the workers reconnect on
+their next call. If it cannot be brought back up, the server shuts down
+and exits non-zero, so the container's restart policy takes over.
+
+On SIGTERM uvicorn stops accepting and lets the workers finish their
+in-flight requests. Only then is the writer process told to stop; it
+flushes queued batches and closes the spool before exiting.
+"""
+
+import argparse
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SERVE_WORKERS = int(os.environ.get("SERVE_WORKERS", "0"))  # 0: one per core
+WRITER_SOCKET = os.environ.get("WRITER_SOCKET") or "/tmp/ingest-writer.sock"
+WRITER_START_TIMEOUT = float(os.environ.get("WRITER_START_TIMEOUT", "30"))
+WRITER_STOP_TIMEOUT = float(os.environ.get("WRITER_STOP_TIMEOUT", "30"))
+WRITER_RESTART_DELAY = float(os.environ.get("WRITER_RESTART_DELAY", "1"))
+WORKER_DB_POOL_MAX_SIZE = os.environ.get("WORKER_DB_POOL_MAX_SIZE", "2")  # reads only
+
+
+def start_writer(socket_path, env):
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    # own session: a terminal Ctrl-C reaches uvicorn, and we stop the writer after it
+    writer = subprocess.Popen([sys.executable, "-m", "app.store", socket_path], env=env,
+                              start_new_session=True)
+    deadline = time.monotonic() + WRITER_START_TIMEOUT
+    while not os.path.exists(socket_path):
+        if writer.poll() is not None:
+            raise SystemExit(f"writer process exited with {writer.returncode}")
+        if time.monotonic() > deadline:
+            writer.terminate()
+            raise SystemExit("writer process did not come up")
+        time.sleep(0.1)
+    return writer
+
+
+def stop_writer(writer):
+    if writer.poll() is not None:
+        return
+    writer.send_signal(signal.SIGTERM)
+    try:
+        writer.wait(WRITER_STOP_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        writer.kill()
+        writer.wait()
+
+
+class WriterSupervisor:
+    """Keeps the writer process running; stop() ends it for good."""
+
+    def __init__(self, socket_path, env):
+        self.socket_path = socket_path
+        self.env = env
+        self.process = start_writer(socket_path, env)
+        self.failed = False
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._watch, name="writer-supervisor", daemon=True)
+        self._thread.start()
+
+    def _watch(self):
+        while True:
+            code = self.process.wait()
+            if self._stopping.wait(WRITER_RESTART_DELAY):
+                return
+            print(f"writer process exited with {code}, restarting it", file=sys.stderr, flush=True)
+            try:
+                self.process = start_writer(self.socket_path, self.env)
+            except SystemExit as e:
+                # uvicorn shuts down on SIGTERM; main() then exits non-zero
+                print(f"{e}; stopping the server", file=sys.stderr, flush=True)
+                self.failed = True
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+            if self._stopping.is_set():
+                stop_writer(self.process)
+                return
+
+    def stop(self):
+        self._stopping.set()
+        stop_writer(self.process)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the ingest server on every core")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=SERVE_WORKERS or os.cpu_count() or 1)
+    parser.add_argument("--socket", default=WRITER_SOCKET, help="unix socket for the writer process")
+    args = parser.parse_args()
+
+    # every process writes its metric samples here; /metrics merges them
+    metrics_dir = tempfile.mkdtemp(prefix="ingest-metrics-")
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = metrics_dir
+    writer = WriterSupervisor(args.socket, dict(os.environ))
+
+    # uvicorn workers inherit this environment: talk to the writer, small read
+    # pool, leave the schema to the writer
+    os.environ["WRITER_SOCKET"] = args.socket
+    os.environ["DB_APPLY_SCHEMA"] = "0"
+    os.environ["DB_POOL_MAX_SIZE"] = WORKER_DB_POOL_MAX_SIZE
+    os.environ["DB_POOL_MIN_SIZE"] = "1"
+    import uvicorn
+    try:
+        uvicorn.run(
+            "app.main:app",
+            host=args.host,
+            port=args.port,
+            workers=args.workers,
+            loop="uvloop",
+            http="httptools",
+            access_log=False,
+        )
+    finally:
+        writer.stop()
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+    if writer.failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""
+Local store-and-forward spool for uplinks the database can't take right now.
+
+When the pool is unhealthy, the writer queue is full or a batch insert
+fails, /uplink appends the row here instead of failing the request. Records
+are framed (length + CRC32) and fsync'd into append-only segment files under
+SPOOL_DIR. A background replayer loads the segments into raw_uplinks, oldest
+first, once the database is back. Every replayed batch stores its segment
+offset in spool_replay_log in the same transaction, so a crash mid-replay
+never inserts a record twice. Fully replayed segments are deleted.
+
+A batch that fails for a reason other than the database itself is
+replayed row by row, so one bad record only holds up its own row. A row
+that fails SPOOL_MAX_ATTEMPTS passes is moved to SPOOL_DIR/rejected/ (one
+NDJSON file per segment, with the error), logged and counted, and replay
+goes on past it.
+
+While anything is still spooled, new uplinks are spooled too, so rows reach
+raw_uplinks in arrival order.
+"""
+
+import asyncio
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from app import db, dedup, metrics
+from app.utils import json_dumps, json_loads
+from app.writer import insert_rows
+
+logger = logging.getLogger(__name__)
+
+# Spool settings
+SPOOL_DIR = os.environ.get("SPOOL_DIR", "/app/spool")
+SPOOL_SEGMENT_BYTES = int(os.environ.get("SPOOL_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+SPOOL_REPLAY_BATCH = int(os.environ.get("SPOOL_REPLAY_BATCH", "500"))
+SPOOL_REPLAY_INTERVAL = float(os.environ.get("SPOOL_REPLAY_INTERVAL", "5"))
+SPOOL_MAX_ATTEMPTS = int(os.environ.get("SPOOL_MAX_ATTEMPTS", "3"))  # failed passes before a row is set aside
+
+HEADER = struct.Struct(">II")  # body length, crc32 of body
+SEGMENT_SUFFIX = ".seg"
+REJECTED_DIR = "rejected"
+
+OFFSET_SQL = "SELECT byte_offset FROM spool_replay_log WHERE segment = $1"
+
+ADVANCE_SQL = """
+    INSERT INTO spool_replay_log (segment, byte_offset) VALUES ($1, $2)
+    ON CONFLICT (segment) DO UPDATE SET byte_offset = EXCLUDED.byte_offset, updated_at = now()
+"""
+
+FORGET_SQL = "DELETE FROM spool_replay_log WHERE segment = $1"
+
+
+def encode_record(deveui, received_at, payload, decoded=None, frame_key=None) -> bytes:
+    body = json_dumps([deveui, received_at.isoformat(), payload, decoded, frame_key])
+    return HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def read_records(data: bytes, offset: int = 0):
+    """
+    Yield (end_offset, row) for each intact record in data from offset.
+    Stops at the first torn or corrupt frame, i.e. a crash mid-append.
+    """
+    while offset + HEADER.size <= len(data):
+        length, crc = HEADER.unpack_from(data, offset)
+        start = offset + HEADER.size
+        body = data[start:start + length]
+        if len(body) < length or zlib.crc32(body) != crc:
+            return
+        deveui, received_at, payload, decoded, key = json_loads(body)
+        offset = start + length
+        yield offset, (deveui, datetime.fromisoformat(received_at), payload, decoded, key or dedup.frame_key(payload))
+
+
+def _append_rejected(path, line: bytes):
+    with open(path, "ab") as f:
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read_file(path) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Spool:
+    """
+    Segmented append-only log plus the background task that replays it.
+
+    append() returns once the record is on disk. Segments are named by
+    creation time so they sort in write order; the one being appended to is
+    sealed before each replay pass, so the replayer only reads files that
+    no longer change.
+    """
+
+    def __init__(self, directory=SPOOL_DIR, segment_bytes=SPOOL_SEGMENT_BYTES,
+                 replay_batch=SPOOL_REPLAY_BATCH, replay_interval=SPOOL_REPLAY_INTERVAL,
+                 max_attempts=SPOOL_MAX_ATTEMPTS):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.replay_batch = replay_batch
+        self.replay_interval = replay_interval
+        self.max_attempts = max_attempts
+        self.on_commit = None
+        self.spooled = 0
+        self.replayed = 0
+        self.failed_replays = 0
+        self.rejected = 0
+        self._attempts = {}  # (segment, end offset) -> failed passes of that row
+        self._lock = threading.Lock()
+        self._file = None
+        self._size = 0
+        self._last_name = ""
+        self._pending = False
+        self._wake = asyncio.Event()
+        self._task = None
+
+    async def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._pending = bool(self.segments())
+        if self._pending:
+            logger.warning("Spool holds %d segments from a previous run", len(self.segments()))
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.to_thread(self._seal)
+
+    def notify(self):
+        self._wake.set()
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+
+    def has_backlog(self) -> bool:
+        return self._pending
+
+    def stats(self) -> dict:
+        segments = self.segments() if os.path.isdir(self.directory) else []
+        return {
+            "segments": len(segments),
+            "bytes": sum(os.path.getsize(os.path.join(self.directory, name)) for name in segments),
+            "spooled": self.spooled,
+            "replayed": self.replayed,
+            "failed_replays": self.failed_replays,
+            "rejected": self.rejected,
+        }
+
+    async def append(self, deveui: str, received_at, payload: dict, decoded: dict = None,
+                     frame_key: str = None):
+        """Durably append one uplink; raises OSError if the disk write fails."""
+        record = encode_record(deveui, received_at, payload, decoded, frame_key)
+        await asyncio.to_thread(self._append, record)
+        self.spooled += 1
+        self._pending = True
+
+    async def append_many(self, rows):
+        """Durably append (deveui, received_at, payload, decoded, frame_key) rows with one fsync."""
+        data = b"".join(encode_record(*row) for row in rows)
+        await asyncio.to_thread(self._append, data)
+        self.spooled += len(rows)
+        self._pending = True
+
+    def _append(self, record: bytes):
+        with self._lock:
+            if self._file is None or self._size >= self.segment_bytes:
+                self._roll()
+            self._file.write(record)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._size += len(record)
+
+    def _roll(self):
+        if self._file is not None:
+            self._file.close()
+        name = f"{time.time_ns():020d}{SEGMENT_SUFFIX}"
+        if name <= self._last_name:
+            name = f"{int(self._last_name[:-len(SEGMENT_SUFFIX)]) + 1:020d}{SEGMENT_SUFFIX}"
+        self._last_name = name
+        self._file = open(os.path.join(self.directory, name), "ab")
+        self._size = 0
+        _fsync_dir(self.directory)
+
+    def _seal(self):
+        """
+        Close the active segment; the next append starts a new one. Returns
+        the segments sealed so far, listed under the lock so a segment an
+        append opens right after is not among them.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            return self.segments()
+
+    async def _run(self):
+        while True:
+            if self._pending and db.is_healthy():
+                try:
+                    # keep going while uplinks arrive during replay, so the
+                    # spool drains instead of trailing the live traffic
+                    await self.replay()
+                    continue
+                except Exception as e:
+                    self.failed_replays += 1
+                    logger.error("Spool replay failed, will retry: %s", e)
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.replay_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def replay(self):
+        """Load every sealed segment into raw_uplinks, oldest first."""
+        for name in await asyncio.to_thread(self._seal):
+            await self._replay_segment(name)
+        with self._lock:
+            self._pending = self._file is not None or bool(self.segments())
+
+    async def _replay_segment(self, name):
+        path = os.path.join(self.directory, name)
+        data = await asyncio.to_thread(_read_file, path)
+        async with db.get_pool().acquire() as conn:
+            offset = start = await conn.fetchval(OFFSET_SQL, name) or 0
+            batch = []
+            for offset, row in read_records(data, start):
+                batch.append((offset, row))
+                if len(batch) >= self.replay_batch:
+                    await self._load_batch(conn, name, batch)
+                    batch = []
+            if batch:
+                await self._load_batch(conn, name, batch)
+        if offset < len(data):
+            logger.warning("Spool segment %s has %d torn bytes at the end, skipped",
+                           name, len(data) - offset)
+        # file first: a leftover log row for a deleted segment is harmless,
+        # a segment without its row would be replayed again
+        await asyncio.to_thread(os.remove, path)
+        async with db.get_pool().acquire() as conn:
+            await conn.execute(FORGET_SQL, name)
+        logger.info("Replayed spool segment %s", name)
+
+    async def _load_batch(self, conn, name, batch):
+        """Load (end offset, row) pairs in one go, or row by row if that fails on the data."""
+        try:
+            await self._load(conn, name, [row for _, row in batch], batch[-1][0])
+            return
+        except Exception as e:
+            if db.is_transient(e):
+                raise
+            logger.warning("Spool batch of %d rows from %s failed, replaying row by row: %s",
+                           len(batch), name, e)
+        for end_offset, row in batch:
+            try:
+                await self._load(conn, name, [row], end_offset)
+            except Exception as e:
+                if db.is_transient(e):
+                    raise
+                attempts = self._attempts.get((name, end_offset), 0) + 1
+                if attempts < self.max_attempts:
+                    self._attempts[(name, end_offset)] = attempts
+                    raise
+                await self._reject(conn, name, end_offset, row, e)
+            self._attempts.pop((name, end_offset), None)
+
+    async def _reject(self, conn, name, end_offset, row, error):
+        """Set a row that keeps failing aside in rejected/ and move the segment offset past it."""
+        deveui, received_at, payload, decoded, key = row
+        line = json_dumps({"deveui": deveui, "received_at": received_at.isoformat(), "payload": payload,
+                           "decoded": decoded, "frame_key": key, "error": str(error)}) + b"\n"
+        directory = os.path.join(self.directory, REJECTED_DIR)
+        await asyncio.to_thread(os.makedirs, directory, exist_ok=True)
+        path = os.path.join(directory, name[:-len(SEGMENT_SUFFIX)] + ".ndjson")
+        await asyncio.to_thread(_append_rejected, path, line)
+        await conn.execute(ADVANCE_SQL, name, end_offset)
+        self.rejected += 1
+        metrics.SPOOL_REJECTED.inc()
+        logger.error("Spooled uplink from %s failed %d replays, moved to %s: %s",
+                     deveui, self.max_attempts, path, error)
+
+    async def _load(self, conn, name, rows, end_offset):
+        async with conn.transaction():
+            _, states = await insert_rows(conn, rows)
+            await conn.execute(ADVANCE_SQL, name, end_offset)
+        self.replayed += len(rows)
+        if self.on_commit is not None:
+            self.on_commit(states)
@@ -0,0 +1,421 @@
+"""
+Where accepted uplinks go: dedup, then the batch writer, else the spool.
+
+LocalStore owns the batch writer, outbox dispatcher, spool, recent-frame
+index and device-state cache. With a single uvicorn process it runs inside the app. Under
+app.serve it runs once in a dedicated writer process
+(`python -m app.store /path/to.sock`), and every HTTP worker talks to it
+through a RemoteStore over a unix socket. That way N workers still share
+one pool, one group-commit queue and one dedup index.
+
+The socket protocol is length-prefixed JSON frames:
+[seq, op, args] -> [seq, ok, result], many requests in flight per connection.
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import signal
+import struct
+from datetime import datetime
+
+from app import db, metrics
+from app.dedup import RecentFrames
+from app.devices import DeviceStates
+from app.logs import kv, setup_logging, shutdown_logging
+from app.outbox import OutboxDispatcher
+from app.spool import Spool
+from app.utils import json_dumps, json_loads
+from app.writer import BatchWriter
+
+try:
+    import uvloop
+except ImportError:  # plain asyncio loop
+    uvloop = None
+
+logger = logging.getLogger(__name__)
+
+WRITER_SOCKET = os.environ.get("WRITER_SOCKET", "")  # set: talk to a shared writer process
+GAUGE_REFRESH_INTERVAL = 5  # seconds, multi-process metrics only
+# seconds between device_state reloads, for rows written by other processes (rebuild, importer)
+DEVICE_STATE_REFRESH = float(os.environ.get("DEVICE_STATE_REFRESH", "60"))
+
+FRAME = struct.Struct(">I")
+
+
+class StoreUnavailable(Exception):
+    """The uplink could be neither stored nor spooled."""
+
+
+async def read_frame(reader):
+    (length,) = FRAME.unpack(await reader.readexactly(FRAME.size))
+    return json_loads(await reader.readexactly(length))
+
+
+def write_frame(writer, message):
+    body = json_dumps(message)
+    writer.write(FRAME.pack(len(body)) + body)
+
+
+class LocalStore:
+    def __init__(self):
+        self.writer = BatchWriter()
+        self.dispatcher = OutboxDispatcher()
+        self.spool = Spool()
+        self.recent_frames = RecentFrames()
+        self.devices = DeviceStates()
+        self.writer.on_commit = self._committed
+        self.spool.on_commit = self._committed
+        self._refresh_task = None
+        self._devices_task = None
+
+    async def start(self):
+        await db.init_pool()
+        await self.writer.start()
+        await self.dispatcher.start()
+        await self.spool.start()
+        if db.is_healthy():
+            try:
+                await self.devices.load()
+            except Exception as e:
+                logger.error("Could not load device_state: %s", e)
+        if metrics.MULTIPROCESS:
+            self._refresh_task = asyncio.create_task(self._refresh_gauges())
+        if DEVICE_STATE_REFRESH > 0:
+            self._devices_task = asyncio.create_task(self._refresh_devices())
+
+    async def stop(self):
+        """Flush queued batches, then shut the background tasks and the pool."""
+        for task in (self._refresh_task, self._devices_task):
+            if task is not None:
+                task.cancel()
+        await self.writer.stop()
+        await self.spool.stop()
+        await self.dispatcher.stop()
+        await db.close_pool()
+
+    def register_gauges(self):
+        """Scrape-time gauges for this store; call once per process."""
+        metrics.gauge("ingest_db_pool_size", "Open database connections", lambda: db.pool_stats()["size"])
+        metrics.gauge("ingest_db_pool_idle", "Idle database connections", lambda: db.pool_stats()["idle"])
+        metrics.gauge("ingest_db_up", "1 if the last database health check passed", lambda: int(db.is_healthy()))
+        metrics.gauge("ingest_writer_queue_depth", "Uplinks waiting for the batch writer",
+                      lambda: self.writer.queue.qsize())
+        metrics.gauge("ingest_outbox_backlog", "forward_outbox rows waiting (counted up to the limit)",
+                      lambda: self.dispatcher.backlog)
+        metrics.gauge("ingest_spool_segments", "Spool segments waiting for replay",
+                      lambda: len(self.spool.segments()))
+        metrics.gauge("ingest_dedup_tracked_frames", "Frames in the recent-frame index",
+                      lambda: self.recent_frames.stats()["tracked"])
+        metrics.gauge("ingest_devices_tracked", "Devices in the device-state cache",
+                      lambda: len(self.devices.states))
+
+    def _committed(self, states):
+        self.devices.update(states)
+        self.dispatcher.notify()
+
+    async def _refresh_gauges(self):
+        while True:
+            metrics.refresh_gauges()
+            await asyncio.sleep(GAUGE_REFRESH_INTERVAL)
+
+    async def _refresh_devices(self):
+        """Reload device_state now and then; batches only patch in what this process wrote."""
+        while True:
+            await asyncio.sleep(DEVICE_STATE_REFRESH)
+            if not db.is_healthy():
+                continue
+            try:
+                await self.devices.load()
+            except Exception as e:
+                logger.error("Could not reload device_state: %s", e)
+
+    async def store(self, deveui, received_at, uplink, decoded=None, key=None) -> str:
+        """
+        Store one uplink; returns "stored-and-queued", "spooled" or "duplicate".
+        Raises StoreUnavailable if it could not even be spooled.
+        """
+        # Copies of a frame (one per gateway, or network server retries) get
+        # the same answer as the first without another write or forward
+        if key is not None and self.recent_frames.seen(deveui, key):
+            metrics.DUPLICATE.inc()
+            return "duplicate"
+
+        # Fall back to the local spool while the database is down, the writer
+        # is backed up or older rows are still spooled
+        if db.is_healthy() and not self.writer.saturated() and not self.spool.has_backlog():
+            try:
+                row_id = await self.writer.submit(deveui, received_at, uplink, decoded, key)
+                if row_id is None:
+                    self.recent_frames.db_duplicates += 1
+                    metrics.DUPLICATE.inc()
+                    return "duplicate"
+                metrics.STORED.inc()
+                metrics.count_device(deveui)
+                return "stored-and-queued"
+            except Exception as e:
+                logger.error("Storing uplink for %s failed, spooling it: %s", deveui, e)
+
+        try:
+            await self.spool.append(deveui, received_at, uplink, decoded, key)
+        except OSError as e:
+            if key is not None:
+                self.recent_frames.forget(deveui, key)
+            metrics.FAILED.inc()
+            logger.exception("Could not spool uplink for %s: %s", deveui, e)
+            raise StoreUnavailable("Uplink storage unavailable") from e
+        metrics.SPOOLED.inc()
+        metrics.count_device(deveui)
+        return "spooled"
+
+    async def store_batch(self, rows) -> list:
+        """
+        Store (deveui, received_at, uplink, decoded, key) rows in one
+        transaction, or spool them together; returns a status per row as
+        store() does. Raises StoreUnavailable if they could not be spooled.
+        """
+        statuses = ["duplicate"] * len(rows)
+        fresh = [i for i, (deveui, _, _, _, key) in enumerate(rows)
+                 if key is None or not self.recent_frames.seen(deveui, key)]
+        metrics.DUPLICATE.inc(len(rows) - len(fresh))
+        if not fresh:
+            return statuses
+        batch = [rows[i] for i in fresh]
+
+        if db.is_healthy() and not self.writer.saturated() and not self.spool.has_backlog():
+            try:
+                ids = await self.writer.write(batch)
+            except Exception as e:
+                logger.error("Storing a batch of %d uplinks failed, spooling it: %s", len(batch), e)
+            else:
+                for i, row_id in zip(fresh, ids):
+                    if row_id is None:
+                        self.recent_frames.db_duplicates += 1
+                        metrics.DUPLICATE.inc()
+                    else:
+                        statuses[i] = "stored-and-queued"
+                        metrics.STORED.inc()
+                        metrics.count_device(rows[i][0])
+                return statuses
+
+        try:
+            await self.spool.append_many(batch)
+        except OSError as e:
+            for deveui, _, _, _, key in batch:
+                if key is not None:
+                    self.recent_frames.forget(deveui, key)
+            metrics.FAILED.inc(len(batch))
+            logger.exception("Could not spool a batch of %d uplinks: %s", len(batch), e)
+            raise StoreUnavailable("Uplink storage unavailable") from e
+        for i in fresh:
+            statuses[i] = "spooled"
+            metrics.SPOOLED.inc()
+            metrics.count_device(rows[i][0])
+        return statuses
+
+    async def stats(self) -> dict:
+        return {
+            "writer": {
+                **self.writer.stats.as_dict(),
+                "queue_depth": self.writer.queue.qsize(),
+                "queue_max": self.writer.queue.maxsize,
+                "saturated": self.writer.saturated(),
+            },
+            "outbox": {
+                "forwarded": self.dispatcher.forwarded,
+                "failed": self.dispatcher.failed,
+                "backlog": self.dispatcher.backlog,
+                "saturated": self.dispatcher.saturated(),
+            },
+            "spool": self.spool.stats(),
+            "dedup": self.recent_frames.stats(),
+            "devices": self.devices.stats(),
+        }
+
+    async def device_list(self) -> list:
+        await self._load_devices()
+        return self.devices.summaries()
+
+    async def device(self, deveui: str):
+        """Latest state of one device, or None if it was never seen."""
+        await self._load_devices()
+        return self.devices.get(deveui)
+
+    async def _load_devices(self):
+        try:
+            await self.devices.ensure_loaded()
+        except Exception as e:
+            raise StoreUnavailable(f"Device state unavailable: {e}") from e
+
+    # ---- writer process side of the socket ----
+
+    async def handle_connection(self, reader, writer):
+        tasks = set()
+        try:
+            while True:
+                seq, op, args = await read_frame(reader)
+                task = asyncio.create_task(self._answer(writer, seq, op, args))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+
+    async def _answer(self, writer, seq, op, args):
+        try:
+            if op == "store":
+                deveui, received_at, uplink, decoded, key = args
+                result = await self.store(deveui, datetime.fromisoformat(received_at), uplink, decoded, key)
+            elif op == "store_batch":
+                result = await self.store_batch([
+                    (deveui, datetime.fromisoformat(received_at), uplink, decoded, key)
+                    for deveui, received_at, uplink, decoded, key in args
+                ])
+            elif op == "stats":
+                result = await self.stats()
+            elif op == "devices":
+                result = await self.device_list()
+            elif op == "device":
+                result = await self.device(args)
+            else:
+                raise ValueError(f"Unknown store operation: {op}")
+            write_frame(writer, [seq, True, result])
+        except Exception as e:
+            write_frame(writer, [seq, False, str(e) or type(e).__name__])
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+class RemoteStore:
+    """Client for the shared writer process; same methods as LocalStore."""
+
+    def __init__(self, path=WRITER_SOCKET):
+        self.path = path
+        self._seq = itertools.count()
+        self._pending = {}
+        self._writer = None
+        self._reader_task = None
+        self._connect_lock = asyncio.Lock()
+
+    async def start(self):
+        await db.init_pool()  # reads (/uplink/raw, /health) still use a small local pool
+        try:
+            await self._connect()
+        except OSError as e:
+            logger.error("Writer process at %s is not reachable yet: %s", self.path, e)
+
+    async def stop(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        await db.close_pool()
+
+    def register_gauges(self):
+        pass  # the writer process exports them
+
+    async def _connect(self):
+        reader, self._writer = await asyncio.open_unix_connection(self.path)
+        self._reader_task = asyncio.create_task(self._read_replies(reader, self._writer))
+
+    async def _read_replies(self, reader, writer):
+        try:
+            while True:
+                seq, ok, result = await read_frame(reader)
+                future = self._pending.pop(seq, None)
+                if future is not None and not future.done():
+                    future.set_result((ok, result))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.error("Lost the connection to the writer process")
+        finally:
+            if self._writer is writer:
+                self._writer = None
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(StoreUnavailable("Writer process connection lost"))
+            self._pending.clear()
+
+    async def _call(self, op, args):
+        if self._writer is None:
+            async with self._connect_lock:
+                if self._writer is None:
+                    try:
+                        await self._connect()
+                    except OSError as e:
+                        raise StoreUnavailable(f"Writer process unavailable: {e}") from e
+        seq = next(self._seq)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[seq] = future
+        write_frame(self._writer, [seq, op, args])
+        await self._writer.drain()
+        ok, result = await future
+        if not ok:
+            raise StoreUnavailable(result)
+        return result
+
+    async def store(self, deveui, received_at, uplink, decoded=None, key=None) -> str:
+        return await self._call("store", [deveui, received_at.isoformat(), uplink, decoded, key])
+
+    async def store_batch(self, rows) -> list:
+        return await self._call("store_batch", [
+            [deveui, received_at.isoformat(), uplink, decoded, key]
+            for deveui, received_at, uplink, decoded, key in rows
+        ])
+
+    async def stats(self) -> dict:
+        return await self._call("stats", None)
+
+    async def device_list(self) -> list:
+        return await self._call("devices", None)
+
+    async def device(self, deveui: str):
+        return await self._call("device", deveui)
+
+
+def create_store():
+    return RemoteStore(WRITER_SOCKET) if WRITER_SOCKET else LocalStore()
+
+
+async def serve_writer(path):
+    """Run the shared LocalStore behind a unix socket until SIGTERM/SIGINT."""
+    store = LocalStore()
+    store.register_gauges()
+    await store.start()
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(store.handle_connection, path=path)
+    logger.info("Writer process listening", extra=kv(socket=path, pid=os.getpid()))
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+    await stopping.wait()
+
+    logger.info("Writer process draining")
+    server.close()
+    await server.wait_closed()
+    await store.stop()
+    if os.path.exists(path):
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared writer process for app.serve")
+    parser.add_argument("socket", help="unix socket path to listen on")
+    args = parser.parse_args()
+    setup_logging()
+    try:
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop if uvloop else None) as runner:
+            runner.run(serve_writer(args.socket))
+    finally:
+        shutdown_logging()
@@ -0,0 +1,27 @@
+from datetime import datetime, timezone
+from functools import lru_cache
+
+import orjson
+
+
+@lru_cache(maxsize=4096)
+def parse_timestamp(timestamp_str: str) -> datetime:
+    """
+    Parses ISO 8601 timestamps, handling Zulu time; naive times are UTC.
+    Cached, since every gateway copy and retry of a frame repeats its Time.
+    """
+    # Python 3.11's fromisoformat accepts "Z" and fractional seconds natively;
+    # a bad value raises ValueError and the caller decides whether to log it
+    parsed = datetime.fromisoformat(timestamp_str)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def json_dumps(value) -> bytes:
+    """Fast JSON encoding for payloads and JSONB parameters."""
+    return orjson.dumps(value)
+
+
+def json_loads(data):
+    return orjson.loads(data)
@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import os
+import time
+
+from app import compact, db, devices, metrics, outbox
+from app.forwarder import build_forward_payload
+from app.logs import kv
+
+logger = logging.getLogger(__name__)
+
+# Group-commit settings: flush after N rows or M milliseconds, whichever first
+WRITER_BATCH_SIZE = int(os.environ.get("WRITER_BATCH_SIZE", "50"))
+WRITER_FLUSH_INTERVAL_MS = float(os.environ.get("WRITER_FLUSH_INTERVAL_MS", "20"))
+WRITER_QUEUE_DEPTH = int(os.environ.get("WRITER_QUEUE_DEPTH", "1000"))
+
+# ids are drawn in input order up front, so each returned id maps back to
+# its row's position even when rows share (deveui, frame_key, received_at)
+INSERT_SQL = """
+    WITH input AS MATERIALIZED (
+        SELECT nextval('raw_uplinks_id_seq')::int AS id, u.*
+        FROM unnest($1::text[], $2::timestamptz[], $3::smallint[], $4::int[], $5::bigint[],
+                    $6::bytea[], $7::timestamptz[], $8::jsonb[], $9::jsonb[], $10::text[])
+            WITH ORDINALITY AS u(deveui, received_at, format, fport, fcnt, payload_bytes, ns_time, meta,
+                                 decoded, frame_key, ord)
+    ), inserted AS (
+        INSERT INTO raw_uplinks (id, deveui, received_at, format, fport, fcnt, payload_bytes, ns_time, meta,
+                                 decoded, frame_key)
+        SELECT id, deveui, received_at, format, fport, fcnt, payload_bytes, ns_time, meta, decoded, frame_key
+        FROM input ORDER BY ord
+        ON CONFLICT (deveui, frame_key, received_at) DO NOTHING
+        RETURNING id
+    )
+    SELECT input.ord, input.id FROM input JOIN inserted USING (id)
+"""
+
+
+async def insert_rows(conn, rows):
+    """
+    Insert (deveui, received_at, payload, decoded, frame_key) rows, their
+    forward_outbox entries and the device_state upsert on conn, inside the
+    caller's transaction. Payloads are stored compactly (app/compact.py).
+    Returns (ids aligned with rows, None where the frame was already
+    stored; the updated device_state rows).
+    """
+    packed = zip(*(compact.pack(r[0], r[2]) for r in rows))
+    records = await conn.fetch(
+        INSERT_SQL,
+        [r[0] for r in rows],
+        [r[1] for r in rows],
+        *(list(column) for column in packed),
+        [r[3] for r in rows],
+        [r[4] for r in rows],
+    )
+    ids = [None] * len(rows)
+    for record in records:
+        ids[record["ord"] - 1] = record["id"]
+    new = [(row_id, r) for row_id, r in zip(ids, rows) if row_id is not None]
+    await outbox.enqueue(
+        conn,
+        [row_id for row_id, _ in new],
+        [r[0] for _, r in new],
+        [build_forward_payload(r[2]) for _, r in new],
+    )
+    return ids, await devices.upsert(conn, rows, ids)
+
+
+class WriterStats:
+    """Running totals for the batching writer, cheap enough to keep always on."""
+
+    def __init__(self):
+        self.batches = 0
+        self.rows = 0
+        self.failed_batches = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_commit_seconds = 0.0
+        self.max_commit_seconds = 0.0
+        self.total_commit_seconds = 0.0
+
+    def record(self, size: int, seconds: float):
+        self.batches += 1
+        self.rows += size
+        self.last_batch_size = size
+        self.max_batch_size = max(self.max_batch_size, size)
+        self.last_commit_seconds = seconds
+        self.max_commit_seconds = max(self.max_commit_seconds, seconds)
+        self.total_commit_seconds += seconds
+
+    def as_dict(self) -> dict:
+        return {
+            "batches": self.batches,
+            "rows": self.rows,
+            "failed_batches": self.failed_batches,
+            "last_batch_size": self.last_batch_size,
+            "max_batch_size": self.max_batch_size,
+            "avg_batch_size": self.rows / self.batches if self.batches else 0.0,
+            "last_commit_ms": self.last_commit_seconds * 1000,
+            "max_commit_ms": self.max_commit_seconds * 1000,
+            "avg_commit_ms": self.total_commit_seconds * 1000 / self.batches if self.batches else 0.0,
+        }
+
+
+class BatchWriter:
+    """
+    Group-commit writer for raw_uplinks.
+
+    Handlers call submit() and await the row id; a single background task
+    collects queued rows and inserts them as one multi-row statement in one
+    transaction, so a burst of uplinks costs one WAL flush instead of many.
+    submit() only returns once the batch holding its row has committed. If
+    a batch fails on its data, its rows are retried one by one.
+    The matching forward_outbox and device_state rows are written in the
+    same transaction, and on_commit (if set) is called with the updated
+    device_state rows after every successful batch.
+    """
+
+    def __init__(self, batch_size=WRITER_BATCH_SIZE,
+                 flush_interval_ms=WRITER_FLUSH_INTERVAL_MS,
+                 queue_depth=WRITER_QUEUE_DEPTH):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.queue = asyncio.Queue(maxsize=queue_depth)
+        self.stats = WriterStats()
+        self.on_commit = None
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flush whatever is already queued, then stop the background task."""
+        if self._task is None:
+            return
+        await self.queue.put(None)
+        await self._task
+        self._task = None
+
+    def saturated(self) -> bool:
+        return self.queue.full()
+
+    async def submit(self, deveui: str, received_at, payload: dict, decoded: dict = None,
+                     frame_key: str = None):
+        """Row id once committed, or None if raw_uplinks already holds this frame."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(((deveui, received_at, payload, decoded, frame_key), future))
+        return await future
+
+    async def _collect(self):
+        """Wait for one row, then gather more until the batch is full or the interval ends."""
+        first = await self.queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            if not self.queue.empty():
+                item = self.queue.get_nowait()
+            else:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = await self._collect()
+            if batch:
+                await self._flush(batch)
+
+    async def write(self, rows):
+        """
+        Insert rows as one transaction of their own, outside the queue, for
+        callers that already hold a batch. Returns ids as insert_rows() does.
+        """
+        started = time.perf_counter()
+        try:
+            async with db.get_pool().acquire() as conn:
+                async with conn.transaction():
+                    ids, states = await insert_rows(conn, rows)
+        except Exception:
+            self.stats.failed_batches += 1
+            raise
+
+        elapsed = time.perf_counter() - started
+        self.stats.record(len(rows), elapsed)
+        metrics.DB_INSERT_SECONDS.observe(elapsed)
+        metrics.DB_BATCH_ROWS.observe(len(rows))
+        logger.debug("Committed uplink batch", extra=kv(rows=len(rows), ms=round(elapsed * 1000, 1)))
+        if self.on_commit is not None:
+            self.on_commit(states)
+        return ids
+
+    async def _flush(self, batch):
+        try:
+            ids = await self.write([row for row, _ in batch])
+        except Exception as e:
+            logger.error("Batch insert of %d uplinks failed: %s", len(batch), e)
+            if len(batch) > 1 and not db.is_transient(e):
+                # one bad row fails the whole statement: retry each on its own
+                # so only the failing row's caller gets the error
+                for item in batch:
+                    await self._flush([item])
+                return
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), row_id in zip(batch, ids):
+            if not future.done():
+                future.set_result(row_id)
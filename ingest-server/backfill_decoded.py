@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+backfill_decoded.py
+
+Fills raw_uplinks.decoded for rows stored before ingest-time decoding,
+using the batch decoder in app/decoders.py. Walks ids in keyset pages and
+writes each page back with a single UPDATE ... FROM unnest().
+"""
+
+import argparse
+import json
+import time
+
+from sqlalchemy import create_engine, text
+from app import decoders
+from app.checkpoints import INGEST_DB_URL
+
+BATCH_SIZE = 5000
+
+engine = create_engine(INGEST_DB_URL)
+
+FETCH_SQL = text("""
+    SELECT id, received_at, deveui, payload FROM raw_uplinks_json
+    WHERE id > :last_id AND decoded IS NULL AND payload ? 'payload_hex'
+    ORDER BY id
+    LIMIT :limit
+""")
+
+UPDATE_SQL = text("""
+    UPDATE raw_uplinks AS r SET decoded = d.decoded
+    FROM unnest(CAST(:ids AS bigint[]), CAST(:times AS timestamptz[]), CAST(:values AS jsonb[]))
+        AS d(id, received_at, decoded)
+    WHERE r.id = d.id AND r.received_at = d.received_at
+""")
+
+def backfill(batch_size=BATCH_SIZE):
+    last_id = 0
+    total = decoded_total = 0
+    started = time.monotonic()
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(FETCH_SQL, {"last_id": last_id, "limit": batch_size}).fetchall()
+            if not rows:
+                break
+            values = decoders.decode_batch([(row.deveui, row.payload) for row in rows])
+            hits = [(row, value) for row, value in zip(rows, values) if value is not None]
+            if hits:
+                conn.execute(UPDATE_SQL, {
+                    "ids": [row.id for row, _ in hits],
+                    "times": [row.received_at for row, _ in hits],
+                    "values": [json.dumps(value) for _, value in hits],
+                })
+        last_id = rows[-1].id
+        total += len(rows)
+        decoded_total += len(hits)
+        elapsed = time.monotonic() - started
+        print(f"[{time.strftime('%H:%M:%S')}] up to id {last_id}: decoded {decoded_total}/{total} "
+              f"({total / elapsed if elapsed > 0 else 0:.0f} rows/s)", flush=True)
+        if len(rows) < batch_size:
+            break
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="rows per page")
+    args = parser.parse_args()
+    backfill(batch_size=args.batch_size)
@@ -0,0 +1,269 @@
+"""
+Load test for the ingest pipeline.
+
+    python -m bench.load_test --spawn --requests 5000 --concurrency 32
+    python -m bench.load_test --url http://pi3:8000 --rate 200 --duration 60 \
+        --thresholds bench/thresholds.json --output results.json --consumer
+
+Replays JSON callbacks seeded from the raw_uplinks CSV export mixed with
+synthetic Actility query-string callbacks (--query-ratio) against
+POST /uplink. It reports throughput, latency percentiles, raw_uplinks
+rows/s and (with --consumer) how long `consumer.py --once` takes to catch
+up, as JSON. Every request carries its own Time and FCntUp so duplicate
+suppression doesn't swallow it. With --rate, latency is measured from each
+request's scheduled start, so a stalled server shows up as latency rather
+than as a quietly lower send rate.
+
+--spawn starts the stub device manager and uvicorn locally against the
+Postgres configured through POSTGRES_* / INGEST_DB_URL. The run exits 1
+if any threshold in --thresholds is exceeded.
+"""
+
+import argparse
+import asyncio
+import csv
+import itertools
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import httpx
+from sqlalchemy import create_engine, text
+
+from app.checkpoints import INGEST_DB_URL
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEED_CSV = os.path.join(ROOT, "raw_uplinks_2025-06-11_1043.csv")
+
+MAX_ID_SQL = text("SELECT coalesce(max(id), 0) FROM raw_uplinks")
+COUNT_SQL = text("SELECT count(*) FROM raw_uplinks WHERE id > :after")
+
+
+def load_seed(path):
+    """(deveui, payload_hex) pairs from a raw_uplinks CSV export."""
+    seed = []
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            try:
+                payload_hex = json.loads(row["payload"]).get("payload_hex")
+            except (ValueError, AttributeError):
+                continue
+            if payload_hex:
+                seed.append((row["deveui"], payload_hex))
+    return seed
+
+
+class Traffic:
+    """Builds the n-th request: a JSON callback from the seed, or an Actility query-string one."""
+
+    def __init__(self, seed, query_ratio=0.5, rng=None):
+        self.seed = seed
+        self.query_ratio = query_ratio
+        self.rng = rng or random.Random(1)
+        self.fcnt = {}
+
+    def request(self):
+        deveui, payload_hex = self.rng.choice(self.seed)
+        fcnt = self.fcnt[deveui] = self.fcnt.get(deveui, 0) + 1
+        now = datetime.now(timezone.utc).isoformat(timespec="microseconds")
+        if self.rng.random() < self.query_ratio:
+            params = {
+                "LrnDevEui": deveui,
+                "LrnFPort": "2",
+                "LrnInfos": f"UPHTTP_BENCH_LORA|{fcnt}",
+                "AS_ID": "bench",
+                "Time": now,
+                "Token": f"{self.rng.getrandbits(64):016x}",
+            }
+            return params, b"{}"
+        body = {"DevEUI_uplink": {
+            "DevEUI": deveui,
+            "Time": now,
+            "FPort": 2,
+            "FCntUp": fcnt,
+            "payload_hex": payload_hex,
+            "LrrRSSI": round(self.rng.uniform(-120, -60), 1),
+        }}
+        return None, json.dumps(body).encode()
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[max(math.ceil(q * len(ordered)) - 1, 0)]
+
+
+async def run_load(url, traffic, requests=None, duration=None, concurrency=16, rate=None):
+    """Send traffic until requests or duration runs out; returns (latencies, statuses, seconds)."""
+    counter = itertools.count()
+    latencies = []
+    statuses = {}
+    started = time.perf_counter()
+    deadline = started + duration if duration else None
+
+    async def worker(client):
+        while True:
+            index = next(counter)
+            if requests is not None and index >= requests:
+                return
+            scheduled = started + index / rate if rate else time.perf_counter()
+            if deadline is not None and scheduled >= deadline:
+                return
+            if rate:
+                await asyncio.sleep(max(scheduled - time.perf_counter(), 0))
+            params, body = traffic.request()
+            try:
+                response = await client.post("/uplink", params=params, content=body,
+                                             headers={"content-type": "application/json"})
+                status = response.status_code
+                if status == 200:
+                    status = response.json().get("status", status)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - scheduled)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30) as client:
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+    return latencies, statuses, time.perf_counter() - started
+
+
+def wait_for_rows(engine, after_id, expected, timeout=60):
+    """Seconds until raw_uplinks holds expected rows past after_id (None on timeout)."""
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        with engine.connect() as conn:
+            if conn.execute(COUNT_SQL, {"after": after_id}).scalar() >= expected:
+                return time.perf_counter() - started
+        time.sleep(0.1)
+    return None
+
+
+def run_consumer():
+    """Wall time of one `consumer.py --once` pass over the new rows."""
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "consumer.py", "--once"], cwd=ROOT, check=True,
+                   stdout=subprocess.DEVNULL)
+    return time.perf_counter() - started
+
+
+def check_thresholds(results, thresholds):
+    """Violations of {"max_p99_ms": 300, "min_throughput_rps": 100, ...} as strings."""
+    violations = []
+    for name, limit in thresholds.items():
+        bound, _, metric = name.partition("_")
+        value = results.get(metric)
+        if value is None:
+            continue
+        if (bound == "max" and value > limit) or (bound == "min" and value < limit):
+            violations.append(f"{metric}={value} ({bound} {limit})")
+    return violations
+
+
+def spawn(port, stub_port):
+    """Start the stub device manager and the ingest server; returns the processes."""
+    env = dict(os.environ,
+               DEVICE_MANAGER_URL=f"http://127.0.0.1:{stub_port}/process-uplink",
+               SPOOL_DIR=tempfile.mkdtemp(prefix="bench-spool-"),
+               LOG_LEVEL=os.environ.get("LOG_LEVEL", "WARNING"))
+    stub = subprocess.Popen([sys.executable, "-m", "bench.stub_device_manager", "--port", str(stub_port)],
+                            cwd=ROOT, env=env)
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app",
+                               "--host", "127.0.0.1", "--port", str(port), "--no-access-log"],
+                              cwd=ROOT, env=env)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            if httpx.get(f"{url}/health").json().get("database") == "up":
+                return url, [server, stub]
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    for process in (server, stub):
+        process.terminate()
+    raise SystemExit("ingest server did not come up")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark POST /uplink end to end")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="ingest server to load")
+    parser.add_argument("--spawn", action="store_true", help="start the server and a stub device manager")
+    parser.add_argument("--port", type=int, default=8011, help="port for --spawn")
+    parser.add_argument("--stub-port", type=int, default=9100, help="stub device manager port for --spawn")
+    parser.add_argument("--requests", type=int, default=None, help="requests to send (default 2000)")
+    parser.add_argument("--duration", type=float, default=None, help="seconds to run instead of --requests")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight")
+    parser.add_argument("--rate", type=float, default=None, help="requests per second (default: as fast as possible)")
+    parser.add_argument("--query-ratio", type=float, default=0.5, help="share of Actility query-string callbacks")
+    parser.add_argument("--seed-csv", default=SEED_CSV, help="raw_uplinks CSV export to draw payloads from")
+    parser.add_argument("--db-url", default=INGEST_DB_URL, help="ingest DB, for rows/s ('' to skip)")
+    parser.add_argument("--consumer", action="store_true", help="time consumer.py --once afterwards")
+    parser.add_argument("--thresholds", default=None, help="JSON file of max_*/min_* limits")
+    parser.add_argument("--output", default=None, help="also write the results JSON here")
+    args = parser.parse_args()
+    if args.requests is None and args.duration is None:
+        args.requests = 2000
+
+    processes = []
+    url = args.url
+    if args.spawn:
+        url, processes = spawn(args.port, args.stub_port)
+    try:
+        engine = create_engine(args.db_url) if args.db_url else None
+        if engine is not None:
+            with engine.connect() as conn:
+                start_id = conn.execute(MAX_ID_SQL).scalar()
+
+        traffic = Traffic(load_seed(args.seed_csv), query_ratio=args.query_ratio)
+        latencies, statuses, elapsed = asyncio.run(run_load(
+            url, traffic, requests=args.requests, duration=args.duration,
+            concurrency=args.concurrency, rate=args.rate,
+        ))
+        latencies.sort()
+        sent = len(latencies)
+        accepted = statuses.get("stored-and-queued", 0) + statuses.get("spooled", 0)
+        results = {
+            "requests": sent,
+            "seconds": round(elapsed, 3),
+            "throughput_rps": round(sent / elapsed, 1) if elapsed else None,
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2) if sent else None,
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2) if sent else None,
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if sent else None,
+            "max_ms": round(latencies[-1] * 1000, 2) if sent else None,
+            "error_rate": round((sent - accepted) / sent, 4) if sent else None,
+            "statuses": {str(k): v for k, v in statuses.items()},
+            "db_rows_per_s": None,
+            "consumer_catchup_s": None,
+        }
+        if engine is not None and accepted:
+            settle = wait_for_rows(engine, start_id, accepted)
+            if settle is not None:
+                results["db_rows_per_s"] = round(accepted / (elapsed + settle), 1)
+        if args.consumer:
+            results["consumer_catchup_s"] = round(run_consumer(), 2)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    if args.thresholds:
+        with open(args.thresholds) as f:
+            results["violations"] = check_thresholds(results, json.load(f))
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    if results.get("violations"):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Stand-in for the device manager's /process-uplink during benchmarks.
+
+    python -m bench.stub_device_manager --port 9100 [--delay-ms 5] [--fail-rate 0.01]
+
+Answers every POST with 200 (or 503 for --fail-rate of them) after
+--delay-ms, and reports how many it received on GET /stats.
+"""
+
+import argparse
+import http.server
+import json
+import random
+import threading
+import time
+
+_lock = threading.Lock()
+_stats = {"received": 0, "failed": 0}
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real service behind uvicorn
+    delay = 0.0
+    fail_rate = 0.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("content-length", 0)))
+        if self.delay:
+            time.sleep(self.delay)
+        failed = random.random() < self.fail_rate
+        with _lock:
+            _stats["received"] += 1
+            _stats["failed"] += failed
+        self._reply(503 if failed else 200, b'{"status": "ok"}')
+
+    def do_GET(self):
+        with _lock:
+            body = json.dumps(_stats).encode()
+        self._reply(200, body)
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub device manager for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--delay-ms", type=float, default=0.0, help="time to spend on each POST")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of POSTs answered 503")
+    args = parser.parse_args()
+    Handler.delay = args.delay_ms / 1000
+    Handler.fail_rate = args.fail_rate
+    server = http.server.ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    server.serve_forever()
@@ -1,54 +1,275 @@
-import psycopg2
-import json
+#!/usr/bin/env python3
+"""
+forward_cron.py
+
+Backfill: replays a range of raw_uplinks to the device manager.
+
+Live forwarding is done by the ingest server's forward_outbox dispatcher
+(app/outbox.py). This script is not a second live forwarder: running it
+on a schedule would send every uplink twice. Use it for rows the outbox
+never carried, such as imported history (app/importer.py), or to re-send
+a window the device manager lost:
+
+    python forward_cron.py --since 2025-06-01T00:00:00Z --until 2025-06-02T00:00:00Z
+    python forward_cron.py --after-id 2900 --until-id 5400
+    python forward_cron.py --resume --until-id 5400    # after a failed run
+
+The range is fixed when the run starts; without --until / --until-id it
+ends at the newest row then. Progress is kept in the "forwarder"
+checkpoint (see app/checkpoints.py), which --resume starts from.
+
+Rows are streamed in id order under one event loop and one pooled HTTP
+client, forwarded with bounded concurrency while keeping each DevEUI's
+uplinks in order, optionally rate limited. Only the contiguous prefix of
+acknowledged ids is checkpointed, so a failure or crash resumes exactly
+where forwarding became uncertain.
+"""
+
+import argparse
+import asyncio
 import os
-from app.forwarder import forward_uplink_to_device_manager
+import time
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import URL
+from app import checkpoints, metrics
+from app.forwarder import build_forward_payload, create_client, post_uplink
 
 DB_HOST = os.getenv("POSTGRES_HOST", "localhost")
 DB_NAME = os.getenv("POSTGRES_DB", "ingest")
 DB_USER = os.getenv("POSTGRES_USER", "ingestuser")
 DB_PASS = os.getenv("POSTGRES_PASSWORD", "ingestpass")
-LAST_ID_FILE = "last_id.txt"
+LAST_ID_FILE = "last_id.txt"  # legacy, only read once to seed the checkpoint
+
+BATCH_SIZE = 500           # rows fetched per page
+CONCURRENCY = 8            # requests in flight to the device manager
+MAX_PENDING = 2000         # rows read ahead of the checkpoint
+MAX_RETRIES = 5            # per row, before the run stops
+RETRY_BASE = 0.5           # seconds, doubled per retry
+CHECKPOINT_INTERVAL = 1.0  # seconds between checkpoint writes
+
+# Progress lives in the ingest DB's consumer_checkpoints table
+engine = create_engine(URL.create(
+    "postgresql",
+    username=DB_USER,
+    password=DB_PASS,
+    host=DB_HOST,
+    database=DB_NAME,
+))
+
+FETCH_SQL = text(
+    "SELECT id, deveui, payload, settled FROM raw_uplinks_json WHERE id > :last_id AND id <= :upper_id "
+    "ORDER BY id LIMIT :limit"
+)
 
 def get_last_id():
-    try:
-        with open(LAST_ID_FILE, "r") as f:
-            return int(f.read().strip())
-    except:
-        return 0
+    checkpoints.ensure_table(engine)
+    with engine.begin() as conn:
+        return checkpoints.load_or_seed(conn, checkpoints.FORWARDER, LAST_ID_FILE)
+
+def start_backfill(after_id):
+    """Point the forwarder checkpoint at the start of a new backfill range."""
+    checkpoints.ensure_table(engine)
+    with engine.begin() as conn:
+        checkpoints.reset(conn, checkpoints.FORWARDER, after_id)
+
+def id_range(since=None, until=None):
+    """(after_id, upper_id) covering rows received in [since, until)."""
+    with engine.connect() as conn:
+        after_id = checkpoints.id_before(conn, since) if since is not None else None
+        upper_id = checkpoints.id_before(conn, until) if until is not None else checkpoints.max_id(conn)
+    return after_id, upper_id
 
 def save_last_id(last_id):
-    with open(LAST_ID_FILE, "w") as f:
-        f.write(str(last_id))
-
-def forward_new_uplinks():
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASS
-    )
-    cur = conn.cursor()
-
-    last_id = get_last_id()
-    cur.execute("SELECT id, deveui, payload FROM raw_uplinks WHERE id > %s ORDER BY id ASC", (last_id,))
-    rows = cur.fetchall()
-
-    print(f"📡 Found {len(rows)} new uplinks to forward...")
-
-    for row in rows:
-        id, deveui, payload_json = row
-        print(f"→ Forwarding ID {id} for device {deveui}")
-        success = False
+    with engine.begin() as conn:
+        checkpoints.advance(conn, checkpoints.FORWARDER, last_id)
+        metrics.report_checkpoint(checkpoints.FORWARDER, last_id, checkpoints.lag(conn, last_id))
+
+def fetch_page(last_id, upper_id, limit):
+    """Rows after last_id up to upper_id, cut at the first one not settled (see app/checkpoints.py)."""
+    with engine.connect() as conn:
+        return checkpoints.settled(conn.execute(
+            FETCH_SQL, {"last_id": last_id, "upper_id": upper_id, "limit": limit},
+        ).fetchall())
+
+
+class RateLimiter:
+    """Token bucket shared by all senders; rate=None disables it."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = rate or 0
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.rate:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class AckTracker:
+    """Tracks acknowledged ids and exposes the highest contiguous one."""
+
+    def __init__(self, last_id):
+        self.committed = last_id
+        self._order = deque()
+        self._acked = set()
+
+    def add(self, row_id):
+        self._order.append(row_id)
+
+    def ack(self, row_id):
+        self._acked.add(row_id)
+        while self._order and self._order[0] in self._acked:
+            head = self._order.popleft()
+            self._acked.discard(head)
+            self.committed = head
+
+    def pending(self):
+        return len(self._order)
+
+
+class ReplayEngine:
+    def __init__(self, last_id, upper_id, concurrency=CONCURRENCY, rate=None,
+                 batch_size=BATCH_SIZE, max_retries=MAX_RETRIES):
+        self.last_id = last_id
+        self.upper_id = upper_id
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.tracker = AckTracker(last_id)
+        self.limiter = RateLimiter(rate)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._room = asyncio.Condition()
+        self._tails = {}
+        self._failed = None
+        self.forwarded = 0
+
+    async def _send(self, client, row, previous):
+        # per-DevEUI ordering: wait for the device's previous uplink
+        if previous is not None:
+            ok = await previous
+            if not ok:
+                return False
+        payload = build_forward_payload(row.payload)
+        for attempt in range(self.max_retries + 1):
+            if self._failed is not None:
+                return False
+            await self.limiter.acquire()
+            async with self._semaphore:
+                try:
+                    await post_uplink(client, payload)
+                    break
+                except Exception as e:
+                    error = e
+            if attempt < self.max_retries:
+                await asyncio.sleep(RETRY_BASE * (2 ** attempt))
+        else:
+            print(f"❌ Giving up on ID {row.id} for device {row.deveui}: {error}", flush=True)
+            async with self._room:
+                self._failed = row.id
+                self._room.notify_all()
+            return False
+
+        self.forwarded += 1
+        async with self._room:
+            self.tracker.ack(row.id)
+            self._room.notify_all()
+        return True
+
+    async def _checkpoint_loop(self):
+        saved = self.tracker.committed
+        while True:
+            await asyncio.sleep(CHECKPOINT_INTERVAL)
+            if self.tracker.committed != saved:
+                saved = self.tracker.committed
+                await asyncio.to_thread(save_last_id, saved)
+
+    async def run(self):
+        started = time.monotonic()
+        tasks = set()
+        checkpointer = asyncio.create_task(self._checkpoint_loop())
         try:
-            success = asyncio.run(forward_uplink_to_device_manager(deveui, payload_json))
-        except Exception as e:
-            print(f"❌ Error forwarding ID {id}: {e}")
-        if success:
-            save_last_id(id)
+            async with create_client() as client:
+                while self._failed is None:
+                    rows = await asyncio.to_thread(fetch_page, self.last_id, self.upper_id, self.batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        async with self._room:
+                            await self._room.wait_for(
+                                lambda: self.tracker.pending() < MAX_PENDING or self._failed is not None
+                            )
+                        if self._failed is not None:
+                            break
+                        self.tracker.add(row.id)
+                        task = asyncio.create_task(self._send(client, row, self._tails.get(row.deveui)))
+                        self._tails[row.deveui] = task
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+                        self.last_id = row.id
+                    # drop references to finished per-device chains
+                    self._tails = {k: t for k, t in self._tails.items() if not t.done()}
+                    if len(rows) < self.batch_size:
+                        break
+                if tasks:
+                    await asyncio.gather(*tasks)
+        finally:
+            checkpointer.cancel()
+            await asyncio.to_thread(save_last_id, self.tracker.committed)
+
+        elapsed = time.monotonic() - started
+        rate = self.forwarded / elapsed if elapsed > 0 else 0
+        print(f"📡 Forwarded {self.forwarded} uplinks in {elapsed:.1f}s ({rate:.0f}/s), checkpoint at {self.tracker.committed}", flush=True)
+        return self._failed is None
 
-    cur.close()
-    conn.close()
+
+def forward_range(after_id, upper_id, concurrency=CONCURRENCY, rate=None, batch_size=BATCH_SIZE):
+    """Forward rows with after_id < id <= upper_id; True if every one was accepted."""
+    print(f"📡 Forwarding uplinks after id {after_id} up to id {upper_id}...", flush=True)
+    replay = ReplayEngine(after_id, upper_id, concurrency=concurrency, rate=rate, batch_size=batch_size)
+    return asyncio.run(replay.run())
 
 if __name__ == "__main__":
-    import asyncio
-    forward_new_uplinks()
+    parser = argparse.ArgumentParser(description="Backfill a range of raw_uplinks to the device manager")
+    start = parser.add_mutually_exclusive_group(required=True)
+    start.add_argument("--since", type=datetime.fromisoformat, help="first row received at/after this ISO time")
+    start.add_argument("--after-id", type=int, help="start after this raw_uplinks id")
+    start.add_argument("--resume", action="store_true", help="start after the forwarder checkpoint")
+    end = parser.add_mutually_exclusive_group()
+    end.add_argument("--until", type=datetime.fromisoformat, help="stop before rows received at/after this time")
+    end.add_argument("--until-id", type=int, help="stop after this raw_uplinks id")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="requests in flight")
+    parser.add_argument("--rate", type=float, default=None, help="max uplinks per second (default: unlimited)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="rows fetched per page")
+    parser.add_argument("--metrics-port", type=int, default=0, help="serve Prometheus /metrics while running")
+    parser.add_argument("--metrics-file", default=None,
+                        help="write metrics here on exit (node_exporter textfile collector)")
+    args = parser.parse_args()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    after_id, upper_id = id_range(since=args.since, until=args.until)
+    if args.until_id is not None:
+        upper_id = args.until_id
+    if args.resume:
+        after_id = get_last_id()
+    else:
+        after_id = args.after_id if args.after_id is not None else after_id
+        start_backfill(after_id)
+    try:
+        ok = forward_range(after_id, upper_id, concurrency=args.concurrency, rate=args.rate,
+                           batch_size=args.batch_size)
+    finally:
+        if args.metrics_file:
+            metrics.write_textfile(args.metrics_file)
+    raise SystemExit(0 if ok else 1)
@@ -0,0 +1,5 @@
+CREATE TABLE IF NOT EXISTS consumer_checkpoints (
+    name TEXT PRIMARY KEY,
+    last_id BIGINT NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
@@ -0,0 +1,13 @@
+-- Latest state per device, upserted with every raw_uplinks batch (app/devices.py).
+-- Rebuild from raw_uplinks with: python -m app.devices rebuild
+CREATE TABLE IF NOT EXISTS device_state (
+    deveui TEXT PRIMARY KEY,
+    first_seen TIMESTAMP WITH TIME ZONE NOT NULL,
+    last_seen TIMESTAMP WITH TIME ZONE NOT NULL,
+    last_uplink_id BIGINT NOT NULL,
+    last_fport INTEGER,
+    last_payload JSONB NOT NULL,
+    last_decoded JSONB,
+    uplink_count BIGINT NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
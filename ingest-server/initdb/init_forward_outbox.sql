@@ -0,0 +1,13 @@
+CREATE TABLE IF NOT EXISTS forward_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    raw_uplink_id BIGINT NOT NULL,
+    deveui TEXT NOT NULL,
+    payload JSONB NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    last_error TEXT,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS forward_outbox_next_attempt_idx
+    ON forward_outbox (next_attempt_at, id);
@@ -1,6 +1,118 @@
+-- raw_uplinks is range partitioned by month on received_at; see
+-- app/partitions.py for creating months ahead, retention, and migrating
+-- a database that still has the original unpartitioned table.
 CREATE TABLE IF NOT EXISTS raw_uplinks (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     deveui TEXT NOT NULL,
-    received_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
-    payload JSONB NOT NULL
-);
+    received_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    payload JSONB NOT NULL,
+    PRIMARY KEY (id, received_at)
+) PARTITION BY RANGE (received_at);
+
+DO $$
+BEGIN
+    -- only on the partitioned layout; an old plain table is left alone until migrated
+    IF (SELECT relkind FROM pg_class WHERE oid = 'raw_uplinks'::regclass) = 'p' THEN
+        CREATE TABLE IF NOT EXISTS raw_uplinks_default PARTITION OF raw_uplinks DEFAULT;
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS raw_uplinks_p%s PARTITION OF raw_uplinks FOR VALUES FROM (%L) TO (%L)',
+            to_char(now(), 'YYYYMM'),
+            date_trunc('month', now())::date,
+            (date_trunc('month', now()) + interval '1 month')::date
+        );
+    END IF;
+END;
+$$;
+
+-- values decoded from payload_hex at ingest (app/decoders.py); NULL if no decoder applies
+ALTER TABLE raw_uplinks ADD COLUMN IF NOT EXISTS decoded JSONB;
+
+-- frame identity from app/dedup.py; the unique index drops copies of a frame
+-- the in-memory index missed (e.g. after a restart). NULL for older rows.
+ALTER TABLE raw_uplinks ADD COLUMN IF NOT EXISTS frame_key TEXT;
+CREATE UNIQUE INDEX IF NOT EXISTS raw_uplinks_frame_key_idx
+    ON raw_uplinks (deveui, frame_key, received_at);
+
+-- per-device reads: WHERE deveui = ... ORDER BY received_at DESC
+CREATE INDEX IF NOT EXISTS raw_uplinks_deveui_received_at_idx
+    ON raw_uplinks (deveui, received_at DESC);
+-- time-range scans and exports; tiny compared to a btree on an append-only table
+CREATE INDEX IF NOT EXISTS raw_uplinks_received_at_brin
+    ON raw_uplinks USING brin (received_at);
+
+-- Wake LISTENing consumers once per inserting statement (not per row);
+-- Postgres folds identical notifications within a transaction.
+CREATE OR REPLACE FUNCTION notify_raw_uplinks() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('raw_uplinks', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER raw_uplinks_notify
+    AFTER INSERT ON raw_uplinks
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_raw_uplinks();
+
+-- Compact storage (app/compact.py): the hot fields in typed columns, the
+-- rest of the uplink in meta, and format saying how to rebuild the payload.
+-- payload is NULL for such rows and only kept for rows not yet migrated.
+ALTER TABLE raw_uplinks ADD COLUMN IF NOT EXISTS format SMALLINT;
+ALTER TABLE raw_uplinks ADD COLUMN IF NOT EXISTS fport INTEGER;
+ALTER TABLE raw_uplinks ADD COLUMN IF NOT EXISTS fcnt BIGINT;
+ALTER TABLE raw_uplinks ADD COLUMN IF NOT EXISTS payload_bytes BYTEA;
+ALTER TABLE raw_uplinks ADD COLUMN IF NOT EXISTS ns_time TIMESTAMP WITH TIME ZONE;
+ALTER TABLE raw_uplinks ADD COLUMN IF NOT EXISTS meta JSONB;
+ALTER TABLE raw_uplinks ALTER COLUMN payload DROP NOT NULL;
+
+-- The stored uplink JSON of a compact row; mirrors app/compact.py pack().
+CREATE OR REPLACE FUNCTION uplink_payload(format SMALLINT, deveui TEXT, fport INTEGER, fcnt BIGINT,
+                                          payload_bytes BYTEA, ns_time TIMESTAMPTZ, meta JSONB)
+RETURNS JSONB AS $$
+DECLARE
+    p JSONB;
+BEGIN
+    p := jsonb_strip_nulls(jsonb_build_object(
+        'DevEUI', CASE WHEN format > 0 THEN deveui END,
+        CASE WHEN format = 2 THEN 'LrnFPort' ELSE 'FPort' END,
+        CASE WHEN format = 2 THEN to_jsonb(fport::text) ELSE to_jsonb(fport) END,
+        'FCntUp', fcnt,
+        'payload_hex', encode(payload_bytes, 'hex'),
+        'Time', to_char(ns_time AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.MS"+00:00"')
+    )) || coalesce(meta, '{}');
+    IF format = 2 THEN
+        -- Actility query string: query_params repeats the top-level fields
+        p := p || jsonb_build_object('query_params', jsonb_strip_nulls(jsonb_build_object(
+            'LrnDevEui', p->'DevEUI', 'Time', p->'Time', 'LrnFPort', p->'LrnFPort',
+            'LrnInfos', p->'LrnInfos', 'AS_ID', p->'AS_ID'
+        )));
+    END IF;
+    RETURN p;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE PARALLEL SAFE;
+
+-- An uplink without its tokens, as compact rows store it; mirrors
+-- app/compact.py stored_payload(). The importer compares with it, as rows
+-- not migrated yet still carry their Token.
+CREATE OR REPLACE FUNCTION uplink_without_tokens(p JSONB)
+RETURNS JSONB AS $$
+    SELECT CASE WHEN jsonb_typeof(p->'query_params') = 'object'
+                THEN (p - 'Token') || jsonb_build_object('query_params', (p->'query_params') - 'Token')
+                ELSE p - 'Token' END
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE;
+
+-- raw_uplinks in its original shape, whichever way each row is stored;
+-- consumer.py, forward_cron.py, /uplink/raw and the exports read this.
+-- settled: the row was written by a transaction older than every one still
+-- running; readers that checkpoint by id stop at the first unsettled row
+-- (app/checkpoints.py settled()).
+CREATE OR REPLACE VIEW raw_uplinks_json AS
+SELECT
+    id,
+    deveui,
+    received_at,
+    CASE WHEN format IS NULL THEN payload
+         ELSE uplink_payload(format, deveui, fport, fcnt, payload_bytes, ns_time, meta) END AS payload,
+    decoded,
+    frame_key,
+    age(xmin) > age(xid(pg_snapshot_xmin(pg_current_snapshot()))) AS settled
+FROM raw_uplinks;
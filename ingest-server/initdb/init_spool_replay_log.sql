@@ -0,0 +1,5 @@
+CREATE TABLE IF NOT EXISTS spool_replay_log (
+    segment TEXT PRIMARY KEY,
+    byte_offset BIGINT NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
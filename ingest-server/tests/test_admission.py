@@ -0,0 +1,19 @@
+from app.admission import Admission, not_ready_reasons
+
+def test_sheds_beyond_limit_and_reports_saturation():
+    admission = Admission(max_in_flight=4, ready_ratio=0.5)
+    assert all(admission.try_enter() for _ in range(4))
+    assert not admission.try_enter()
+    assert admission.stats() == {"in_flight": 4, "max_in_flight": 4, "shed": 1}
+    assert not_ready_reasons(admission, {}) == ["ingest at capacity"]
+    for _ in range(3):
+        admission.leave()
+    assert not admission.saturated()
+    assert admission.try_enter()
+
+def test_not_ready_on_writer_or_outbox_saturation():
+    admission = Admission(max_in_flight=4)
+    stats = {"writer": {"saturated": True}, "outbox": {"saturated": False}}
+    assert not_ready_reasons(admission, stats) == ["writer queue full"]
+    stats["outbox"]["saturated"] = True
+    assert len(not_ready_reasons(admission, stats)) == 2
@@ -0,0 +1,64 @@
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import psycopg2
+import pytest
+
+from app.checkpoints import INGEST_DB_URL, settled
+
+Row = namedtuple("Row", "id settled")
+
+def test_settled_stops_at_first_unsettled_row():
+    rows = [Row(1, True), Row(2, True), Row(3, False), Row(4, True)]
+    assert settled(rows) == rows[:2]
+    assert settled(rows[2:]) == []
+    assert settled(rows[:2]) == rows[:2]
+
+def _connect():
+    try:
+        conn = psycopg2.connect(INGEST_DB_URL, connect_timeout=2)
+    except psycopg2.OperationalError:
+        pytest.skip("ingest database not reachable")
+    with conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM information_schema.columns "
+                    "WHERE table_name = 'raw_uplinks_json' AND column_name = 'settled'")
+        if cur.fetchone() is None:
+            conn.close()
+            pytest.skip("initdb schema not applied")
+    conn.rollback()
+    return conn
+
+INSERT_SQL = "INSERT INTO raw_uplinks (deveui, received_at, payload) VALUES (%s, %s, '{}') RETURNING id"
+
+def test_rows_committed_out_of_id_order_are_not_skipped():
+    deveui = "CHECKPOINTTEST01"
+    now = datetime.now(timezone.utc)
+    slow, fast, reader = _connect(), _connect(), _connect()
+    reader.autocommit = True
+    try:
+        # slow takes the lower id and stays open, like an import batch
+        with slow.cursor() as cur:
+            cur.execute(INSERT_SQL, (deveui, now))
+            low_id = cur.fetchone()[0]
+        with fast.cursor() as cur:
+            cur.execute(INSERT_SQL, (deveui, now))
+            high_id = cur.fetchone()[0]
+        fast.commit()
+
+        with reader.cursor() as cur:
+            cur.execute("SELECT id, settled FROM raw_uplinks_json WHERE id >= %s ORDER BY id", (low_id,))
+            rows = [Row(*r) for r in cur.fetchall()]
+        assert [r.id for r in rows] == [high_id]
+        assert settled(rows) == []
+
+        slow.commit()
+        with reader.cursor() as cur:
+            cur.execute("SELECT id, settled FROM raw_uplinks_json WHERE id >= %s ORDER BY id", (low_id,))
+            rows = [Row(*r) for r in cur.fetchall()]
+        assert [r.id for r in settled(rows)] == [low_id, high_id]
+    finally:
+        slow.rollback()
+        with reader.cursor() as cur:
+            cur.execute("DELETE FROM raw_uplinks WHERE deveui = %s", (deveui,))
+        for conn in (slow, fast, reader):
+            conn.close()
@@ -0,0 +1,30 @@
+from datetime import datetime, timezone
+
+from app.compact import FORMAT_CALLBACK, FORMAT_OTHER, FORMAT_QUERY, pack, stored_payload
+from app.parser import parse_uplink
+
+def test_query_string_uplink_keeps_only_leftover_fields():
+    query = {"LrnDevEui": "0004A30B00FB6713", "LrnFPort": "1", "LrnInfos": "UPHTTP|1", "AS_ID": "as",
+             "Time": "2025-06-24T10:00:00.123+00:00", "Token": "secret"}
+    uplink = parse_uplink(b"{}", query).uplink
+    fmt, fport, fcnt, payload_bytes, ns_time, meta = pack("0004A30B00FB6713", uplink)
+    assert fmt == FORMAT_QUERY and fport == 1 and fcnt is None and payload_bytes is None
+    assert ns_time == datetime(2025, 6, 24, 10, 0, 0, 123000, tzinfo=timezone.utc)
+    assert meta == {"LrnInfos": "UPHTTP|1", "AS_ID": "as"}
+
+def test_callback_fields_move_to_columns_only_when_exact():
+    uplink = {"DevEUI": "58A0CB0000101640", "Time": "2025-06-10T19:07:24.887+00:00", "FPort": 2,
+              "FCntUp": 7, "payload_hex": "00db252c", "LrrRSSI": -80.5}
+    assert pack("58A0CB0000101640", uplink) == (
+        FORMAT_CALLBACK, 2, 7, bytes.fromhex("00db252c"),
+        datetime(2025, 6, 10, 19, 7, 24, 887000, tzinfo=timezone.utc), {"LrrRSSI": -80.5},
+    )
+    odd = dict(uplink, Time="2025-06-10T21:07:24.887+02:00", FPort="2", payload_hex="00DB252C")
+    fmt, fport, _, payload_bytes, _, meta = pack("58A0CB0000101640", odd)
+    assert fport == 2 and payload_bytes == bytes.fromhex("00db252c")
+    assert meta == {"Time": odd["Time"], "FPort": "2", "payload_hex": "00DB252C", "LrrRSSI": -80.5}
+
+def test_rows_without_matching_deveui_and_tokens():
+    assert pack("ABCDEF1234567890", {"payload_hex": "021a"})[0] == FORMAT_OTHER
+    payload = stored_payload({"DevEUI": "X", "Token": "t", "query_params": {"LrnDevEui": "X", "Token": "t"}})
+    assert payload == {"DevEUI": "X", "query_params": {"LrnDevEui": "X"}}
@@ -0,0 +1,39 @@
+import pytest
+from app import decoders
+
+def test_decode_browan_iaq():
+    values = decoders.decode("58A0CB0000101F62", {"payload_hex": "086b3444ffffffff"})
+    assert values == {
+        "status": 8,
+        "battery_v": 3.6,
+        "temperature_c": 20,
+        "humidity_pct": 68,
+        "co2_ppm": None,
+        "voc_ppb": None,
+        "decoder": "browan_tbhv110",
+    }
+
+def test_decode_picks_layout_by_length():
+    values = decoders.decode("58A0CB0000101640", {"payload_hex": "00db252c"})
+    assert values["decoder"] == "browan_tbhh100"
+    assert values["temperature_c"] == 5
+
+def test_decode_unknown_device_or_payload():
+    assert decoders.decode("ABCDEF1234567890", {"payload_hex": "021a00002c"}) is None
+    assert decoders.decode("58A0CB0000101640", {"payload_hex": "zz"}) is None
+    assert decoders.decode("58A0CB0000101640", {}) is None
+
+@pytest.mark.parametrize("use_numpy", [False, True])
+def test_decode_batch_matches_single(monkeypatch, use_numpy):
+    if use_numpy and decoders.np is None:
+        pytest.skip("numpy not installed")
+    if not use_numpy:
+        monkeypatch.setattr(decoders.BROWAN_IAQ, "dtype", None)
+        monkeypatch.setattr(decoders.BROWAN_TEMP_HUMIDITY, "dtype", None)
+    items = [
+        ("58A0CB0000101640", {"payload_hex": "00db252cffffffff"}),
+        ("ABCDEF1234567890", {"payload_hex": "021a00002c"}),
+        ("58A0CB0000101F62", {"payload_hex": "086b3444e803ffff"}),
+        ("58A0CB0000101640", {"payload_hex": "00db252c"}),
+    ]
+    assert decoders.decode_batch(items) == [decoders.decode(d, u) for d, u in items]
@@ -0,0 +1,31 @@
+from app.dedup import RecentFrames, frame_key
+
+def test_fcnt_key_ignores_gateway_fields():
+    a = {"DevEUI": "58A0CB0000101F62", "FCntUp": 12, "LrrRSSI": -90, "Lrrid": "gw1"}
+    b = dict(a, LrrRSSI=-101, Lrrid="gw2")
+    assert frame_key(a) == frame_key(b) == "fcnt:12"
+
+def test_hash_key_without_fcnt():
+    a = {"payload_hex": "086b3444ffffffff", "FPort": 2, "Time": "2025-06-10T19:09:41.572+02:00"}
+    assert frame_key(a).startswith("hash:")
+    assert frame_key(dict(a, LrrRSSI=-80)) == frame_key(a)
+    assert frame_key(dict(a, Time="2025-06-10T19:10:41.572+02:00")) != frame_key(a)
+    assert frame_key({"DevEUI": "58A0CB0000101F62"}) is None
+    # the same reading sent twice without FCntUp or Time is two frames
+    assert frame_key({"payload_hex": "086b3444ffffffff", "FPort": 2}) is None
+
+def test_window_and_bound():
+    frames = RecentFrames(window=60, max_entries=2)
+    assert not frames.seen("A", "fcnt:1")
+    assert frames.seen("A", "fcnt:1")
+    assert not frames.seen("B", "fcnt:1")
+    assert not frames.seen("A", "fcnt:2")   # evicts (A, fcnt:1)
+    assert not frames.seen("A", "fcnt:1")
+    assert frames.suppressed == 1
+    frames.forget("A", "fcnt:1")
+    assert not frames.seen("A", "fcnt:1")
+
+def test_expiry():
+    frames = RecentFrames(window=0)
+    assert not frames.seen("A", "fcnt:1")
+    assert not frames.seen("A", "fcnt:1")
@@ -0,0 +1,26 @@
+from datetime import datetime, timezone
+
+from app.devices import DeviceStates, uplink_fport
+
+def state(deveui, second, row_id, count):
+    return {
+        "deveui": deveui, "first_seen": datetime(2025, 6, 1, tzinfo=timezone.utc),
+        "last_seen": datetime(2025, 6, 1, 0, 0, second, tzinfo=timezone.utc), "last_uplink_id": row_id,
+        "last_fport": 2, "last_payload": {"payload_hex": "00"}, "last_decoded": None, "uplink_count": count,
+    }
+
+def test_newer_state_wins():
+    states = DeviceStates()
+    states.update([state("B", 10, 5, 3), state("A", 1, 1, 1)])
+    states.update([state("B", 5, 4, 2)])        # a stale load must not roll B back
+    assert states.get("B")["uplink_count"] == 3
+    states.update([state("B", 10, 5, 4)])       # a late uplink still counts
+    assert states.get("B")["uplink_count"] == 4
+    assert [s["deveui"] for s in states.summaries()] == ["A", "B"]
+    assert "last_payload" not in states.summaries()[0]
+
+def test_uplink_fport():
+    assert uplink_fport({"FPort": 2}) == 2
+    assert uplink_fport({"LrnFPort": "1"}) == 1
+    assert uplink_fport({"FPort": "x"}) is None and uplink_fport({}) is None
+    assert uplink_fport({"FPort": 10 ** 12}) is None and uplink_fport({"FPort": True}) is None
@@ -0,0 +1,24 @@
+from app.export import bounds_query, compression_for, export_query, open_chunk
+
+def test_export_query_placeholders_and_missing_columns():
+    sql, params = export_query("devices.uplinks", {"id", "deveui", "received_at", "payload"},
+                               0, 100, deveui="58A0CB0000101F62", placeholder="$")
+    assert "id > $1 AND id <= $2 AND deveui = $3" in sql
+    assert "NULL AS decoded" in sql
+    assert params == [0, 100, "58A0CB0000101F62"]
+    sql, params = bounds_query("raw_uplinks")
+    assert sql.endswith("WHERE true") and params == []
+
+def test_compression_from_extension():
+    assert compression_for("x.csv.gz") == "gzip"
+    assert compression_for("x.csv.zst") == "zstd"
+    assert compression_for("x.csv") is None
+    assert compression_for("x.csv", "gzip") == "gzip"
+
+def test_gzip_chunks_concatenate(tmp_path):
+    import gzip
+    path = str(tmp_path / "out.csv.gz")
+    for chunk in (b"a\n", b"b\n"):
+        with open_chunk(path, "gzip") as f:
+            f.write(chunk)
+    assert gzip.open(path).read() == b"a\nb\n"
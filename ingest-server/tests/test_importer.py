@@ -0,0 +1,28 @@
+import csv
+import io
+
+from app.importer import normalize, parse_chunk
+
+def test_normalize_csv_row_and_callback_body():
+    deveui, received_at, payload, decoded, key = normalize({
+        "id": "2", "deveui": "58a0cb0000101f62", "received_at": "2025-06-10 19:07:24.887+00",
+        "payload": '{"payload_hex": "086b3444ffffffff", "FCntUp": 3}',
+    })
+    assert deveui == "58A0CB0000101F62"
+    assert received_at.isoformat() == "2025-06-10T19:07:24.887000+00:00"
+    assert key == "fcnt:3"
+    deveui, received_at, payload, _, _ = normalize(
+        {"DevEUI_uplink": {"DevEUI": "58A0CB0000101F62", "Time": "2025-06-10T19:09:41Z"}}
+    )
+    assert payload["Time"] == "2025-06-10T19:09:41Z" and received_at.tzinfo is not None
+
+def test_parse_chunk_rejects_bad_rows():
+    text, rows, rejects = parse_chunk([
+        (1, '{"DevEUI": "58A0CB0000101F62", "Time": "2025-06-10T19:09:41Z"}'),
+        (2, '{"DevEUI": "not-hex", "Time": "2025-06-10T19:09:41Z"}'),
+        (3, '{"DevEUI": "58A0CB0000101F62"}'),
+        (4, "[1, 2]"),
+    ])
+    assert rows == 1 and [line for line, _ in rejects] == [2, 3, 4]
+    (row,) = csv.reader(io.StringIO(text))
+    assert row[0] == "58A0CB0000101F62" and row[1] == "2025-06-10T19:09:41+00:00"
@@ -0,0 +1,21 @@
+import logging
+from app.logs import KeyValueFormatter, RateLimitFilter, kv, parse_rate_limits
+
+def make_record(name="app.main", level=logging.INFO, msg="stored %s", args=("x",), **extra):
+    record = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+def test_parse_rate_limits():
+    assert parse_rate_limits("app.main=5, app.outbox=0.5,bad=x,") == {"app.main": 5.0, "app.outbox": 0.5}
+
+def test_rate_limit_drops_info_but_not_errors():
+    limiter = RateLimitFilter({"app": 2})
+    passed = [limiter.filter(make_record()) for _ in range(10)]
+    assert passed.count(True) == 2
+    assert limiter.filter(make_record(level=logging.ERROR))
+    assert limiter.filter(make_record(name="uvicorn"))
+
+def test_formatter_appends_fields():
+    line = KeyValueFormatter().format(make_record(**kv(deveui="58A0CB", id=7), suppressed=3))
+    assert line.endswith("app.main stored x deveui=58A0CB id=7 suppressed=3")
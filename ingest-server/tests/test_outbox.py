@@ -0,0 +1,7 @@
+from app.outbox import OUTBOX_RETRY_BASE, OUTBOX_RETRY_MAX, retry_delay
+
+def test_retry_delay_backs_off_and_caps():
+    assert retry_delay(0) == min(OUTBOX_RETRY_BASE, OUTBOX_RETRY_MAX)
+    assert retry_delay(1) == min(OUTBOX_RETRY_BASE * 2, OUTBOX_RETRY_MAX)
+    assert retry_delay(1100) == OUTBOX_RETRY_MAX
+    assert retry_delay(10 ** 6) == OUTBOX_RETRY_MAX
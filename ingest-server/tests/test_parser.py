@@ -0,0 +1,66 @@
+import pytest
+from datetime import datetime, timezone
+from app.parser import parse_batch_item, parse_uplink
+
+ACTILITY_QUERY = {
+    "LrnDevEui": "0004A30B00FB6713",
+    "LrnFPort": "1",
+    "LrnInfos": "test",
+    "AS_ID": "test",
+    "Time": "2025-06-24T10:00:00Z",
+    "Token": "dummytoken",
+}
+
+def test_actility_query_with_empty_json_body():
+    parsed = parse_uplink(b"{}", ACTILITY_QUERY)
+    assert parsed.deveui == "0004A30B00FB6713"
+    assert parsed.received_at == datetime(2025, 6, 24, 10, 0, tzinfo=timezone.utc)
+    assert parsed.uplink["LrnFPort"] == "1"
+    assert parsed.uplink["query_params"] == ACTILITY_QUERY
+
+def test_json_body_wrapped():
+    body = b'{"DevEUI_uplink": {"DevEUI": "58A0CB0000101640", "Time": "2025-06-10T19:07:24.887+00:00", "payload_hex": "00db252cffffffff"}}'
+    parsed = parse_uplink(body, {})
+    assert parsed.deveui == "58A0CB0000101640"
+    assert parsed.uplink["payload_hex"] == "00db252cffffffff"
+    assert parsed.received_at.microsecond == 887000
+
+def test_json_without_deveui_falls_back_to_query():
+    parsed = parse_uplink(b'{"foo": 1}', ACTILITY_QUERY)
+    assert parsed.deveui == "0004A30B00FB6713"
+
+def test_bad_time_uses_now():
+    parsed = parse_uplink(b"", dict(ACTILITY_QUERY, Time="yesterday"))
+    assert (datetime.now(timezone.utc) - parsed.received_at).total_seconds() < 5
+
+def test_missing_deveui():
+    with pytest.raises(ValueError):
+        parse_uplink(b"not json", {})
+    with pytest.raises(ValueError):
+        parse_uplink(b'{"DevEUI": 1234}', {})
+
+def test_batch_items_in_both_formats():
+    wrapped = parse_batch_item({"DevEUI_uplink": {"DevEUI": "58A0CB0000101640", "Time": "2025-06-10T19:07:24Z"}})
+    assert wrapped.deveui == "58A0CB0000101640"
+    query = parse_batch_item(dict(ACTILITY_QUERY, LrnFPort=1))
+    assert query.deveui == "0004A30B00FB6713"
+    assert query.uplink["LrnFPort"] == "1"
+    assert query.uplink == parse_uplink(b"{}", ACTILITY_QUERY).uplink
+    with pytest.raises(ValueError):
+        parse_batch_item(["not", "an", "object"])
+
+def test_batch_with_bad_items_rejects_only_those():
+    good = {"DevEUI": "58A0CB0000101640", "Time": "2025-06-10T19:07:24Z"}
+    items = [good, dict(good, Time=12345), dict(good, Time=["x"]), {"FPort": 2}, dict(good, Time=None)]
+    outcomes = []
+    for item in items:
+        try:
+            outcomes.append(parse_batch_item(item).deveui)
+        except ValueError:
+            outcomes.append("rejected")
+    assert outcomes == ["58A0CB0000101640", "rejected", "rejected", "rejected", "58A0CB0000101640"]
+
+def test_deveui_is_upper_cased():
+    parsed = parse_uplink(b'{"DevEUI": " 58a0cb0000101640 "}', {})
+    assert parsed.deveui == "58A0CB0000101640"
+    assert parse_batch_item(dict(ACTILITY_QUERY, LrnDevEui="0004a30b00fb6713")).deveui == "0004A30B00FB6713"
@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta, timezone
+
+from app.rollups import accumulate, bucket_start, day_range
+
+T = datetime(2025, 6, 10, 19, 7, 24, 887000, tzinfo=timezone.utc)
+
+def test_bucket_start_is_utc_aligned():
+    local = T.astimezone(timezone(timedelta(hours=2)))
+    assert bucket_start(local, "1m") == datetime(2025, 6, 10, 19, 7, tzinfo=timezone.utc)
+    assert bucket_start(local, "1h") == datetime(2025, 6, 10, 19, tzinfo=timezone.utc)
+    assert bucket_start(local, "1d") == datetime(2025, 6, 10, tzinfo=timezone.utc)
+
+def test_accumulate_counts_and_numeric_fields():
+    later = T + timedelta(minutes=5)
+    buckets, fields = accumulate([
+        ("A", T, {"decoder": "browan_tbhv110", "temperature_c": 20, "battery_v": 3.6, "co2_ppm": None}),
+        ("A", later, {"temperature_c": 22, "ok": True}),
+        ("A", later, None),
+    ])
+    hour = ("A", "1h", datetime(2025, 6, 10, 19, tzinfo=timezone.utc))
+    assert buckets[hour] == [3, T, later]
+    assert fields[hour + ("temperature_c",)] == [2, 20.0, 22.0, 42.0]
+    assert hour + ("ok",) not in fields and hour + ("co2_ppm",) not in fields
+    assert len([k for k in buckets if k[1] == "1m"]) == 2
+
+def test_day_range_covers_whole_days():
+    start, end = day_range(T, T + timedelta(days=1))
+    assert start == datetime(2025, 6, 10, tzinfo=timezone.utc)
+    assert end == datetime(2025, 6, 12, tzinfo=timezone.utc)
+    assert day_range(start, end) == (start, end)
@@ -0,0 +1,103 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+from app import spool as spool_module
+from app.spool import Spool, encode_record, read_records
+
+ROW = ("58A0CB0000101F62", datetime(2025, 6, 10, 17, 7, 24, 887000, tzinfo=timezone.utc),
+       {"DevEUI": "58A0CB0000101F62", "payload_hex": "0a"}, None, "fcnt:7")
+
+def test_round_trip_and_offsets():
+    data = encode_record(*ROW) + encode_record(*ROW)
+    records = list(read_records(data))
+    assert [row for _, row in records] == [ROW, ROW]
+    assert records[-1][0] == len(data)
+    assert list(read_records(data, records[0][0])) == records[1:]
+
+def test_torn_tail_is_ignored():
+    first = encode_record(*ROW)
+    data = first + encode_record(*ROW)[:-3]
+    assert [end for end, _ in read_records(data)] == [len(first)]
+
+def test_segments_roll_in_order(tmp_path):
+    spool = Spool(directory=str(tmp_path), segment_bytes=1)
+    for _ in range(3):
+        spool._append(encode_record(*ROW))
+    spool._seal()
+    segments = spool.segments()
+    assert len(segments) == 3 and segments == sorted(segments)
+    data = b"".join((tmp_path / name).read_bytes() for name in segments)
+    assert len(list(read_records(data))) == 3
+
+def test_append_many_writes_one_readable_run(tmp_path):
+    spool = Spool(directory=str(tmp_path))
+    asyncio.run(spool.append_many([ROW, ROW, ROW]))
+    spool._seal()
+    [segment] = spool.segments()
+    assert [row for _, row in read_records((tmp_path / segment).read_bytes())] == [ROW] * 3
+    assert spool.spooled == 3 and spool.has_backlog()
+
+class FakeConn:
+    """Just enough of an asyncpg connection for Spool replay: keeps the offsets."""
+
+    def __init__(self, offsets):
+        self.offsets = offsets
+
+    async def fetchval(self, sql, name):
+        return self.offsets.get(name)
+
+    async def execute(self, sql, name, offset=None):
+        if offset is None:
+            self.offsets.pop(name, None)
+        else:
+            self.offsets[name] = offset
+
+    def transaction(self):
+        return self
+
+    def acquire(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+def test_replay_sets_aside_a_row_that_always_fails(tmp_path, monkeypatch):
+    stored = []
+
+    async def insert_rows(conn, rows):
+        if any(row[0] == "BAD" for row in rows):
+            raise ValueError("invalid input for query argument")
+        stored.extend(row[0] for row in rows)
+        return [1] * len(rows), []
+
+    conn = FakeConn({})
+    monkeypatch.setattr(spool_module, "insert_rows", insert_rows)
+    monkeypatch.setattr(spool_module.db, "get_pool", lambda: conn)
+    monkeypatch.setattr(spool_module.db, "_healthy", True)
+    bad = ("BAD",) + ROW[1:]
+    spool = Spool(directory=str(tmp_path), replay_batch=10, max_attempts=3)
+    asyncio.run(spool.append_many([ROW, bad, ROW]))
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            asyncio.run(spool.replay())
+    assert stored == [ROW[0]]  # the row before the bad one is in, once
+    asyncio.run(spool.replay())
+    assert stored == [ROW[0], ROW[0]]
+    assert spool.segments() == [] and not spool.has_backlog() and spool.rejected == 1
+    [rejected] = (tmp_path / "rejected").iterdir()
+    assert json.loads(rejected.read_text())["deveui"] == "BAD"
+
+def test_replay_leaves_a_segment_opened_after_sealing(tmp_path):
+    spool = Spool(directory=str(tmp_path))
+    spool._append(encode_record(*ROW))
+    sealed = spool._seal()
+    spool._append(encode_record(*ROW))
+    assert len(sealed) == 1 and len(spool.segments()) == 2 and sealed[0] in spool.segments()
+    assert spool._file is not None
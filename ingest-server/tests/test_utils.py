@@ -0,0 +1,25 @@
+import pytest
+from datetime import datetime, timezone
+from app.utils import parse_timestamp
+
+def test_valid_iso_z():
+    ts = "2025-06-24T21:01:00Z"
+    dt = parse_timestamp(ts)
+    assert dt == datetime(2025, 6, 24, 21, 1, 0, tzinfo=timezone.utc)
+
+def test_valid_iso_offset():
+    ts = "2025-06-24T21:01:00+00:00"
+    dt = parse_timestamp(ts)
+    assert dt == datetime(2025, 6, 24, 21, 1, 0, tzinfo=timezone.utc)
+
+def test_invalid_format_raises():
+    with pytest.raises(ValueError):
+        parse_timestamp("invalid-date")
+
+def test_naive_is_utc():
+    dt = parse_timestamp("2025-06-24 21:01:00")
+    assert dt == datetime(2025, 6, 24, 21, 1, 0, tzinfo=timezone.utc)
+
+def test_fractional_seconds_and_offset():
+    dt = parse_timestamp("2025-06-10T19:07:24.887+02:00")
+    assert dt == datetime(2025, 6, 10, 17, 7, 24, 887000, tzinfo=timezone.utc)
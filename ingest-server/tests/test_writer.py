@@ -0,0 +1,31 @@
+import asyncio
+
+import pytest
+
+from app import db
+from app.writer import BatchWriter
+
+def test_failed_batch_is_retried_row_by_row(monkeypatch):
+    writer = BatchWriter()
+    written = []
+
+    async def write(rows):
+        if any(row == "bad" for row in rows):
+            raise ValueError("invalid input")
+        written.append(rows)
+        return [f"id-{row}" for row in rows]
+
+    monkeypatch.setattr(writer, "write", write)
+    monkeypatch.setattr(db, "_healthy", True)
+
+    async def flush():
+        loop = asyncio.get_running_loop()
+        batch = [(row, loop.create_future()) for row in ("a", "bad", "b")]
+        await writer._flush(batch)
+        return [future for _, future in batch]
+
+    good, bad, other = asyncio.run(flush())
+    assert good.result() == "id-a" and other.result() == "id-b"
+    with pytest.raises(ValueError):
+        bad.result()
+    assert written == [["a"], ["b"]]